@@ -0,0 +1,56 @@
+import unittest
+
+import numpy as np
+
+from tractor.cache import Cache
+from tractor.patch import Patch
+
+class CacheTest(unittest.TestCase):
+
+    def test_lru_bytes(self):
+        # each entry is 100 float64 pixels = 800 bytes
+        c = Cache(maxsize=100, maxbytes=2000)
+        for i in range(3):
+            c.put(i, (0., Patch(0, 0, np.zeros((10,10)))))
+        self.assertEqual(len(c), 2)
+        self.assertEqual(c.totalBytes(), 1600)
+        self.assertEqual(c.get(0, None), None)
+        c.get(1)
+        c.put(3, Patch(0, 0, np.zeros((10,10))))
+        # 2 was the least recently used
+        self.assertEqual(sorted(c.dict.keys()), [1, 3])
+        st = c.stats()
+        self.assertEqual(st['hits'], 1)
+        self.assertEqual(st['misses'], 1)
+        self.assertEqual(st['evictions'], 2)
+        self.assertEqual(st['nbytes'], 1600)
+
+        # too big to fit at all
+        c.put(4, np.zeros(1000))
+        self.assertEqual(len(c), 2)
+        self.assertEqual(c.stats()['rejected'], 1)
+
+        # replacing an entry does not double-count its bytes
+        c.put(3, np.zeros(10))
+        self.assertEqual(c.totalBytes(), 880)
+
+    def test_cost(self):
+        c = Cache(maxsize=None, maxbytes=3000, policy='cost')
+        c.put('slow', np.zeros(100), cost=10.)
+        c.put('fast', np.zeros(100), cost=0.1)
+        c.put('big', np.zeros(150), cost=1.)
+        # 'fast' has the lowest cost per byte
+        c.put('new', np.zeros(100), cost=1.)
+        self.assertEqual(sorted(c.dict.keys()), ['big', 'new', 'slow'])
+        self.assertEqual(c.totalBytes(), 2800)
+
+    def test_count(self):
+        c = Cache(maxsize=10)
+        for i in range(20):
+            c[i] = i
+        self.assertEqual(len(c), 10)
+        self.assertEqual(c.get(15), 15)
+        self.assertEqual(c.stats()['evictions'], 10)
+
+if __name__ == '__main__':
+    unittest.main()
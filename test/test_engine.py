@@ -0,0 +1,891 @@
+import unittest
+
+import numpy as np
+
+from tractor import *
+from tractor.galaxy import *
+
+def _make_tractor(nimg=2, H=30, W=40, seed=42):
+    np.random.seed(seed)
+    tims = []
+    for i in range(nimg):
+        psf = NCircularGaussianPSF([1.5 + 0.2*i], [1.])
+        tim = Image(data=np.zeros((H,W)), invvar=np.ones((H,W)) * 4.,
+                    psf=psf, wcs=NullWCS(), photocal=LinearPhotoCal(1.),
+                    sky=ConstantSky(0.))
+        tims.append(tim)
+    srcs = [PointSource(PixPos(12.3, 15.6), Flux(100.)),
+            ExpGalaxy(PixPos(30.2, 20.1), Flux(200.),
+                      GalaxyShape(3., 0.6, 30.)),
+            PointSource(PixPos(38.5, 3.2), Flux(50.)),]
+    tractor = Tractor(tims, srcs)
+    for i,tim in enumerate(tims):
+        mod = tractor.getModelImage(i)
+        tim.data = mod + np.random.normal(size=mod.shape) * 0.5
+    srcs[0].pos.x += 0.4
+    srcs[0].brightness.setParams([120.])
+    srcs[1].pos.y -= 0.3
+    tractor.freezeParam('images')
+    return tractor
+
+class _WideningPSF(NCircularGaussianPSF):
+    # wider to the right
+    def getPointSourcePatch(self, px, py, **kwargs):
+        psf = NCircularGaussianPSF([1. + px / 50.], [1.])
+        return psf.getPointSourcePatch(px, py, **kwargs)
+    def getPointSourceMixture(self, *args, **kwargs):
+        return None
+
+class _GradientSky(ConstantSky):
+    def addTo(self, mod, scale=1., x0=0, y0=0):
+        (h,w) = mod.shape
+        mod += self.val * scale * (x0 + np.arange(w))[np.newaxis,:]
+
+class _OldGradientSky(ConstantSky):
+    # (without pixel offsets)
+    def addTo(self, mod, scale=1.):
+        (h,w) = mod.shape
+        mod += self.val * scale * np.arange(w)[np.newaxis,:]
+
+def _make_shifting_tractor(skyclass):
+    # Three separate point sources, noiseless, on an image whose PSF
+    # and sky vary with position.
+    H,W = 40,90
+    tim = Image(data=np.zeros((H,W)), invvar=np.ones((H,W)),
+                psf=_WideningPSF([1.], [1.]), wcs=NullWCS(),
+                photocal=LinearPhotoCal(1.), sky=skyclass(0.5))
+    srcs = [PointSource(PixPos(x, 20.), Flux(100.))
+            for x in [10.3, 45.2, 75.6]]
+    tractor = Tractor([tim], srcs)
+    tim.data = tractor.getModelImage(0)
+    tractor.freezeParam('images')
+    return tractor
+
+def _make_pixelized_tractor(psfclass=PixelizedPSF):
+    # A point source and two galaxies, noiseless, on an image with a
+    # pixelized PSF.
+    H,W = 40,90
+    psf = NCircularGaussianPSF([1.5], [1.])
+    psf = psfclass(psf.getPointSourcePatch(0., 0., radius=8).patch)
+    tim = Image(data=np.zeros((H,W)), invvar=np.ones((H,W)), psf=psf,
+                wcs=NullWCS(), photocal=LinearPhotoCal(1.),
+                sky=ConstantSky(0.))
+    srcs = [PointSource(PixPos(10.3, 20.2), Flux(100.)),
+            ExpGalaxy(PixPos(45.2, 20.5), Flux(200.),
+                      GalaxyShape(2., 0.7, 30.)),
+            DevGalaxy(PixPos(75.6, 19.4), Flux(150.),
+                      GalaxyShape(1.5, 0.8, 120.))]
+    tractor = Tractor([tim], srcs)
+    tim.data = tractor.getModelImage(0)
+    tractor.freezeParam('images')
+    return tractor
+
+class EngineTest(unittest.TestCase):
+
+    def test_update_matrix(self):
+        # The sparse matrix built by getUpdateDirection must match a
+        # dense matrix built straight from the derivative patches.
+        tractor = _make_tractor()
+        allderivs = tractor.getDerivs()
+        tims = tractor.getImages()
+        A = tractor.getUpdateDirection(allderivs, priors=False,
+                                       shared_params=False,
+                                       get_A_matrix=True)
+        A = A.toarray()
+        NP = sum([tim.numberOfPixels() for tim in tims])
+        Ad = np.zeros((NP, len(allderivs)))
+        for col,param in enumerate(allderivs):
+            for deriv,tim in param:
+                row0 = 0
+                for t in tims:
+                    if t is tim:
+                        break
+                    row0 += t.numberOfPixels()
+                mod = np.zeros(tim.shape)
+                deriv.addTo(mod)
+                Ad[row0 : row0 + tim.numberOfPixels(), col] += (
+                    mod * tim.getInvError()).ravel()
+        scales = np.sqrt(np.sum(Ad**2, axis=0))
+        Ad /= scales[np.newaxis,:]
+        # Pixels that no derivative touches do not get rows.
+        Ad = Ad[np.any(Ad != 0, axis=1), :]
+        self.assertEqual(A.shape, Ad.shape)
+        self.assertTrue(np.allclose(A, Ad, rtol=1e-6, atol=1e-8))
+
+        s = tractor.getUpdateDirection(allderivs, scales_only=True)
+        self.assertTrue(np.allclose(s, scales, rtol=1e-6))
+
+    def test_update_direction(self):
+        tractor = _make_tractor()
+        allderivs = tractor.getDerivs()
+        X,V = tractor.getUpdateDirection(allderivs, variance=True)
+        self.assertEqual(len(X), tractor.numberOfParams())
+        self.assertEqual(len(V), tractor.numberOfParams())
+        self.assertTrue(np.all(np.isfinite(X)))
+        self.assertTrue(np.all(V > 0))
+        # no shared params here
+        X2 = tractor.getUpdateDirection(allderivs, shared_params=False)
+        self.assertTrue(np.allclose(X, X2))
+
+    def test_update_direction_chi(self):
+        # Passing in the full chi images gives the same answer as
+        # computing chi just where the derivatives are non-zero.
+        tractor = _make_tractor()
+        allderivs = tractor.getDerivs()
+        X1 = tractor.getUpdateDirection(allderivs)
+        chis = tractor.getChiImages()
+        X2 = tractor.getUpdateDirection(allderivs, chiImages=chis)
+        self.assertTrue(np.allclose(X1, X2))
+
+        # A source that is well inside one image: its update direction
+        # only involves a small part of the image.
+        tractor.catalog.freezeAllBut(0)
+        allderivs = tractor.getDerivs()
+        A = tractor.getUpdateDirection(allderivs, priors=False,
+                                       get_A_matrix=True)
+        NP = sum([tim.numberOfPixels() for tim in tractor.getImages()])
+        self.assertLess(A.shape[0], NP / 2)
+        tractor.catalog.thawAllParams()
+
+    def test_chi_roi_sky(self):
+        # _getChiRoi() works with skies that take pixel offsets and with
+        # ones that have the plain addTo(mod, scale) signature.
+        class GradientSky(ConstantSky):
+            def addTo(self, mod, scale=1.):
+                (H,W) = mod.shape
+                mod += scale * self.val * np.arange(W)[np.newaxis,:]
+        tractor = _make_tractor()
+        for sky in [ConstantSky(0.3), GradientSky(0.01)]:
+            for tim in tractor.getImages():
+                tim.sky = sky
+            chi = tractor.getChiImage(0)
+            roi = tractor._getChiRoi(tractor.getImage(0), 5, 25, 3, 20)
+            self.assertTrue(np.allclose(roi, chi[3:20, 5:25]))
+
+    def test_matrix_free(self):
+        tractor = _make_tractor()
+        allderivs = tractor.getDerivs()
+        X1,V1 = tractor.getUpdateDirection(allderivs, variance=True)
+        X2,V2 = tractor.getUpdateDirection(allderivs, variance=True,
+                                           matrix_free=True)
+        self.assertTrue(np.allclose(X1, X2, rtol=1e-5, atol=1e-8))
+        self.assertTrue(np.allclose(V1, V2, rtol=1e-5))
+        X1 = tractor.getUpdateDirection(allderivs, priors=False, damp=0.1)
+        X2 = tractor.getUpdateDirection(allderivs, priors=False, damp=0.1,
+                                        matrix_free=True)
+        self.assertTrue(np.allclose(X1, X2, rtol=1e-5, atol=1e-8))
+        # optimize() with the matrix-free operator
+        tractor.matrixFree = True
+        dlnp,X,alpha = tractor.optimize()
+        self.assertTrue(dlnp > 0)
+
+        # Sources far apart in a big image: the rows are just the
+        # pixels of the derivatives, not their bounding box.
+        from tractor.engine import _numberDerivativeRows
+        H,W = 1000,1200
+        psf = NCircularGaussianPSF([1.5], [1.])
+        tim = Image(data=np.zeros((H,W)), invvar=np.ones((H,W)),
+                    psf=psf, wcs=NullWCS(), photocal=LinearPhotoCal(1.),
+                    sky=ConstantSky(0.))
+        srcs = [PointSource(PixPos(20., 30.), Flux(100.)),
+                PointSource(PixPos(1150., 960.), Flux(100.))]
+        tractor = Tractor([tim], srcs)
+        tim.data = tractor.getModelImage(0) + np.random.normal(size=(H,W))
+        srcs[0].pos.x += 0.3
+        srcs[1].brightness.setParams([80.])
+        tractor.freezeParam('images')
+        allderivs = tractor.getDerivs()
+        nil,nil,Nrows = _numberDerivativeRows(allderivs)
+        self.assertTrue(Nrows < 0.01 * H * W)
+        A = tractor.getUpdateDirection(allderivs, priors=False,
+                                       get_A_matrix=True)
+        self.assertEqual(A.shape[0], Nrows)
+        for chis in [None, tractor.getChiImages()]:
+            X1 = tractor.getUpdateDirection(allderivs, chiImages=chis)
+            X2 = tractor.getUpdateDirection(allderivs, chiImages=chis,
+                                            matrix_free=True)
+            self.assertTrue(np.allclose(X1, X2, rtol=1e-5, atol=1e-8))
+
+    def test_optimize_loop(self):
+        tractor = _make_tractor()
+        for i in range(20):
+            dlnp,X,alpha = tractor.optimize()
+            if dlnp < 1e-3:
+                break
+        lnp1 = tractor.getLogProb()
+
+        tractor = _make_tractor()
+        lnp0 = tractor.getLogProb()
+        R = tractor.optimize_loop()
+        self.assertFalse(R['hit_limit'])
+        self.assertTrue(np.allclose(tractor.getLogProb(), lnp0 + R['dlnp']))
+        self.assertTrue(tractor.getLogProb() > lnp1 - 1e-2)
+        self.assertEqual(R['steps'], len([s for s in R['stats']
+                                          if s['accepted']]))
+        self.assertEqual(R['nevals'], len(R['stats']) + 1)
+        # the first (Gauss-Newton) step is well predicted
+        first = R['stats'][0]
+        self.assertTrue(first['accepted'])
+        self.assertTrue(abs(first['rho'] - 1.) < 0.2)
+
+    def test_logprob_gradient(self):
+        tractor = _make_tractor()
+        lnp,g = tractor.getLogProbGradient(return_lnp=True)
+        self.assertTrue(np.allclose(lnp, tractor.getLogProb()))
+        # J^T chi, with J from the derivative patches
+        allderivs = tractor.getDerivs()
+        chis = tractor.getChiImages()
+        for i,param in enumerate(allderivs):
+            gi = 0.
+            for deriv,tim in param:
+                mod = np.zeros(tim.shape)
+                deriv.addTo(mod)
+                j = list(tractor.getImages()).index(tim)
+                gi += np.sum(mod * tim.getInvError() * chis[j])
+            self.assertTrue(np.allclose(g[i], gi))
+        # fluxes are linear, so their derivatives are exact
+        p0 = tractor.getParams()
+        for i,name in enumerate(tractor.getParamNames()):
+            if not 'brightness' in name:
+                continue
+            tractor.setParam(i, p0[i] + 1e-3)
+            lnp1 = tractor.getLogProb()
+            tractor.setParam(i, p0[i] - 1e-3)
+            lnp2 = tractor.getLogProb()
+            tractor.setParam(i, p0[i])
+            fd = (lnp1 - lnp2) / 2e-3
+            self.assertTrue(np.abs(g[i] - fd) < 1e-3 * np.abs(fd) + 1e-3)
+        # priors
+        tractor.catalog[0].pos.addGaussianPrior('x', 12., 0.5)
+        g2 = tractor.getLogProbGradient()
+        dg = np.zeros(len(g))
+        dg[0] = -(p0[0] - 12.) / 0.5**2
+        self.assertTrue(np.allclose(g2, g + dg))
+
+    def test_lbfgsb(self):
+        def fluxfit():
+            tractor = _make_tractor()
+            for src in tractor.catalog:
+                src.freezeAllBut('brightness')
+            return tractor
+        tractor = fluxfit()
+        tractor.optimize_forced_photometry(direct=True)
+        p1 = tractor.getParams()
+        tractor = fluxfit()
+        tractor.optimize_lbfgsb()
+        self.assertTrue(np.allclose(tractor.getParams(), p1, rtol=1e-3))
+        # bounds
+        tractor = fluxfit()
+        self.assertTrue(p1[0] < 105.)
+        tractor.optimize_lbfgsb(bounds=[(105., None), (None, None),
+                                        (None, None)])
+        self.assertTrue(abs(tractor.getParams()[0] - 105.) < 1e-6)
+
+    def test_parameter_covariance(self):
+        tractor = _make_tractor()
+        # a blend
+        tractor.catalog.append(PointSource(PixPos(14.5, 16.), Flux(10.)))
+        allderivs = tractor.getDerivs()
+        C = tractor.getParameterCovariance(allderivs)
+        # dense Fisher matrix
+        A = []
+        for param in allderivs:
+            col = []
+            for tim in tractor.getImages():
+                mod = np.zeros(tim.shape)
+                for deriv,dtim in param:
+                    if dtim is tim:
+                        deriv.addTo(mod)
+                col.append((mod * tim.getInvError()).ravel())
+            A.append(np.hstack(col))
+        A = np.array(A).T
+        Cd = np.linalg.inv(np.dot(A.T, A))
+        self.assertTrue(np.allclose(C.toarray(), Cd, rtol=1e-4, atol=1e-10))
+        # sources 0 and 3 are blended
+        names = tractor.getParamNames()
+        i0 = names.index('catalog.source0.brightness.Flux')
+        i3 = names.index('catalog.source3.brightness.Flux')
+        self.assertTrue(C[i0,i3] < 0)
+
+        # For fluxes, the sweep finds the conditional errors,
+        # 1/sqrt(F_ii); the Fisher errors are marginalized.
+        for src in tractor.catalog:
+            src.freezeAllBut('brightness')
+        # the sweep starts from the maximum
+        tractor.optimize_forced_photometry(direct=True)
+        p0 = tractor.getParams()
+        sweep = tractor.computeParameterErrors()
+        tractor.setParams(p0)
+        fisher = tractor.computeParameterErrors(fisher=True)
+        F = tractor._normalEquations(tractor.getDerivs(),
+                                     tractor.getImages())[0].toarray()
+        self.assertTrue(np.allclose(sweep, 1. / np.sqrt(np.diag(F)),
+                                    rtol=1e-2))
+        self.assertTrue(np.allclose(fisher, np.sqrt(np.diag(np.linalg.inv(F)))))
+        self.assertTrue(fisher[0] > sweep[0])
+
+    def test_overlapping_sources(self):
+        tractor = _make_tractor()
+        tim = tractor.getImage(0)
+        r = np.random.RandomState(42)
+        xy = r.uniform(0, 50, size=(40,2))
+        tractor.catalog = Catalog(*[PointSource(PixPos(x, y), Flux(f))
+                                    for (x,y),f in zip(xy, r.uniform(1, 100, 40))])
+        def partition(groups):
+            return sorted([sorted(g) for g in groups.values()])
+        for minsb in [0.5, 0.05]:
+            g1,L,mod = tractor.getOverlappingSources(tim, minsb=minsb)
+            g2,L2,mod2 = tractor.getOverlappingSources(tim, minsb=minsb,
+                                                       fullImage=False)
+            self.assertEqual(L2, None)
+            self.assertEqual(sorted(g2.keys()), range(1, len(g2)+1))
+            # (grouping on individual rather than summed models could
+            # split groups, but doesn't here)
+            self.assertEqual(partition(g1), partition(g2))
+
+    def test_batch_models(self):
+        tractor = _make_tractor()
+        tractor.catalog.append(
+            FixedCompositeGalaxy(PixPos(5.5, 25.2), Flux(150.), 0.3,
+                                 GalaxyShape(2., 0.5, 10.),
+                                 GalaxyShape(1., 0.8, 80.)))
+        # off the edge of the image
+        tractor.catalog.append(PointSource(PixPos(-3., 10.), Flux(50.)))
+        mods = [tractor.getModelImage(i) for i in range(2)]
+        tractor.batchModels = True
+        for i in range(2):
+            mod = tractor.getModelImage(i)
+            self.assertTrue(np.allclose(mod, mods[i], rtol=1e-6, atol=1e-5))
+
+    def test_batch_pixelized_psf(self):
+        tractor = _make_tractor()
+        psf = tractor.getImage(0).getPsf()
+        pixpsf = PixelizedPSF(psf.getPointSourcePatch(0., 0., radius=7).patch)
+        for tim in tractor.getImages():
+            tim.psf = pixpsf
+        tractor.catalog = Catalog(*[
+            PointSource(PixPos(x, y), Flux(100.))
+            for x,y in [(10.3, 12.7), (14.5, 16.), (47.9, 3.2), (-2., 30.),
+                        (30.5, 20.5), (5., 5.)]])
+        mods = [tractor.getModelImage(i) for i in range(2)]
+        tractor.batchModels = True
+        for i in range(2):
+            mod = tractor.getModelImage(i)
+            self.assertTrue(np.allclose(mod, mods[i], rtol=1e-6, atol=1e-5))
+        # kernels from the table: shifts snapped to 1/64 pixel
+        pixpsf.Lsub = 64
+        mod = tractor.getModelImage(0)
+        self.assertTrue(np.allclose(mod, mods[0], atol=1e-2 * mods[0].max()))
+        self.assertFalse(np.all(mod == mods[0]))
+        # the kernel for a whole-pixel position is in the table
+        p1 = pixpsf.getPointSourcePatch(5., 5.)
+        self.assertTrue(np.allclose(p1.patch, pixpsf.img))
+
+    def test_calibration_changes(self):
+        # Changing an image's photocal or sky, by any route, changes its
+        # model (not a stale cached patch or resident model).
+        from tractor.cfht import CfhtPhotoCal
+        from tractor.utils import BaseParams
+        class TrackedWCS(NullWCS):
+            # a WCS whose hashkey is tracked, like ConstantFitsWcs's
+            hashkey = BaseParams.__dict__['hashkey']
+        for incremental in [False, True]:
+            tractor = _make_tractor()
+            tractor.incrementalModels = incremental
+            tim = tractor.getImage(0)
+            tim.wcs = TrackedWCS()
+            m0 = tractor.getModelImage(0)
+            k0 = tim.hashkey()
+            self.assertEqual(tim.hashkey(), k0)
+            src = tractor.catalog[0]
+            src.brightness.val *= 2.
+            self.assertFalse(np.allclose(tractor.getModelImage(0), m0))
+            src.brightness.val /= 2.
+            self.assertTrue(np.allclose(tractor.getModelImage(0), m0))
+            tim.getPhotoCal().val = 2.
+            m1 = tractor.getModelImage(0)
+            self.assertTrue(np.allclose(m1, 2. * m0))
+            tim.getSky().subtract(-3.)
+            m2 = tractor.getModelImage(0)
+            self.assertTrue(np.allclose(m2, m1 + 3.))
+            tim.getPhotoCal().setParams([1.])
+            tim.getSky().setParams([0.])
+            self.assertTrue(np.allclose(tractor.getModelImage(0), m0))
+
+        # (CfhtPhotoCal works with magnitudes)
+        tractor = _make_tractor()
+        tim = tractor.getImage(0)
+        pc = CfhtPhotoCal(hdr=dict(EXPTIME=1., PHOT_C=20., PHOT_K=0.,
+                                   AIRMASS=1.), bandname='r')
+        tim.photocal = pc
+        for src in tractor.catalog:
+            src.brightness = Mags(r=15.)
+        m0 = tractor.getModelImage(0)
+        pc.setParam(0, 20. + 2.5 * np.log10(2.))
+        self.assertTrue(np.allclose(tractor.getModelImage(0), 2. * m0))
+
+    def test_pixelized_psf_hashkey(self):
+        import pickle
+        img = np.exp(-0.1 * np.hypot(*np.meshgrid(np.arange(-7,8),
+                                                  np.arange(-7,8))))
+        p1 = PixelizedPSF(img.copy())
+        p2 = PixelizedPSF(img.copy())
+        self.assertEqual(p1.hashkey(), p2.hashkey())
+        # identical pixels share the FFT
+        self.assertTrue(p1.getFourierTransform(10.)[0] is
+                        p2.getFourierTransform(10.)[0])
+        tim = Image(data=np.zeros((20,20)), invvar=np.ones((20,20)), psf=p1)
+        k0 = tim.hashkey()
+        v0 = p1.getVersion()
+        p1.img[7,7] += 1.
+        p1.pixelsChanged()
+        self.assertNotEqual(p1.hashkey(), p2.hashkey())
+        self.assertNotEqual(tim.hashkey(), k0)
+        self.assertNotEqual(p1.getVersion(), v0)
+        self.assertFalse(p1.getFourierTransform(10.)[0] is
+                         p2.getFourierTransform(10.)[0])
+        p1.img = img.copy()
+        self.assertEqual(p1.hashkey(), p2.hashkey())
+        self.assertEqual(tim.hashkey(), k0)
+        p3 = pickle.loads(pickle.dumps(p1))
+        self.assertEqual(p3.hashkey(), p1.hashkey())
+        self.assertTrue(np.all(p3.img == img))
+        self.assertEqual(p1.copy().hashkey(), p1.hashkey())
+
+    def test_line_search(self):
+        results = {}
+        for ls in ['grid', 'quadratic']:
+            tractor = _make_tractor()
+            tractor.lineSearch = ls
+            p0 = tractor.getLogProb()
+            nlnp = [0]
+            getLogProb = tractor.getLogProb
+            def counting():
+                nlnp[0] += 1
+                return getLogProb()
+            tractor.getLogProb = counting
+            dlnp,X,alpha = tractor.optimize()
+            del tractor.getLogProb
+            self.assertTrue(dlnp > 0)
+            self.assertTrue(alpha > 0)
+            self.assertTrue(np.allclose(tractor.getLogProb(), p0 + dlnp))
+            results[ls] = (dlnp, nlnp[0])
+        # the quadratic search does nearly as well with fewer
+        # log-prob evaluations (including the one before stepping)
+        self.assertTrue(results['quadratic'][0] > 0.9 * results['grid'][0])
+        self.assertTrue(results['quadratic'][1] <= 4)
+        self.assertTrue(results['quadratic'][1] < results['grid'][1])
+
+    def test_parallel_line_search(self):
+        import multiprocessing
+        from astrometry.util.multiproc import multiproc
+        tractor = _make_tractor()
+        X = tractor.getUpdateDirection(tractor.getDerivs())
+        p0 = tractor.getParams()
+        r1 = tractor.tryUpdates(X)
+        p1 = tractor.getParams()
+        tractor.setParams(p0)
+        pool = multiprocessing.Pool(2)
+        try:
+            tractor.mp = multiproc(pool=pool)
+            r2 = tractor.tryUpdates(X, lineSearch='parallel')
+        finally:
+            pool.close()
+            pool.join()
+        self.assertEqual(r1[1], r2[1])
+        self.assertTrue(np.allclose(r1[0], r2[0]))
+        self.assertTrue(np.allclose(tractor.getParams(), p1))
+
+    def test_optimize_blobs(self):
+        import multiprocessing
+        from astrometry.util.multiproc import multiproc
+        tractor = _make_tractor()
+        p0 = tractor.getParams()
+        tractor.optimize_loop()
+        pfull = tractor.getParams()
+        lnpfull = tractor.getLogProb()
+        tractor.setParams(p0)
+        R = tractor.optimize_blobs(minsb=0.05)
+        self.assertTrue(len(R['blobs']) >= 2)
+        self.assertEqual(sorted(sum(R['blobs'], [])), [0, 1, 2])
+        self.assertTrue(R['dlnp'] > 0)
+        p1 = tractor.getParams()
+        # the blobs barely overlap, so the answer is nearly the same
+        self.assertTrue(abs(tractor.getLogProb() - lnpfull) < 0.1)
+        self.assertTrue(np.allclose(p1, pfull, rtol=1e-2, atol=0.05))
+        # in parallel
+        tractor.setParams(p0)
+        pool = multiprocessing.Pool(2)
+        try:
+            tractor.mp = multiproc(pool=pool)
+            R2 = tractor.optimize_blobs(minsb=0.05)
+        finally:
+            pool.close()
+            pool.join()
+        self.assertEqual(R['blobs'], R2['blobs'])
+        self.assertTrue(np.allclose(tractor.getParams(), p1))
+
+    def test_optimize_blobs_shifted(self):
+        # The blobs see the PSF and sky at their full-image positions.
+        for skyclass in [_GradientSky, _OldGradientSky]:
+            tractor = _make_shifting_tractor(skyclass)
+            ptrue = tractor.getParams()
+            for src in tractor.catalog:
+                src.pos.x += 0.2
+                src.brightness.setParams([80.])
+            R = tractor.optimize_blobs(minsb=0.01)
+            self.assertEqual(len(R['blobs']), 3)
+            self.assertTrue(np.allclose(tractor.getParams(), ptrue,
+                                        rtol=1e-4))
+        # galaxies on a pixelized PSF
+        tractor = _make_pixelized_tractor()
+        ptrue = tractor.getParams()
+        for src in tractor.catalog:
+            src.pos.x += 0.2
+            src.brightness.setParams([0.8 * src.brightness.getValue()])
+        R = tractor.optimize_blobs(minsb=0.01)
+        self.assertEqual(len(R['blobs']), 3)
+        # (the galaxy shapes converge slowly, as on the full image)
+        self.assertTrue(np.allclose(tractor.getParams(), ptrue, rtol=1e-2))
+
+    def test_resident_workers(self):
+        import os
+        import multiprocessing
+        from astrometry.util.multiproc import multiproc
+        tractor = _make_tractor()
+        def derivs():
+            return [[(d.x0, d.y0, d.patch.copy()) for d,img in param]
+                    for param in tractor.getDerivs()]
+        d1 = derivs()
+        m1 = tractor.getModelImages()
+        X = tractor.getUpdateDirection(tractor.getDerivs())
+        p0 = tractor.getParams()
+        r1 = tractor.tryUpdates(X)
+        p1 = tractor.getParams()
+        tractor.setParams(p0)
+        pool = multiprocessing.Pool(2)
+        try:
+            tractor.mp = multiproc(pool=pool)
+            tractor.residentWorkers = True
+            tractor.lineSearch = 'parallel'
+            d2 = derivs()
+            path = tractor._getWorkerState()
+            self.assertTrue(os.path.exists(path))
+            m2 = tractor.getModelImages()
+            r2 = tractor.tryUpdates(X)
+            # only the parameters changed, so the workers' copies are
+            # still good
+            self.assertEqual(tractor._getWorkerState(), path)
+            m3 = tractor.getModelImages()
+            # changing the catalog sends a new copy
+            tractor.catalog.freezeParam(2)
+            self.assertNotEqual(tractor._getWorkerState(), path)
+            self.assertFalse(os.path.exists(path))
+            d3 = derivs()
+            tractor.clearWorkerState()
+        finally:
+            pool.close()
+            pool.join()
+        for a,b in zip(d1, d2):
+            for (x0,y0,p),(x1,y1,q) in zip(a, b):
+                self.assertEqual((x0,y0), (x1,y1))
+                self.assertTrue(np.allclose(p, q))
+        self.assertEqual(len(d3), len(d1) - 3)
+        for a,b in zip(m1, m2):
+            self.assertTrue(np.allclose(a, b))
+        self.assertEqual(r1[1], r2[1])
+        self.assertTrue(np.allclose(tractor.getParams(), p1[:-3]))
+        tractor.mp = multiproc()
+        for a,b in zip(tractor.getModelImages(), m3):
+            self.assertTrue(np.allclose(a, b))
+
+    def test_worker_state(self):
+        import os
+        import gc
+        import cPickle as pickle
+        tractor = _make_tractor()
+        tractor.thawParam('images')
+        path = tractor._getWorkerState()
+        # thawed values, including the images', are sent with each task
+        tractor.getImage(0).sky.setParams([0.2])
+        tractor.catalog[0].pos.x += 0.1
+        self.assertEqual(tractor._getWorkerState(), path)
+        # frozen ones are not
+        tractor.catalog[1].freezeParam('brightness')
+        path2 = tractor._getWorkerState()
+        self.assertNotEqual(path2, path)
+        self.assertFalse(os.path.exists(path))
+        tractor.catalog[1].brightness.setParams([150.])
+        path3 = tractor._getWorkerState()
+        self.assertNotEqual(path3, path2)
+        self.assertFalse(os.path.exists(path2))
+        # the file goes with the Tractor
+        del tractor
+        gc.collect()
+        self.assertFalse(os.path.exists(path3))
+
+        # the workers' copies keep the settings
+        tractor = _make_tractor()
+        tractor.batchModels = True
+        tractor.lineSearch = 'quadratic'
+        tractor.incrementalModels = True
+        tractor.matrixFree = True
+        t2 = pickle.loads(pickle.dumps(tractor, -1))
+        for k in ['batchModels', 'lineSearch', 'incrementalModels',
+                  'matrixFree']:
+            self.assertEqual(getattr(t2, k), getattr(tractor, k))
+        self.assertTrue(np.allclose(t2.getParams(), tractor.getParams()))
+        # (and the old pickled state still loads)
+        t3 = Tractor()
+        t3.__setstate__(tractor.__getstate__()[:-1])
+        self.assertFalse(t3.batchModels)
+        self.assertEqual(t3.numberOfParams(), tractor.numberOfParams())
+
+    def test_incremental_models(self):
+        tractor = _make_tractor()
+        tractor.incrementalModels = True
+        def check():
+            tractor.incrementalModels = False
+            lnl = tractor.getLogLikelihood()
+            mods = [tractor.getModelImage(i) for i in range(2)]
+            tractor.incrementalModels = True
+            self.assertTrue(np.allclose(tractor.getLogLikelihood(), lnl,
+                                        rtol=1e-6))
+            for i in range(2):
+                self.assertTrue(np.allclose(tractor.getModelImage(i), mods[i],
+                                            rtol=1e-5, atol=1e-5))
+        check()
+        # moving one source only updates its patch
+        src = tractor.catalog[0]
+        src.pos.x += 1.5
+        src.brightness.setParams([80.])
+        check()
+        self.assertEqual(tractor._resident[id(tractor.images[0])]['nupdates'],
+                         1)
+        # optimizing
+        for i in range(3):
+            tractor.optimize()
+        check()
+        # changing the catalog or an image rebuilds
+        tractor.catalog.append(PointSource(PixPos(20., 10.), Flux(30.)))
+        check()
+        tractor.images[1].sky.setParams([0.1])
+        check()
+
+    def test_profiling(self):
+        tractor = _make_tractor()
+        p0 = tractor.getParams()
+        tractor.optimize()
+        p1 = tractor.getParams()
+        tractor.setParams(p0)
+        tractor.cache.clear()
+        with tractor.profiling() as stats:
+            R = tractor.optimize()
+            tractor.getModelImages()
+        self.assertEqual(tractor.stats, None)
+        # same answer
+        self.assertTrue(np.allclose(tractor.getParams(), p1))
+        rep = stats.report()
+        for stage in ['render', 'cache', 'derivs', 'matrix', 'solve',
+                      'linesearch']:
+            self.assertTrue(stage in rep)
+            self.assertTrue(rep[stage]['calls'] > 0)
+        self.assertEqual(rep['linesearch']['calls'], 1)
+        self.assertTrue(rep['render']['pixels'] > 0)
+        self.assertTrue(rep['derivs']['pixels'] > 0)
+        # split by source and PSF
+        kinds = rep['render']['kinds']
+        self.assertTrue('PointSource/NCircularGaussianPSF' in kinds)
+        self.assertEqual(sum([k['calls'] for k in kinds.values()]),
+                         rep['render']['calls'])
+        # the cache served the getModelImages() call
+        self.assertTrue(rep['cache']['kinds']['hit']['calls'] >= 2 * 3)
+        # the optimizer's own report excludes the getModelImages() call
+        self.assertEqual(tractor.lastProfile['render']['calls'],
+                         rep['render']['calls'])
+        self.assertTrue(tractor.lastProfile['cache']['calls'] <
+                        rep['cache']['calls'])
+        # forced photometry puts it in the result
+        for src in tractor.catalog:
+            src.freezeAllBut('brightness')
+        with tractor.profiling():
+            r = tractor.optimize_forced_photometry(direct=True)
+        self.assertTrue('matrix' in r.profile)
+        self.assertTrue('solve' in r.profile)
+        self.assertTrue(r.profile['render']['pixels'] > 0)
+        # the matrix stage is closed on the early returns too
+        derivs = tractor.getDerivs()
+        with tractor.profiling() as stats:
+            tractor.getUpdateDirection(derivs, scales_only=True)
+            tractor.getUpdateDirection(derivs, get_A_matrix=True)
+        self.assertEqual(stats.report()['matrix']['calls'], 2)
+        # off
+        r = tractor.optimize_forced_photometry(direct=True)
+        self.assertFalse(hasattr(r, 'profile'))
+
+    def test_forced_photometry_direct(self):
+        def forced():
+            tractor = _make_tractor()
+            # a blend
+            tractor.catalog.append(PointSource(PixPos(14.5, 16.), Flux(10.)))
+            for src in tractor.catalog:
+                src.freezeAllBut('brightness')
+            return tractor
+        t1 = forced()
+        r1 = t1.optimize_forced_photometry(variance=True)
+        t2 = forced()
+        r2 = t2.optimize_forced_photometry(variance=True, direct=True)
+        self.assertTrue(np.allclose(t1.getParams(), t2.getParams(), rtol=1e-4))
+        # (source 2 is near the image edge)
+        self.assertTrue(np.allclose(r1.IV[[0,1,3]], r2.IV[[0,1,3]]))
+
+        # IVmatrix is the dense A^T A
+        N = r2.IVmatrix.toarray()
+        self.assertTrue(np.allclose(N, N.T))
+        derivs = t2.getDerivs()
+        A = []
+        for param in derivs:
+            col = []
+            for tim in t2.getImages():
+                mod = np.zeros(tim.shape)
+                for deriv,dtim in param:
+                    if dtim is tim:
+                        deriv.addTo(mod)
+                col.append((mod * tim.getInvError()).ravel())
+            A.append(np.hstack(col))
+        A = np.array(A).T
+        self.assertTrue(np.allclose(N, np.dot(A.T, A), rtol=1e-5))
+        self.assertTrue(np.allclose(r2.IV, np.diag(N)))
+        # the blended pair has a covariance term
+        self.assertTrue(N[0,3] != 0)
+        self.assertEqual(N[0,2], 0)
+
+    def test_bounded_normal_lsq(self):
+        import scipy.sparse
+        from scipy.optimize import nnls
+        from tractor.engine import bounded_normal_lsq
+        np.random.seed(17)
+        for i in range(10):
+            A = np.random.normal(size=(60, 20))
+            A[np.random.uniform(size=A.shape) < 0.7] = 0.
+            y = np.random.normal(size=60)
+            M = scipy.sparse.csc_matrix(np.dot(A.T, A) + 1e-6 * np.eye(20))
+            x,conv = bounded_normal_lsq(M, np.dot(A.T, y), np.zeros(20))
+            xn,nil = nnls(A, y)
+            self.assertTrue(conv)
+            self.assertTrue(np.all(x >= 0))
+            self.assertTrue(np.allclose(x, xn, atol=1e-4))
+        # unbounded variables
+        lower = np.zeros(20)
+        lower[:5] = -np.inf
+        x,conv = bounded_normal_lsq(M, np.dot(A.T, y), lower)
+        self.assertTrue(conv)
+        self.assertTrue(np.all(x[5:] >= 0))
+        self.assertTrue(np.any(x[:5] < 0))
+        # out of iterations
+        x,conv = bounded_normal_lsq(M, np.dot(A.T, y), np.zeros(20),
+                                    maxiter=1)
+        self.assertFalse(conv)
+        self.assertTrue(np.all(x >= 0))
+
+    def test_forced_photometry_nonneg(self):
+        tractor = _make_tractor()
+        # a source in a dip in the data
+        tractor.catalog.append(PointSource(PixPos(20.5, 5.5), Flux(10.)))
+        for tim in tractor.getImages():
+            tim.data[4:8, 19:23] -= 1.
+        for src in tractor.catalog:
+            src.freezeAllBut('brightness')
+        tractor.optimize_forced_photometry(direct=True)
+        unconstrained = tractor.getParams()
+        r = tractor.optimize_forced_photometry(nonneg=True)
+        self.assertTrue(r.converged)
+        fluxes = tractor.getParams()
+        self.assertTrue(np.all(np.array(fluxes) >= 0))
+        self.assertTrue(unconstrained[3] < 0)
+        self.assertEqual(fluxes[3], 0.)
+        self.assertTrue(np.allclose(fluxes[:3], unconstrained[:3], rtol=1e-2))
+
+    def test_forced_photometry_tiled(self):
+        def forced():
+            np.random.seed(3)
+            H,W = 70,90
+            psf = NCircularGaussianPSF([1.5], [1.])
+            tim = Image(data=np.zeros((H,W)), invvar=np.ones((H,W)) * 4.,
+                        psf=psf, wcs=NullWCS(), photocal=LinearPhotoCal(1.),
+                        sky=ConstantSky(0.))
+            srcs = [PointSource(PixPos(x, y), Flux(f)) for x,y,f in
+                    [(10.2, 12.3, 100.), (31.5, 29.0, 50.), (35.1, 31.2, 80.),
+                     (60.3, 15.8, 40.), (75.5, 55.5, 120.), (28.8, 52.3, 60.),
+                     (95., 30., 50.)]]
+            tractor = Tractor([tim], srcs)
+            tim.data = (tractor.getModelImage(0) +
+                        np.random.normal(size=(H,W)) * 0.5)
+            for src in srcs:
+                src.brightness.setParams([10.])
+                src.freezeAllBut('brightness')
+            tractor.freezeParam('images')
+            return tractor
+        t1 = forced()
+        r1 = t1.optimize_forced_photometry(variance=True, direct=True)
+        t2 = forced()
+        r2 = t2.optimize_forced_photometry_tiled(tilesize=32, margin=8,
+                                                 variance=True, direct=True)
+        self.assertEqual(r2.ntiles, 5)
+        self.assertTrue(r2.converged)
+        self.assertTrue(np.allclose(t1.getParams(), t2.getParams(), rtol=1e-2))
+        self.assertTrue(np.allclose(r1.IV, r2.IV, rtol=1e-3))
+        # the LSQR path
+        t3 = forced()
+        t3.optimize_forced_photometry_tiled(tilesize=32, margin=8)
+        self.assertTrue(np.allclose(t1.getParams(), t3.getParams(), rtol=1e-2))
+
+    def test_forced_photometry_tiled_shifted(self):
+        # The tiles see the PSF and sky at their full-image positions.
+        for skyclass in [_GradientSky, _OldGradientSky]:
+            def forced():
+                tractor = _make_shifting_tractor(skyclass)
+                for src in tractor.catalog:
+                    src.brightness.setParams([10.])
+                    src.freezeAllBut('brightness')
+                return tractor
+            t1 = forced()
+            t1.optimize_forced_photometry(direct=True)
+            t2 = forced()
+            r2 = t2.optimize_forced_photometry_tiled(tilesize=32, margin=12,
+                                                     direct=True)
+            self.assertEqual(r2.ntiles, 3)
+            self.assertTrue(np.allclose(t1.getParams(), 100., rtol=1e-6))
+            self.assertTrue(np.allclose(t2.getParams(), 100., rtol=1e-6))
+
+    def test_forced_photometry_tiled_pixelized(self):
+        # Galaxies on a pixelized PSF; the point sources are still
+        # rendered in batches.
+        calls = []
+        class CountingPSF(PixelizedPSF):
+            def addPointSourcesTo(self, *args, **kwargs):
+                calls.append(1)
+                return super(CountingPSF, self).addPointSourcesTo(
+                    *args, **kwargs)
+        def forced():
+            tractor = _make_pixelized_tractor(CountingPSF)
+            tractor.batchModels = True
+            for src in tractor.catalog:
+                src.brightness.setParams([10.])
+                src.freezeAllBut('brightness')
+            return tractor
+        t1 = forced()
+        t1.optimize_forced_photometry(direct=True)
+        t2 = forced()
+        del calls[:]
+        r2 = t2.optimize_forced_photometry_tiled(tilesize=32, margin=12,
+                                                 direct=True)
+        self.assertEqual(r2.ntiles, 3)
+        self.assertTrue(len(calls) > 0)
+        self.assertTrue(np.allclose(t1.getParams(), [100., 200., 150.],
+                                    rtol=1e-3))
+        self.assertTrue(np.allclose(t2.getParams(), t1.getParams(),
+                                    rtol=1e-3))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -36,3 +36,84 @@ print p1
 print gal2
 print p2
 
+
+# Analytic position and shape derivatives match central differences.
+disable_galaxy_cache()
+H,W = 50,60
+psf = GaussianMixturePSF(np.array([0.8, 0.2]), np.zeros((2,2)),
+                         np.array([[[2., 0.3], [0.3, 2.5]],
+                                   [[8., 0.], [0., 8.]]]))
+tim = Image(data=np.zeros((H,W)), invvar=np.ones((H,W)), psf=psf,
+            wcs=NullWCS(pixscale=0.5), photocal=LinearPhotoCal(1.),
+            sky=ConstantSky(0.))
+gals = [ExpGalaxy(PixPos(30.2, 20.1), Flux(200.), GalaxyShape(3., 0.6, 30.)),
+        DevGalaxy(PixPos(30.7, 25.4), Flux(200.), EllipseESoft(0.5, 0.2, -0.1)),
+        FixedCompositeGalaxy(PixPos(28.3, 24.6), Flux(300.), 0.3,
+                             EllipseE(2., 0.1, 0.2), EllipseE(1.5, -0.2, 0.1))]
+set_analytic_derivatives(True)
+for gal in gals:
+    derivs = gal.getParamDerivatives(tim)
+    p0 = gal.getParams()
+    step = 1e-3
+    for i,(deriv,nm) in enumerate(zip(derivs, gal.getParamNames())):
+        gal.setParam(i, p0[i] + step)
+        mod1 = np.zeros((H,W))
+        gal.getModelPatch(tim).addTo(mod1)
+        gal.setParam(i, p0[i] - step)
+        mod0 = np.zeros((H,W))
+        gal.getModelPatch(tim).addTo(mod0)
+        gal.setParams(p0)
+        fd = (mod1 - mod0) / (2. * step)
+        d = np.zeros((H,W))
+        deriv.addTo(d)
+        print gal.getName(), nm, 'max', np.abs(fd).max(), 'diff', np.abs(d - fd).max()
+        assert(np.abs(d - fd).max() < 1e-3 * np.abs(fd).max())
+set_analytic_derivatives(False)
+enable_galaxy_cache()
+
+
+# The shift cache gives the same models, and is hit by small position
+# changes.
+disable_galaxy_cache()
+pixpsf = PixelizedPSF(psf.getPointSourcePatch(0., 0., radius=12).patch)
+for p in [psf, pixpsf]:
+    tim.psf = p
+    gal = ExpGalaxy(PixPos(30.2, 20.1), Flux(200.), GalaxyShape(3., 0.6, 30.))
+    mods = []
+    for on in [False, True]:
+        set_galaxy_shift_cache(None if not on else 8)
+        mod = []
+        for dx in [0., 1e-3, 0.01, 1.03]:
+            gal.pos.x = 30.2 + dx
+            m = np.zeros((H,W))
+            gal.getModelPatch(tim).addTo(m)
+            mod.append(m)
+        mods.append(mod)
+    st = get_galaxy_shift_cache().stats()
+    print p, 'shift cache', st
+    # (the FFT path also absorbs whole-pixel shifts)
+    assert(st['hits'] >= 2)
+    assert(st['entries'] <= 2)
+    for m0,m1 in zip(*mods):
+        print 'diff', np.abs(m0 - m1).max()
+        assert(np.abs(m0 - m1).max() < 1e-6 * m0.max())
+# Changing a mixture we got doesn't change the cached one.
+tim.psf = psf
+cmix = gal._getConvolvedMixture(tim, 30.2, 20.1)
+cmix.amp[:] = 0.
+cmix.mean[:] = 0.
+cmix.var[:] = 0.
+cmix = gal._getConvolvedMixture(tim, 30.2, 20.1)
+assert(np.all(cmix.amp != 0) and np.all(cmix.var != 0))
+set_galaxy_shift_cache(None)
+enable_galaxy_cache()
+
+# Position derivatives of a galaxy whose PixelizedPSF rendering is
+# clipped by the image edge.
+tim.psf = pixpsf
+for x in [W - 4.3, W - 4.7, 3.4]:
+    gal = ExpGalaxy(PixPos(x, 20.1), Flux(200.), GalaxyShape(3., 0.6, 30.))
+    derivs = gal.getParamDerivatives(tim)
+    assert(len(derivs) == gal.numberOfParams())
+    for d in derivs[:2]:
+        assert(d is not None and np.all(np.isfinite(d.patch)))
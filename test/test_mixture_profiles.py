@@ -0,0 +1,53 @@
+import unittest
+
+import numpy as np
+
+from tractor import mixture_profiles as mp
+
+class MixtureTest(unittest.TestCase):
+
+    def test_apply_affine(self):
+        mix = mp.get_dev_mixture()
+        shift = np.array([3., -4.])
+        scale = np.array([[1., 0.3], [0.1, 2.]])
+        amix = mix.apply_affine(shift, scale)
+        self.assertEqual(amix.K, mix.K)
+        self.assertTrue(np.all(amix.mean == mix.mean + shift))
+        for k in range(mix.K):
+            v = np.dot(scale.T, np.dot(mix.var[k], scale))
+            self.assertTrue(np.allclose(amix.var[k], v, rtol=1e-14))
+            self.assertTrue(np.all(amix.var[k] == amix.var[k].T))
+        # result does not share memory with the input
+        amix.amp *= 2.
+        self.assertTrue(np.all(amix.amp == 2. * mix.amp))
+
+    def test_convolve(self):
+        a = mp.MixtureOfGaussians(np.array([0.2, 0.8]),
+                                  np.array([[0., 1.], [2., 0.]]),
+                                  np.array([1., 3.]))
+        b = mp.MixtureOfGaussians(np.array([0.5, 0.3, 0.2]),
+                                  np.array([[0., 0.], [1., 1.], [0., -1.]]),
+                                  np.array([[[1., 0.1], [0.1, 2.]],
+                                            [[2., 0.], [0., 2.]],
+                                            [[4., -0.5], [-0.5, 1.]]]))
+        c = a.convolve(b)
+        self.assertEqual(c.K, a.K * b.K)
+        i = 0
+        for k in range(b.K):
+            for j in range(a.K):
+                self.assertEqual(c.amp[i], a.amp[j] * b.amp[k])
+                self.assertTrue(np.all(c.mean[i] == a.mean[j] + b.mean[k]))
+                self.assertTrue(np.all(c.var[i] == a.var[j] + b.var[k]))
+                i += 1
+
+    def test_constructor(self):
+        mix = mp.MixtureOfGaussians([1.], [[0., 0.]],
+                                    np.array([[[2., 1.], [0., 3.]]]))
+        self.assertTrue(np.all(mix.var[0] == [[2., 0.5], [0.5, 3.]]))
+        mix = mp.MixtureOfGaussians(np.ones(3), np.zeros((3,2)),
+                                    np.array([1., 2., 3.]))
+        self.assertTrue(np.all(mix.var[:,0,1] == 0))
+        self.assertTrue(np.all(mix.var[:,1,1] == [1., 2., 3.]))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+import unittest
+import multiprocessing
+
+import numpy as np
+
+from tractor.mpcache import SharedPatchCache
+from tractor.patch import Patch
+
+def _render(args):
+    (cache, i) = args
+    try:
+        (p, mv) = cache.get(i)
+        return 'hit'
+    except KeyError:
+        pass
+    cache.put(i, (Patch(i, 2*i, np.zeros((5,5)) + i), 0.))
+    return 'miss'
+
+class SharedPatchCacheTest(unittest.TestCase):
+
+    def test_get_put(self):
+        c = SharedPatchCache(nbytes=4096, nslots=64)
+        pat = Patch(3, 4, np.arange(12, dtype=np.float32).reshape((3,4)))
+        c.put('a', (pat, 0.5))
+        c.put('b', (1e-3, None))
+        c.put('c', (2., Patch(0, 0, None)))
+        (p, mv) = c.get('a')
+        self.assertEqual(mv, 0.5)
+        self.assertEqual((p.x0, p.y0), (3, 4))
+        self.assertEqual(p.patch.dtype, np.float32)
+        self.assertTrue(np.all(p.patch == pat.patch))
+        # the pixels are copied out
+        p.patch[:,:] = 0.
+        self.assertTrue(np.all(c.get('a')[0].patch == pat.patch))
+        self.assertEqual(c.get('b'), (1e-3, None))
+        (mv, p) = c.get('c')
+        self.assertEqual(mv, 2.)
+        self.assertEqual(p, None)
+        self.assertEqual(c.get('d', 42), 42)
+        self.assertRaises(KeyError, c.get, 'd')
+        self.assertEqual(len(c), 3)
+        st = c.stats()
+        self.assertEqual(st['puts'], 3)
+        self.assertEqual(st['misses'], 2)
+        c.clear()
+        self.assertEqual(len(c), 0)
+
+    def test_overwrite(self):
+        # 800-byte patches: only 5 fit in the ring buffer
+        c = SharedPatchCache(nbytes=4096, nslots=64)
+        for i in range(8):
+            c.put(i, (Patch(0, 0, np.zeros((10,10)) + i), 0.))
+        self.assertEqual(len(c), 5)
+        self.assertEqual(c.get(0, None), None)
+        for i in range(3, 8):
+            self.assertTrue(np.all(c.get(i)[0].patch == i))
+        # too big
+        c.put(99, (Patch(0, 0, np.zeros((100,100))), 0.))
+        self.assertEqual(c.get(99, None), None)
+
+    def test_processes(self):
+        c = SharedPatchCache(nbytes=1<<16, nslots=256)
+        pool = multiprocessing.Pool(2)
+        try:
+            r1 = pool.map(_render, [(c, i) for i in range(10)])
+            r2 = pool.map(_render, [(c, i) for i in range(10)])
+        finally:
+            pool.close()
+            pool.join()
+        self.assertEqual(r1, ['miss'] * 10)
+        self.assertEqual(r2, ['hit'] * 10)
+        self.assertEqual(len(c), 10)
+        (p, mv) = c.get(7)
+        self.assertEqual((p.x0, p.y0), (7, 14))
+        self.assertTrue(np.all(p.patch == 7))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -28,3 +28,62 @@ print 't3:', t3
 print 't3 params:', t3.getParams()
 assert(len(t3.getParams()) == 2)
 
+
+# MultiParams hashkeys are cached, and change when (and only when) the
+# parameters of any of the sub-Params change.
+import pickle
+t4 = TestParamList(1., 2., 3.)
+s1 = ScalarParam(5.)
+m1 = MultiParams(t4, s1)
+m2 = MultiParams(m1, t1)
+k1 = m2.hashkey()
+assert(m2.hashkey() == k1)
+v1 = m2.getVersion()
+t4.b = 7.
+k2 = m2.hashkey()
+assert(k2 != k1)
+assert(m2.getVersion() != v1)
+old = s1.setParam(0, 6.)
+k3 = m2.hashkey()
+assert(k3 != k2)
+# back to the same parameter values -> the same hashkey
+s1.setParam(0, old)
+assert(m2.hashkey() == k2)
+m2.setParams(m2.getParams())
+assert(m2.hashkey() == k2)
+# pickling keeps the parameters, and the copy tracks its own changes
+m3 = pickle.loads(pickle.dumps(m2))
+assert(m3.hashkey() == k2)
+m3.subs[0].subs[1].setValue(10.)
+assert(m3.hashkey() != k2)
+assert(m2.hashkey() == k2)
+
+# Direct writes to a ScalarParam's value are noticed, too.
+s1.val += 1.
+assert(m2.hashkey() != k2)
+s1.val -= 1.
+assert(m2.hashkey() == k2)
+
+# A setter that does not report its changes makes the container
+# recompute its hashkey on every call.
+class Untracked(ScalarParam):
+	def setParam(self, i, p):
+		self.__dict__['val'] = p
+u = Untracked(1.)
+m4 = MultiParams(u, t4)
+k4 = m4.hashkey()
+u.setParam(0, 2.)
+assert(m4.hashkey() != k4)
+
+# Parameter values that Python hashes alike (hash(-1.) == hash(-2.))
+# still give different hashkeys.
+a = MultiParams(ScalarParam(-1.))
+b = MultiParams(ScalarParam(-2.))
+assert(a.hashkey() != b.hashkey())
+
+# Parents that are deleted are forgotten.
+import gc
+for i in range(10):
+	MultiParams(s1).hashkey()
+gc.collect()
+assert(len(s1._hkparents) == 1)
@@ -9,7 +9,8 @@ from imageutils import *
 
 __all__ = [
     # modules
-    'sdss', 'fitpsf', 'emfit', 'galaxy', 'sersic',
+    'sdss', 'fitpsf', 'emfit', 'galaxy', 'sersic', 'blobs',
+    'instrument',
     # ducks
     'Params', 'Sky', 'Source', 'Position', 'Brightness', 'PhotoCal',
     'PSF', 
@@ -11,8 +11,10 @@ Magnitudes, (RA,Dec) positions, FITS WCS, and so on.
 
 """
 from math import ceil, floor, pi, sqrt, exp
+import hashlib
 
 from .engine import *
+from .engine import _takesOffsets
 from .utils import *
 #from . import ducks
 import ducks
@@ -808,7 +810,7 @@ class ConstantSky(ScalarParam, ducks.ImageCalibration):
         p = Patch(0, 0, np.ones_like(img.getImage()))
         p.setName('dsky')
         return [p]
-    def addTo(self, img, scale=1.):
+    def addTo(self, img, scale=1., x0=0, y0=0):
         if self.val == 0:
             return
         img += (self.val * scale)
@@ -819,6 +821,7 @@ class ConstantSky(ScalarParam, ducks.ImageCalibration):
         return self.val
 
     def subtract(self, con):
+        # (ScalarParam.__setattr__ calls _paramsChanged())
         self.val -= con
 
     def toStandardFitsHeader(self, hdr):
@@ -943,6 +946,58 @@ class PointSource(MultiParams, SingleProfileSource):
                                         minradius=self.minRadius, modelMask=modelMask)
         return patch
 
+    def getModelMixture(self, img, minsb=None):
+        '''
+        Returns (mixture, extent) for batch rendering; see
+        ducks.Source.getModelMixture().
+        '''
+        psf = self._getPsf(img)
+        if not hasattr(psf, 'getPointSourceMixture'):
+            return None
+        if minsb is None:
+            minsb = img.modelMinval
+        if minsb != 0. or self.minRadius is not None:
+            return None
+        counts = img.getPhotoCal().brightnessToCounts(self.brightness)
+        if counts == 0 or not np.isfinite(np.float32(counts)):
+            return None,None
+        (px,py) = img.getWcs().positionToPixel(self.getPosition(), self)
+        H,W = img.shape
+        r = self.fixedRadius
+        if r is None:
+            r = psf.getRadius()
+        if px + r < 0 or px - r > W or py + r < 0 or py - r > H:
+            return None,None
+        mm = psf.getPointSourceMixture(px, py, extent=[0,W,0,H],
+                                       radius=self.fixedRadius)
+        if mm is None:
+            return None
+        mix,extent = mm
+        mix.amp = mix.amp * counts
+        return mix,extent
+
+    def getPixelizedModel(self, img, minsb=None):
+        '''
+        Returns (psf, px, py, counts) for batch rendering with a
+        pixelized PSF (see PixelizedPSF.addPointSourcesTo()), or None
+        if that is not possible.  *counts* is zero if there is nothing
+        to render.
+        '''
+        psf = self._getPsf(img)
+        if not hasattr(psf, 'addPointSourcesTo'):
+            return None
+        counts = img.getPhotoCal().brightnessToCounts(self.brightness)
+        if counts == 0 or not np.isfinite(np.float32(counts)):
+            return psf,0.,0.,0.
+        (px,py) = img.getWcs().positionToPixel(self.getPosition(), self)
+        H,W = img.shape
+        r = self.fixedRadius
+        if r is None:
+            r = psf.getRadius()
+        if px + r < 0 or px - r > W or py + r < 0 or py - r > H:
+            return psf,0.,0.,0.
+        return psf,px,py,counts
+
     def _getPsf(self, img):
         return img.getPsf()
 
@@ -1052,6 +1107,27 @@ class PointSource(MultiParams, SingleProfileSource):
                 derivs.append(df)
         return derivs
 
+# FFTs of PixelizedPSF images, keyed by pixel digest and size, so
+# they are shared between PSF objects with identical pixels.
+_psf_fft_cache = Cache(maxsize=100)
+
+_lanczos_kernels = {}
+def _getLanczosKernels(L, nsub):
+    '''
+    Returns the flux-normalized Lanczos kernels of order *L* for
+    sub-pixel shifts -0.5, -0.5 + 1/*nsub*, ..., 0.5, as an array of
+    shape (nsub+1, 2L+1).  The tables are computed once and kept.
+    '''
+    key = (L, nsub)
+    if key in _lanczos_kernels:
+        return _lanczos_kernels[key]
+    d = np.linspace(-0.5, 0.5, nsub+1)
+    x = np.arange(-L, L+1)[np.newaxis,:] + d[:,np.newaxis]
+    K = lanczos_filter(L, x.ravel()).reshape(x.shape)
+    K /= K.sum(axis=1)[:,np.newaxis]
+    _lanczos_kernels[key] = K
+    return K
+
 class PixelizedPSF(BaseParams, ducks.ImageCalibration):
     '''
     A PSF model based on an image postage stamp, which will be
@@ -1060,9 +1136,12 @@ class PixelizedPSF(BaseParams, ducks.ImageCalibration):
     Galaxies will be rendering using FFT convolution.
     
     FIXME -- currently this class claims to have no params.
+
+    The hashkey is a digest of the pixels, computed when *img* is
+    set; if you modify the pixels in place, call pixelsChanged().
     '''
 
-    def __init__(self, img, Lorder=3):
+    def __init__(self, img, Lorder=3, Lsub=None):
         '''
         Creates a new PixelizedPSF object from the given *img* (numpy
         array) image of the PSF. 
@@ -1070,22 +1149,56 @@ class PixelizedPSF(BaseParams, ducks.ImageCalibration):
         - *img* must be an ODD size.
         - *Lorder* is the order of the Lanczos interpolant used for
            shifting the image to subpixel positions.
+        - *Lsub*, if not None, snaps the subpixel shifts to a grid of
+           1/*Lsub* pixel, so the Lanczos kernels come from a
+           precomputed table rather than being computed for each
+           source.
         '''
-        self.img = img
         H,W = img.shape
         assert((H % 2) == 1)
         assert((W % 2) == 1)
         self.Lorder = Lorder
-        self.fftcache = {}
-        
+        self.Lsub = Lsub
+        self.img = img
+
     def __str__(self):
         return 'PixelizedPSF'
 
+    def _getImg(self):
+        return self._img
+    def _setImg(self, img):
+        self._img = img
+        self.pixelsChanged()
+    img = property(_getImg, _setImg, None, 'The PSF postage stamp')
+
+    def pixelsChanged(self):
+        '''
+        Recomputes the digest of the PSF pixels; call this after
+        modifying *img* in place.
+        '''
+        img = np.ascontiguousarray(self._img)
+        self.digest = (img.shape, img.dtype.str,
+                       hashlib.sha1(img.data).hexdigest())
+        self._paramsChanged()
+
+    def __setstate__(self, state):
+        # pickles from before the digest existed
+        if 'img' in state:
+            state['_img'] = state.pop('img')
+        state.pop('fftcache', None)
+        state.setdefault('Lsub', None)
+        self.__dict__.update(state)
+        if not 'digest' in state:
+            self.pixelsChanged()
+
     def hashkey(self):
-        return ('PixelizedPSF', tuple(self.img.ravel()))
+        return ('PixelizedPSF', self.digest, self.Lorder, self.Lsub)
+
+    def _hashkeyTracked(self):
+        return True
 
     def copy(self):
-        return PixelizedPSF(self.img.copy())
+        return PixelizedPSF(self.img.copy(), Lorder=self.Lorder, Lsub=self.Lsub)
 
     def getRadius(self):
         H,W = self.img.shape
@@ -1120,12 +1233,7 @@ class PixelizedPSF(BaseParams, ducks.ImageCalibration):
             # Otherwise, we'll just produce the Lanczos-shifted PSF image as usual,
             # and then copy it into the modelMask space.
 
-        L = self.Lorder
-        Lx = lanczos_filter(L, np.arange(-L, L+1) + dx)
-        Ly = lanczos_filter(L, np.arange(-L, L+1) + dy)
-        # Normalize the Lanczos interpolants (preserve flux)
-        Lx /= Lx.sum()
-        Ly /= Ly.sum()
+        (Lx,Ly) = self._getShiftKernels(np.array([dx, dy]))
         sx      = correlate1d(self.img, Lx, axis=1, mode='constant')
         shifted = correlate1d(sx,       Ly, axis=0, mode='constant')
         if modelMask is None:
@@ -1153,6 +1261,68 @@ class PixelizedPSF(BaseParams, ducks.ImageCalibration):
         mm[yo:yo+ny, xo:xo+nx] = shifted[yi:yi+ny, xi:xi+nx]
         return Patch(mx0, my0, mm)
 
+    def _getShiftKernels(self, d):
+        '''
+        Returns the (normalized) Lanczos kernels for shifting the PSF
+        image by the subpixel offsets *d* (numpy array, values in
+        [-0.5, 0.5]), as an array of shape (len(d), 2*Lorder+1).
+        '''
+        L = self.Lorder
+        if self.Lsub is not None:
+            K = _getLanczosKernels(L, self.Lsub)
+            i = np.round((d + 0.5) * self.Lsub).astype(int)
+            return K[np.clip(i, 0, self.Lsub)]
+        x = np.arange(-L, L+1)[np.newaxis,:] + d[:,np.newaxis]
+        K = lanczos_filter(L, x.ravel()).reshape(x.shape)
+        # Normalize the Lanczos interpolants (preserve flux)
+        K /= K.sum(axis=1)[:,np.newaxis]
+        return K
+
+    def addPointSourcesTo(self, mod, pxs, pys, fluxes, x0=0, y0=0,
+                          chunk=256):
+        '''
+        Renders point sources at pixel positions *pxs*, *pys* with
+        the given *fluxes* (arrays), adding them directly into the
+        image *mod*, whose [0,0] pixel is at *x0*,*y0*.
+
+        Equivalent to adding getPointSourcePatch() * flux for each
+        source, but the sources are shifted *chunk* at a time, with
+        array operations in place of per-source filtering.
+        '''
+        pxs = np.atleast_1d(pxs).astype(float)
+        pys = np.atleast_1d(pys).astype(float)
+        fluxes = np.atleast_1d(fluxes)
+        H,W = self.img.shape
+        L = self.Lorder
+        mh,mw = mod.shape
+        ix = np.round(pxs).astype(int)
+        iy = np.round(pys).astype(int)
+        Kx = self._getShiftKernels(pxs - ix)
+        Ky = self._getShiftKernels(pys - iy)
+        # the PSF image shifted by each kernel offset, in x
+        pad = np.zeros((H, W + 2*L))
+        pad[:, L:L+W] = self.img
+        Sx = np.array([pad[:, k:k+W] for k in range(2*L+1)])
+        sx = np.zeros((min(chunk, len(pxs)), H + 2*L, W))
+        for c0 in range(0, len(pxs), chunk):
+            c1 = min(c0 + chunk, len(pxs))
+            n = c1 - c0
+            sx[:n, L:L+H, :] = np.tensordot(Kx[c0:c1], Sx, axes=(1,0))
+            shifted = np.zeros((n, H, W))
+            for k in range(2*L+1):
+                shifted += Ky[c0:c1, k, np.newaxis, np.newaxis] * sx[:n, k:k+H, :]
+            for j in range(n):
+                i = c0 + j
+                # stamp corner in *mod* coordinates
+                sx0 = ix[i] - W/2 - x0
+                sy0 = iy[i] - H/2 - y0
+                xa,xb = max(sx0, 0), min(sx0 + W, mw)
+                ya,yb = max(sy0, 0), min(sy0 + H, mh)
+                if xa >= xb or ya >= yb:
+                    continue
+                mod[ya:yb, xa:xb] += fluxes[i] * shifted[j, ya-sy0:yb-sy0,
+                                                         xa-sx0:xb-sx0]
+
     def getFourierTransformSize(self, radius):
         # Next power-of-two size
         sz = 2**int(np.ceil(np.log2(radius*2.)))
@@ -1206,14 +1376,16 @@ class PixelizedPSF(BaseParams, ducks.ImageCalibration):
         '''
         sz = self.getFourierTransformSize(radius)
         # print 'PixelizedPSF FFT size', sz
-        if sz in self.fftcache:
-            return self.fftcache[sz]
+        key = (self.digest, sz)
+        rtn = _psf_fft_cache.get(key, None)
+        if rtn is not None:
+            return rtn
 
         pad,cx,cy = self._padInImage(sz,sz)
         ## cx,cy: coordinate of the PSF center in *pad*
         P = np.fft.rfft2(pad)
         rtn = P, (cx, cy), pad.shape
-        self.fftcache[sz] = rtn
+        _psf_fft_cache.put(key, rtn)
         return rtn
 
     def constantPsfAt(self, x, y):
@@ -1316,6 +1488,7 @@ class GaussianMixturePSF(ParamList, ducks.ImageCalibration):
     def shiftBy(self, dx, dy):
         self.mog.mean[:,0] += dx
         self.mog.mean[:,1] += dy
+        self._paramsChanged()
     
     def computeRadius(self):
         import numpy.linalg
@@ -1331,6 +1504,31 @@ class GaussianMixturePSF(ParamList, ducks.ImageCalibration):
     def getRadius(self):
         return self.radius
 
+    def getPointSourceMixture(self, px, py, extent=None, radius=None):
+        '''
+        Returns (mixture, [x0,x1,y0,y1]): this PSF's mixture of
+        Gaussians centered at pixel position *px*,*py*, and the pixel
+        range that getPointSourcePatch() evaluates it over when
+        minval=0.
+        '''
+        if radius is None:
+            r = self.getRadius()
+        else:
+            r = radius
+        x0,x1 = int(floor(px-r)), int(ceil(px+r)) + 1
+        y0,y1 = int(floor(py-r)), int(ceil(py+r)) + 1
+        if extent is not None:
+            [xl,xh,yl,yh] = extent
+            # clip
+            x0 = max(x0, xl)
+            x1 = min(x1, xh)
+            y0 = max(y0, yl)
+            y1 = min(y1, yh)
+        mix = mp.MixtureOfGaussians(self.mog.amp,
+                                    self.mog.mean + np.array([px,py]),
+                                    self.mog.var, quick=True)
+        return mix, [x0,x1,y0,y1]
+
     # returns a Patch object.
     def getPointSourcePatch(self, px, py, minval=0., extent=None, radius=None,
                             derivs=False, minradius=None, modelMask=None,
@@ -1714,10 +1912,6 @@ class NCircularGaussianPSF(MultiParams, ducks.ImageCalibration):
             vars[k,0,0] = vars[k,1,1] = self.mysigmas[k]**2
         return mp.MixtureOfGaussians(amps, means, vars)
         
-    def hashkey(self):
-        hk = ('NCircularGaussianPSF', tuple(self.sigmas), tuple(self.weights))
-        return hk
-    
     def copy(self):
         return NCircularGaussianPSF(list([s for s in self.sigmas]),
                                     list([w for w in self.weights]))
@@ -1741,6 +1935,24 @@ class NCircularGaussianPSF(MultiParams, ducks.ImageCalibration):
             return self.radius
         return max(self.minradius, max(self.mysigmas) * self.getNSigma())
 
+    def getPointSourceMixture(self, px, py, extent=None, radius=None):
+        '''
+        Returns (mixture, [x0,x1,y0,y1]): this PSF's mixture of
+        Gaussians centered at pixel position *px*,*py*, and the pixel
+        range that getPointSourcePatch() evaluates it over when
+        minval=0.
+        '''
+        ix = int(round(px))
+        iy = int(round(py))
+        if radius is None:
+            rad = int(ceil(self.getRadius()))
+        else:
+            rad = radius
+        mix = self.getMixtureOfGaussians()
+        mix.mean[:,0] += px
+        mix.mean[:,1] += py
+        return mix, [ix - rad, ix + rad + 1, iy - rad, iy + rad + 1]
+
     # returns a Patch object.
     def getPointSourcePatch(self, px, py, minval=0., radius=None,
                             modelMask=None, **kwargs):
@@ -1852,12 +2064,50 @@ class ShiftedPsf(ParamsWrapper, ducks.ImageCalibration):
     def getRadius(self):
         return self.psf.getRadius()
 
-    def getMixtureOfGaussians(self, px=None, py=None, **kwargs):
+    # Optional PSF methods, which callers test for with hasattr(): we
+    # have them only if the wrapped PSF does.  The first are shifted,
+    # the others do not depend on position.
+    _shiftedMethods = ['getPointSourceMixture', 'getMixtureOfGaussians',
+                       'addPointSourcesTo']
+    _constantAttrs = ['getFourierTransform', 'getFourierTransformSize',
+                      'img']
+
+    def __getattr__(self, name):
+        # (only called when normal lookup fails; "psf" is not set yet
+        # while unpickling)
+        psf = self.__dict__.get('psf')
+        if psf is not None and hasattr(psf, name):
+            if name in self._shiftedMethods:
+                return getattr(self, '_' + name)
+            if name in self._constantAttrs:
+                return getattr(psf, name)
+        raise AttributeError(name)
+
+    def _getPointSourceMixture(self, px, py, extent=None, **kwargs):
+        if extent is not None:
+            (ex0,ex1,ey0,ey1) = extent
+            extent = (ex0+self.x0, ex1+self.x0, ey0+self.y0, ey1+self.y0)
+        mix,(x0,x1,y0,y1) = self.psf.getPointSourceMixture(
+            self.x0 + px, self.y0 + py, extent=extent, **kwargs)
+        # shift back
+        mix = mp.MixtureOfGaussians(mix.amp, mix.mean -
+                                    np.array([self.x0, self.y0]), mix.var,
+                                    quick=True)
+        return mix, [x0 - self.x0, x1 - self.x0, y0 - self.y0, y1 - self.y0]
+
+    def _getMixtureOfGaussians(self, px=None, py=None, **kwargs):
         if px is not None:
             px = px + self.x0
         if py is not None:
             py = py + self.y0
         return self.psf.getMixtureOfGaussians(px=px, py=py, **kwargs)
+
+    def _addPointSourcesTo(self, mod, pxs, pys, fluxes, x0=0, y0=0,
+                           **kwargs):
+        self.psf.addPointSourcesTo(mod, np.asarray(pxs) + self.x0,
+                                   np.asarray(pys) + self.y0, fluxes,
+                                   x0=x0 + self.x0, y0=y0 + self.y0,
+                                   **kwargs)
     
 class ScaledPhotoCal(ParamsWrapper, ducks.ImageCalibration):
     def __init__(self, photocal, factor):
@@ -1925,4 +2175,43 @@ class ShiftedWcs(ParamsWrapper, ducks.ImageCalibration):
         pos = self.wcs.pixelToPosition(x+self.x0, y+self.y0, src=src)
         return pos
 
-    
+class ShiftedSky(ParamsWrapper, ducks.ImageCalibration):
+    '''
+    Wraps a Sky in order to use it for a subimage whose pixel 0,0 is
+    pixel *x0*,*y0* of the full image, of shape *shape* (H,W).
+    '''
+    def __init__(self, sky, x0, y0, shape):
+        super(ShiftedSky,self).__init__(sky)
+        self.sky = sky
+        self.x0 = x0
+        self.y0 = y0
+        self.shape = shape
+
+    def __str__(self):
+        return ('ShiftedSky: %i,%i + ' % (self.x0,self.y0)) + str(self.sky)
+
+    def hashkey(self):
+        return ('ShiftedSky', self.x0, self.y0) + tuple(self.sky.hashkey())
+
+    def addTo(self, mod, scale=1., x0=0, y0=0):
+        x0 += self.x0
+        y0 += self.y0
+        if _takesOffsets(self.sky.addTo):
+            self.sky.addTo(mod, scale=scale, x0=x0, y0=y0)
+            return
+        # Render the full image and cut out our part.
+        (h,w) = mod.shape
+        full = np.zeros(self.shape, mod.dtype)
+        self.sky.addTo(full)
+        if scale != 1.:
+            full *= scale
+        mod += full[y0:y0+h, x0:x0+w]
+
+    def getParamDerivatives(self, tractor, img, srcs):
+        return self.sky.getParamDerivatives(tractor, img, srcs)
+
+    def getConstant(self):
+        return self.sky.getConstant()
+
+    def subtract(self, con):
+        self.sky.subtract(con)
@@ -0,0 +1,173 @@
+'''
+This file is part of the Tractor project.
+Copyright 2011, 2012 Dustin Lang and David W. Hogg.
+Licensed under the GPLv2; see the file COPYING for details.
+
+`blobs.py`
+===========
+
+Grouping sources into "blobs" of overlapping sources, from the
+extents of their model patches, without full-image arrays.
+'''
+import numpy as np
+
+class UnionFind(object):
+    '''
+    Disjoint sets of the integers 0..N-1.
+    '''
+    def __init__(self, N):
+        self.parent = range(N)
+        self.size = [1] * N
+
+    def find(self, i):
+        parent = self.parent
+        while parent[i] != i:
+            # path halving
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    def union(self, i, j):
+        i = self.find(i)
+        j = self.find(j)
+        if i == j:
+            return
+        if self.size[i] < self.size[j]:
+            i,j = j,i
+        self.parent[j] = i
+        self.size[i] += self.size[j]
+
+    def groups(self):
+        '''
+        Returns the sets, as lists of sorted integers, ordered by their
+        smallest element.
+        '''
+        groups = {}
+        order = []
+        for i in range(len(self.parent)):
+            r = self.find(i)
+            if not r in groups:
+                groups[r] = []
+                order.append(r)
+            groups[r].append(i)
+        return [groups[r] for r in order]
+
+class BoxIndex(object):
+    '''
+    A spatial index of axis-aligned boxes, [x0,x1) x [y0,y1), in
+    buckets of a regular grid of *cellsize* pixels.
+    '''
+    def __init__(self, cellsize=64):
+        self.cellsize = cellsize
+        self.cells = {}
+        self.boxes = {}
+
+    def _cells(self, box):
+        (x0,x1,y0,y1) = box
+        c = self.cellsize
+        for cy in range(y0 // c, (y1 - 1) // c + 1):
+            for cx in range(x0 // c, (x1 - 1) // c + 1):
+                yield (cx,cy)
+
+    def add(self, key, box):
+        self.boxes[key] = box
+        for cell in self._cells(box):
+            self.cells.setdefault(cell, []).append(key)
+
+    def query(self, box):
+        '''
+        Returns the set of keys whose boxes intersect *box*.
+        '''
+        (x0,x1,y0,y1) = box
+        found = set()
+        for cell in self._cells(box):
+            for key in self.cells.get(cell, []):
+                if key in found:
+                    continue
+                (bx0,bx1,by0,by1) = self.boxes[key]
+                if bx0 < x1 and bx1 > x0 and by0 < y1 and by1 > y0:
+                    found.add(key)
+        return found
+
+def _maskExtent(mask):
+    '''
+    Returns the [x0,x1,y0,y1] bounding box of the True pixels of
+    boolean Patch *mask*, or None if there are none.
+    '''
+    if mask is None or mask.patch is None:
+        return None
+    rows = np.flatnonzero(np.any(mask.patch, axis=1))
+    if len(rows) == 0:
+        return None
+    cols = np.flatnonzero(np.any(mask.patch, axis=0))
+    return (mask.x0 + cols[0], mask.x0 + cols[-1] + 1,
+            mask.y0 + rows[0], mask.y0 + rows[-1] + 1)
+
+def _touchStructure(dilate):
+    '''
+    Returns the boolean array of offsets between two pixels that end
+    up 8-connected after each is dilated *dilate* times by the
+    4-connected "cross" structure: Chebyshev distance at most
+    2 * *dilate* + 1 and Manhattan distance at most 2 * *dilate* + 2.
+    '''
+    d = 2 * dilate + 1
+    dy,dx = np.mgrid[-d:d+1, -d:d+1]
+    return (np.abs(dx) + np.abs(dy)) <= d + 1
+
+def _masksTouch(m1, m2, box, struct):
+    '''
+    Is any True pixel of Patch *m1* within offset *struct* (see
+    _touchStructure) of a True pixel of Patch *m2* inside *box* =
+    [x0,x1,y0,y1]?
+    '''
+    from scipy.ndimage.morphology import binary_dilation
+    d = struct.shape[0] // 2
+    (x0,x1,y0,y1) = box
+    # the pixels of m1 that can reach the box
+    a = np.zeros((y1 - y0 + 2*d, x1 - x0 + 2*d), bool)
+    (h,w) = m1.patch.shape
+    ax0,ax1 = max(x0 - d, m1.x0), min(x1 + d, m1.x0 + w)
+    ay0,ay1 = max(y0 - d, m1.y0), min(y1 + d, m1.y0 + h)
+    if ax0 >= ax1 or ay0 >= ay1:
+        return False
+    a[ay0 - (y0 - d):ay1 - (y0 - d), ax0 - (x0 - d):ax1 - (x0 - d)] = (
+        m1.patch[ay0 - m1.y0:ay1 - m1.y0, ax0 - m1.x0:ax1 - m1.x0])
+    a = binary_dilation(a, structure=struct)
+    a = a[d:-d, d:-d]
+    b = m2.patch[y0 - m2.y0:y1 - m2.y0, x0 - m2.x0:x1 - m2.x0]
+    return np.any(a & b)
+
+def find_overlapping_groups(masks, dilate=1, cellsize=64):
+    '''
+    Groups sources by their boolean mask Patches *masks* (None for
+    sources that are not to be grouped).
+
+    Two sources are in the same group if their masks are 8-connected
+    after each is dilated *dilate* times (by the 4-connected cross,
+    as in Tractor.getOverlappingSources), and groups are the
+    transitive closure of that.  The candidate pairs come from a
+    BoxIndex of the mask extents, so the cost scales with the number
+    of sources (at fixed density), not the image size.
+
+    Returns a list of groups (lists of source indices), ordered by
+    their first source; sources with empty masks are omitted.
+    '''
+    struct = _touchStructure(dilate)
+    d = struct.shape[0] // 2
+    extents = [_maskExtent(m) for m in masks]
+    index = BoxIndex(cellsize=cellsize)
+    uf = UnionFind(len(masks))
+    for i,ext in enumerate(extents):
+        if ext is None:
+            continue
+        (x0,x1,y0,y1) = ext
+        for j in index.query((x0 - d, x1 + d, y0 - d, y1 + d)):
+            if uf.find(i) == uf.find(j):
+                continue
+            (bx0,bx1,by0,by1) = extents[j]
+            box = (max(x0 - d, bx0), min(x1 + d, bx1),
+                   max(y0 - d, by0), min(y1 + d, by1))
+            if _masksTouch(masks[i], masks[j], box, struct):
+                uf.union(i, j)
+        index.add(i, ext)
+    return [g for g in uf.groups() if extents[g[0]] is not None]
@@ -8,6 +8,32 @@ except:
 
 #from refcnt import refcnt
 
+import heapq
+
+import numpy as np
+
+def _cost_size(val):
+	'''
+	Returns (nbytes, npixels) of the numpy arrays (or Patch objects)
+	held in *val*, which may be a tuple or list of them.
+	'''
+	if val is None:
+		return 0,0
+	if isinstance(val, np.ndarray):
+		return val.nbytes, val.size
+	if isinstance(val, (tuple, list)):
+		nb = npix = 0
+		for v in val:
+			b,p = _cost_size(v)
+			nb += b
+			npix += p
+		return nb,npix
+	# Patch
+	p = getattr(val, 'patch', None)
+	if isinstance(p, np.ndarray):
+		return p.nbytes, p.size
+	return 0,0
+
 '''
 LRU cache.
 This code is based on: http://code.activestate.com/recipes/498245-lru-and-lfu-cache-decorators/
@@ -15,11 +41,33 @@ By: Raymond Hettinger
 License: Python Software Foundation (PSF) license.
 '''
 class Cache(object):
+	'''
+	A cache with a limit on the number of entries (*maxsize*) and,
+	optionally, on the total number of bytes of the numpy arrays (or
+	Patches) held in the entries (*maxbytes*).
+
+	*policy* is the eviction policy:
+
+	- 'lru': evict the least-recently used entry.
+
+	- 'cost': "GreedyDual-Size": each entry gets a priority of its
+	  cost (eg, the time it took to compute it, given to put()) per
+	  byte, plus an "inflation" value that rises as entries are
+	  evicted, so entries that are cheap to recompute, large, or
+	  not recently used get evicted first.
+
+	Statistics of hits, misses, evictions and bytes are kept; see
+	stats().
+	'''
 	class Entry(object):
 		pass
-	def __init__(self, maxsize=1000, sizeattr='size'):
+	def __init__(self, maxsize=1000, sizeattr='size', maxbytes=None,
+				 policy='lru'):
+		assert(policy in ['lru', 'cost'])
 		self.clear()
 		self.maxsize = maxsize
+		self.maxbytes = maxbytes
+		self.policy = policy
 		self.sizeattr = sizeattr
 
 	def __del__(self):
@@ -44,22 +92,78 @@ class Cache(object):
 			# 	print 'real', refcnt(vv)
 		self.hits = 0
 		self.misses = 0
+		self.evictions = 0
+		self.rejected = 0
+		self.nbytes = 0
+		# for policy='cost': heap of (priority, serial number, key);
+		# entries are left in the heap when their priority changes,
+		# and skipped when their serial number is out of date.
+		self.heap = []
+		self.serial = 0
+		self.inflation = 0.
 		
 	def __setitem__(self, key, val):
-		sz = 0
+		self.put(key, val)
+
+	def put(self, key, val, cost=1.):
+		'''
+		Adds *val* to the cache.  *cost* is the cost of computing it
+		(eg, in seconds), used by the 'cost' eviction policy.
+		'''
+		nb,sz = _cost_size(val)
 		if hasattr(val, self.sizeattr):
 			try:
 				sz = int(getattr(val, self.sizeattr))
 			except:
 				pass
+		if self.maxbytes is not None and nb > self.maxbytes:
+			# would not fit even in an empty cache
+			self.rejected += 1
+			self._remove(key)
+			return
+		self._remove(key)
 		e = Cache.Entry()
 		e.val = val
 		e.size = sz
+		e.nbytes = nb
+		e.cost = cost
 		e.hits = 0
-		# purge LRU item
-		if len(self.dict) >= self.maxsize:
-			self.dict.popitem(0)
 		self.dict[key] = e
+		self.nbytes += nb
+		if self.policy == 'cost':
+			self._push(key, e)
+		self._evict()
+
+	def _remove(self, key):
+		e = self.dict.pop(key, None)
+		if e is not None:
+			self.nbytes -= e.nbytes
+
+	def _push(self, key, e):
+		self.serial += 1
+		e.serial = self.serial
+		e.priority = self.inflation + e.cost / float(max(e.nbytes, 1))
+		heapq.heappush(self.heap, (e.priority, e.serial, key))
+		# drop stale heap items
+		if len(self.heap) > 2 * len(self.dict) + 100:
+			self.heap = [(v.priority, v.serial, k)
+						 for k,v in self.dict.items()]
+			heapq.heapify(self.heap)
+
+	def _evict(self):
+		while ((self.maxsize is not None and len(self.dict) > self.maxsize) or
+			   (self.maxbytes is not None and self.nbytes > self.maxbytes)):
+			if self.policy == 'cost':
+				pri,serial,key = heapq.heappop(self.heap)
+				e = self.dict.get(key)
+				if e is None or e.serial != serial:
+					continue
+				self.inflation = pri
+				self._remove(key)
+			else:
+				key,e = self.dict.popitem(0)
+				self.nbytes -= e.nbytes
+			self.evictions += 1
 
 	def __getitem__(self, key):
 		# pop
@@ -74,11 +178,11 @@ class Cache(object):
 		if e is None:
 			return e
 		e.hits += 1
+		if self.policy == 'cost':
+			self._push(key, e)
 		return e.val
 	def __len__(self):
 		return len(self.dict)
-	def put(self, k, v):
-		self[k] = v
 	def get(self, *args):
 		if len(args) == 1:
 			key = args[0]
@@ -89,14 +193,23 @@ class Cache(object):
 			return self.__getitem__(key)
 		except:
 			return default
+	def stats(self):
+		'''
+		Returns a dict of cache statistics.
+		'''
+		return dict(entries=len(self), hits=self.hits, misses=self.misses,
+					evictions=self.evictions, rejected=self.rejected,
+					nbytes=self.nbytes, maxbytes=self.maxbytes,
+					maxsize=self.maxsize, policy=self.policy)
 	def about(self):
 		print 'Cache has', len(self), 'items:'
 		for k,v in self.dict.items():
 			if v is None:
 				continue
-			print '  size', v.size, 'hits', v.hits
+			print '  size', v.size, 'bytes', v.nbytes, 'hits', v.hits
 	def __str__(self):
-		s =  'Cache: %i items, total of %i hits, %i misses' % (len(self), self.hits, self.misses)
+		s =  'Cache: %i items, total of %i hits, %i misses, %i evictions' % (
+			len(self), self.hits, self.misses, self.evictions)
 		nnone = 0
 		hits = 0
 		size = 0
@@ -110,7 +223,8 @@ class Cache(object):
 			hits += v.hits
 			size += v.size
 		s +=  ', %i entries are None' % nnone
-		s +=  '; current cache entries: %i hits, %i pixels' % (hits, size)
+		s +=  '; current cache entries: %i hits, %i pixels, %i bytes' % (
+			hits, size, self.nbytes)
 		return s
 
 	def printItems(self):
@@ -132,10 +246,14 @@ class Cache(object):
 				continue
 			sz += v.size
 		return sz
+
+	def totalBytes(self):
+		return self.nbytes
 		
 	def printStats(self):
 		print 'Cache has', len(self), 'items'
 		print 'Total of', self.hits, 'cache hits and', self.misses, 'misses'
+		print 'Evictions:', self.evictions, 'rejected:', self.rejected
 		nnone = 0
 		hits = 0
 		size = 0
@@ -148,6 +266,7 @@ class Cache(object):
 		print '  ', nnone, 'entries are None'
 		print 'Total number of hits of cache entries:', hits
 		print' Total size (pixels) of cache entries:', size
+		print' Total size (bytes) of cache entries:', self.nbytes, 'of max', self.maxbytes
 		
 
 class NullCache(object):
@@ -161,10 +280,14 @@ class NullCache(object):
 		if len(args) == 1:
 			return self.__getitem__(args[0])
 		return args[1]
-	def put(self, *args):
+	def put(self, *args, **kwargs):
 		pass
 	def totalSize(self):
 		return 0
+	def totalBytes(self):
+		return 0
+	def stats(self):
+		return dict(entries=0)
 	def __len__(self):
-		return len(self.dict)
+		return 0
 
@@ -30,7 +30,10 @@ class CfhtPhotoCal(BaseParams):
 		return [0.01]
 	def setParam(self, i, p):
 		assert(i == 0)
+		old = self.phot_c
 		self.phot_c = p
+		self._paramsChanged()
+		return old
 
 	def getParamNames(self):
 		return ['phot_c']
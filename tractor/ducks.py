@@ -135,6 +135,11 @@ class Sky(ImageCalibration, Params):
         '''
         Add the sky to the input synthetic image `mod`, a 2-D numpy
         array.
+
+        Optionally, a sky can also take keywords `x0`,`y0`: the image
+        pixel coordinates of mod[0,0], for when `mod` is a sub-region
+        of the image.  Skies that don't are rendered over the whole
+        image and cut down (see Tractor._addSkyTo).
         '''
         pass
 
@@ -169,6 +174,20 @@ class Source(Params):
         '''
         pass
 
+    def getModelMixture(self, img, minsb=0.):
+        '''
+        Optional: lets the Tractor render many sources in one batch.
+
+        Returns None if this Source cannot be rendered as a mixture of
+        Gaussians (in which case getModelPatch() will be used);
+        otherwise (mixture, extent), where *mixture* is a
+        MixtureOfGaussians in the pixel coordinates of the `Image`,
+        including the source brightness, and *extent* = [x0,x1,y0,y1]
+        is the pixel range that getModelPatch() would render.
+        *mixture* can be None if there is nothing to render.
+        '''
+        return None
+
     def getParamDerivatives(self, img, modelMask=None):
         '''
         Returns [ Patch, Patch, ... ], of length numberOfParams(),
@@ -16,6 +16,10 @@ import random
 import os
 import resource
 import gc
+import contextlib
+import inspect
+import atexit
+import weakref
 
 import numpy as np
 
@@ -29,6 +33,8 @@ from astrometry.util.multiproc import *
 from astrometry.util.ttime import *
 
 from .utils import MultiParams, _isint, listmax, get_class_from_name
+from .utils import getClassName
+from .instrument import StageStats, nulltimer
 from .cache import *
 from .patch import *
 
@@ -173,9 +179,9 @@ class Image(MultiParams):
         return self.getShape()
     
     def hashkey(self):
-        return ('Image', id(self.data), id(self.inverr), self.psf.hashkey(),
-                self.sky.hashkey(), self.wcs.hashkey(),
-                self.photocal.hashkey())
+        # MultiParams.hashkey covers psf, wcs, photocal, sky.
+        return ('Image', id(self.data), id(self.inverr),
+                super(Image, self).hashkey())
 
     def numberOfPixels(self):
         (H,W) = self.data.shape
@@ -352,6 +358,99 @@ def getimagederivs(X):
     (imj, img, tractor, srcs) = X
     ## FIXME -- avoid shipping all images...
     return img.getParamDerivatives(tractor, srcs)
+def getlogprobstep(X):
+    (tr, params) = X
+    tr.setParams(params)
+    return tr.getLogProb()
+def getforcedphottile(X):
+    (tr, nown, kwargs) = X
+    r = tr.optimize_forced_photometry(**kwargs)
+    params = [tr.catalog[i].getParams() for i in range(nown)]
+    return params, getattr(r, 'IV', None), getattr(r, 'converged', None)
+# Tractors loaded by worker processes from resident-state files (see
+# Tractor._getWorkerState), keyed by file name.
+_worker_tractors = {}
+_worker_tractor_order = []
+
+# Resident-state files written by this process and not yet deleted:
+# file name -> (pid, weak reference to the Tractor).  They are
+# deleted when their Tractor goes away, or at exit.
+_worker_state_files = {}
+
+def _removeWorkerStateFile(path):
+    W = _worker_state_files.pop(path, None)
+    if W is None or W[0] != os.getpid():
+        # (not ours: eg, inherited by a forked process)
+        return
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
+
+@atexit.register
+def _removeWorkerStateFiles():
+    for path in list(_worker_state_files.keys()):
+        _removeWorkerStateFile(path)
+
+def _frozenState(params, frozen=False):
+    '''
+    Returns a hashable summary of what a worker holding *params* is
+    not sent with each task (see Tractor._getWorkerState): the
+    hashkeys of frozen sub-Params and the values of frozen
+    parameters.
+    '''
+    if frozen:
+        return params.hashkey()
+    subs = getattr(params, 'subs', None)
+    if subs is not None:
+        return tuple([_frozenState(sub, not liquid)
+                      for sub,liquid in zip(subs, params.liquid)])
+    liquid = getattr(params, 'liquid', None)
+    if liquid is None:
+        return None
+    return tuple([v for v,l in zip(params.getAllParams(), liquid) if not l])
+
+def _getWorkerTractor(path, params):
+    '''
+    In a worker process: returns the Tractor broadcast in file *path*,
+    loading it the first time, with its thawed parameters set to
+    *params*.
+    '''
+    W = _worker_tractors.get(path)
+    if W is None:
+        import cPickle as pickle
+        f = open(path, 'rb')
+        tr = pickle.load(f)
+        f.close()
+        W = [tr, None]
+        _worker_tractors[path] = W
+        _worker_tractor_order.append(path)
+        # keep a few
+        while len(_worker_tractor_order) > 4:
+            del _worker_tractors[_worker_tractor_order.pop(0)]
+    tr = W[0]
+    if W[1] != params:
+        tr.setParams(params)
+        W[1] = params
+    return tr
+
+def getworkersrcderivs(X):
+    (path, params, j, i) = X
+    tr = _getWorkerTractor(path, params)
+    return tr.catalog[j].getParamDerivatives(tr.images[i])
+def getworkermodelimage(X):
+    (path, params, i) = X
+    tr = _getWorkerTractor(path, params)
+    return tr.getModelImage(i)
+def getworkerlogprob(X):
+    (path, params) = X
+    tr = _getWorkerTractor(path, params)
+    return tr.getLogProb()
+
+def getblobfit(X):
+    (tr, kwargs) = X
+    r = tr.optimize_loop(**kwargs)
+    return [src.getParams() for src in tr.catalog], r
 def getmodelimagefunc2(X):
     (tr, im) = X
     #print 'getmodelimagefunc2(): im', im, 'pid', os.getpid()
@@ -364,10 +463,214 @@ def getmodelimagefunc2(X):
         traceback.print_exc()
         raise
 
+def sparse_solve(M, b):
+    '''
+    Solves M x = b for sparse, symmetric positive-definite M, with
+    scikit-sparse's CHOLMOD Cholesky factorization if available,
+    else SuperLU from scipy.
+    '''
+    try:
+        from sksparse.cholmod import cholesky
+        return cholesky(M.tocsc())(b)
+    except ImportError:
+        from scipy.sparse.linalg import splu
+        return splu(M.tocsc()).solve(b)
+
+def bounded_normal_lsq(M, b, lower, maxiter=None):
+    '''
+    Minimizes 0.5 x^T M x - b^T x subject to x >= *lower*, for sparse
+    symmetric positive-definite *M* (the normal equations of a
+    least-squares problem A x = y, with M = A^T A and b = A^T y);
+    elements of *lower* can be -inf.  Returns (x, converged): if
+    *converged* is False, x (clipped to *lower*) is from the last of
+    *maxiter* iterations, not the solution.
+
+    Uses block principal pivoting (Kim & Park 2011, SIAM J. Sci.
+    Comput. 33, 3261): each iteration solves the unconstrained problem
+    for the free variables, then swaps all the variables that violate
+    the optimality conditions between the free and bound sets, falling
+    back to one at a time if that stops making progress.  Usually only
+    a few iterations are needed.
+    '''
+    n = len(b)
+    lower = np.asarray(lower, float)
+    bounded = np.isfinite(lower)
+    lb = np.where(bounded, lower, 0.)
+    M = M.tocsr()
+    if maxiter is None:
+        maxiter = 5 * n + 10
+    free = np.ones(n, bool)
+    tol = 1e-9 * (np.max(np.abs(b)) +
+                  np.max(np.abs(M.diagonal())) * np.max(np.abs(lb)))
+    nbest = n + 1
+    backup = 3
+    for it in range(maxiter):
+        F = np.flatnonzero(free)
+        x = lb.copy()
+        if len(F):
+            xb = x.copy()
+            xb[F] = 0.
+            rhs = b[F] - M.dot(xb)[F]
+            x[F] = sparse_solve(M[F,:][:,F], rhs)
+        g = M.dot(x) - b
+        viol = bounded & ((free & (x < lower)) |
+                          (np.logical_not(free) & (g < -tol)))
+        nv = np.sum(viol)
+        if nv == 0:
+            break
+        if nv < nbest:
+            nbest = nv
+            backup = 3
+            free[viol] = np.logical_not(free[viol])
+        elif backup > 0:
+            backup -= 1
+            free[viol] = np.logical_not(free[viol])
+        else:
+            i = np.flatnonzero(viol)[-1]
+            free[i] = not free[i]
+    else:
+        logmsg('bounded_normal_lsq: did not converge after', maxiter,
+               'iterations;', nv, 'variables violate the bounds')
+        return np.maximum(x, lower), False
+    return np.maximum(x, lower), True
+
+def _patchPixels(patch, img, nz):
+    '''
+    Returns the flat indices, in *img*, of the elements *nz* (flat
+    indices) of Patch *patch*.
+    '''
+    (h,w) = patch.patch.shape
+    W = img.shape[1]
+    return (patch.y0 + nz // w) * W + (patch.x0 + nz % w)
+
+def _numberDerivativeRows(allderivs, density=0.25):
+    '''
+    Numbers the rows of the update matrix: the pixels where some
+    derivative is non-zero, image by image (in order of appearance)
+    and in row-major order within an image.  The derivatives must
+    already be clipped to their images.
+
+    Returns (imgorder, imgrows, Nrows).  imgrows[img] is a dict with
+    "row0" and "nrows", the first row and number of rows of the image,
+    and "pix", the sorted flat indices of its pixels; see
+    _derivativeRows().  If the derivative patches cover at least
+    *density* of their bounding box, the rows are looked up in a
+    "rowmap" image of that box (at "extent"), else by searching
+    "pix"; either way, memory use is about that of the derivative
+    patches, however far apart they are.
+    '''
+    imgorder = []
+    imgderivs = {}
+    for param in allderivs:
+        for (deriv, img) in param:
+            if deriv.patch is None:
+                continue
+            dl = imgderivs.get(img, None)
+            if dl is None:
+                imgorder.append(img)
+                dl = imgderivs[img] = []
+            dl.append(deriv)
+    imgrows = {}
+    Nrows = 0
+    for img in imgorder:
+        derivs = imgderivs[img]
+        x0 = min([d.x0 for d in derivs])
+        y0 = min([d.y0 for d in derivs])
+        x1 = max([d.x1 for d in derivs])
+        y1 = max([d.y1 for d in derivs])
+        npix = sum([d.patch.size for d in derivs])
+        R = dict(row0=Nrows, extent=(x0,x1,y0,y1), rowmap=None)
+        if npix >= density * (x1 - x0) * (y1 - y0):
+            mask = np.zeros((y1-y0, x1-x0), bool)
+            for d in derivs:
+                mask[d.y0 - y0 : d.y1 - y0,
+                     d.x0 - x0 : d.x1 - x0] |= (d.patch != 0)
+            rowmap = np.cumsum(mask.ravel()).reshape(mask.shape)
+            rowmap += (Nrows - 1)
+            R.update(rowmap=rowmap)
+            (yy,xx) = np.nonzero(mask)
+            del mask
+            pix = (yy + y0) * img.shape[1] + (xx + x0)
+        else:
+            pix = np.unique(np.hstack([
+                _patchPixels(d, img, np.flatnonzero(d.patch))
+                for d in derivs]))
+        R.update(pix=pix, nrows=len(pix))
+        imgrows[img] = R
+        Nrows += len(pix)
+    return imgorder, imgrows, Nrows
+
+def _derivativeRows(imgrows, img, deriv, nz):
+    '''
+    Returns the rows (see _numberDerivativeRows) of the elements *nz*
+    (flat indices) of derivative Patch *deriv* of *img*.
+    '''
+    R = imgrows[img]
+    rowmap = R['rowmap']
+    if rowmap is not None:
+        (x0,x1,y0,y1) = R['extent']
+        return rowmap[deriv.y0 - y0 : deriv.y1 - y0,
+                      deriv.x0 - x0 : deriv.x1 - x0].flat[nz]
+    return R['row0'] + np.searchsorted(R['pix'], _patchPixels(deriv, img, nz))
+
+def _takesOffsets(func):
+    '''
+    Does *func* (eg, a Sky's addTo method) take x0,y0 keywords?
+    '''
+    try:
+        args,varargs,varkw,defaults = inspect.getargspec(func)
+    except TypeError:
+        return False
+    return varkw is not None or ('x0' in args and 'y0' in args)
+
 class OptResult():
     # quack
     pass
 
+def _timedStage(name):
+    '''
+    Decorator for Tractor methods: records each call as stage *name*
+    in the Tractor's stats, if profiling() is on.
+    '''
+    def wrap(func):
+        def timed(self, *args, **kwargs):
+            if self.stats is None:
+                return func(self, *args, **kwargs)
+            with self.stats.stage(name):
+                return func(self, *args, **kwargs)
+        timed.__name__ = func.__name__
+        timed.__doc__ = func.__doc__
+        return timed
+    return wrap
+
+def _profiled(func):
+    '''
+    Decorator for Tractor optimizer methods: if profiling() is on,
+    stores the report of the stages run during this call in
+    self.lastProfile, and in the result as "profile" (an attribute of
+    an OptResult, or a key of a dict).
+    '''
+    def profiled(self, *args, **kwargs):
+        if self.stats is None:
+            return func(self, *args, **kwargs)
+        outer = self.stats
+        self.stats = StageStats()
+        try:
+            R = func(self, *args, **kwargs)
+        finally:
+            stats = self.stats
+            self.stats = outer
+            outer.merge(stats)
+            self.lastProfile = stats.report()
+        if isinstance(R, OptResult):
+            R.profile = self.lastProfile
+        elif isinstance(R, dict):
+            R['profile'] = self.lastProfile
+        return R
+    profiled.__name__ = func.__name__
+    profiled.__doc__ = func.__doc__
+    return profiled
+
 class Tractor(MultiParams):
     """
     Heavy farm machinery.
@@ -401,6 +704,14 @@ class Tractor(MultiParams):
     def disable_cache(self):
         self.cache = None
 
+    def set_cache_size(self, N=1000, maxbytes=None, policy='lru'):
+        '''
+        Replaces the model-patch cache with a new one holding at most
+        *N* patches and *maxbytes* bytes of patches, with eviction
+        policy *policy*; see cache.Cache.
+        '''
+        self.cache = Cache(maxsize=N, maxbytes=maxbytes, policy=policy)
+
     def _setup(self, mp=None, cache=None, pickleCache=False):
         if mp is None:
             mp = multiproc()
@@ -412,6 +723,27 @@ class Tractor(MultiParams):
         self.pickleCache = pickleCache
         self.modelMasks = None
         self.expectModelMasks = False
+        # Render sources that can be described as mixtures of
+        # Gaussians in one batch in getModelImage()?
+        self.batchModels = False
+        # Line search used by tryUpdates(): 'grid', 'quadratic' or
+        # 'parallel'
+        self.lineSearch = 'grid'
+        # Keep resident model images, updated only for the sources
+        # whose parameters change?  See _getResidentModel().
+        self.incrementalModels = False
+        self._resident = {}
+        # Give LSQR a matrix-free operator in getUpdateDirection()?
+        self.matrixFree = False
+        # In multiprocessing mode, send the images and catalog to the
+        # workers once, and then only parameter vectors?  See
+        # _getWorkerState().
+        self.residentWorkers = False
+        self._workerState = None
+        # Per-stage timing counters (a StageStats), or None; see
+        # profiling().
+        self.stats = None
+        self.lastProfile = None
 
     def __str__(self):
         s = '%s with %i sources and %i images' % (self.getName(), len(self.catalog), len(self.images))
@@ -424,9 +756,104 @@ class Tractor(MultiParams):
         s += ' (' + ', '.join(names) + ')'
         return s
 
+    @contextlib.contextmanager
+    def profiling(self):
+        '''
+        Turns on per-stage timing counters for the duration of a
+        "with" block:
+
+            with tractor.profiling() as stats:
+                tractor.optimize_loop()
+            print stats
+
+        *stats* is a StageStats (see instrument.py) counting the calls,
+        wall and CPU time, and pixels of the stages 'render' (model
+        patches), 'cache' (model-patch cache hits and misses),
+        'derivs', 'matrix' (building the sparse or normal matrix),
+        'solve' and 'linesearch', split by the source and PSF classes
+        where that makes sense.  Stages nest, so times are inclusive.
+        The optimizers also leave the report of their last call in
+        self.lastProfile.  Work done in multiprocessing workers is not
+        counted.
+        '''
+        stats = StageStats()
+        outer = self.stats
+        self.stats = stats
+        try:
+            yield stats
+        finally:
+            self.stats = outer
+            if outer is not None:
+                outer.merge(stats)
+
+    def _stage(self, name, src=None, img=None):
+        '''
+        Returns a timer for stage *name* (see profiling()), by the
+        classes of *src* and *img*'s PSF, or a no-op one.
+        '''
+        if self.stats is None:
+            return nulltimer
+        kind = None
+        if src is not None:
+            kind = getClassName(src)
+            if img is not None:
+                kind = '%s/%s' % (kind, getClassName(img.getPsf()))
+        return self.stats.stage(name, kind)
+
     def is_multiproc(self):
         return self.mp.pool is not None
 
+    def _useWorkerState(self):
+        return self.residentWorkers and self.is_multiproc()
+
+    def _getWorkerState(self):
+        '''
+        Returns the name of a file holding this Tractor (pickled), for
+        the worker processes to load once and keep (see
+        _getWorkerTractor()), so that tasks need only carry the file
+        name, the parameter vector and a work-item index.
+
+        The file is rewritten when the images or their pixel arrays,
+        the list of sources, the set of thawed parameters, or anything
+        frozen (see _frozenState()) change, but not when just the
+        thawed parameter values do.  Like the patch cache, this does
+        not notice changes to image pixels made in place; call
+        clearWorkerState() after making such changes.  The file is
+        deleted when this Tractor is, or at exit.
+        '''
+        import cPickle as pickle
+        import tempfile
+        sig = (tuple([(id(img), id(img.data), id(img.inverr))
+                      for img in self.images]),
+               tuple([id(src) for src in self.catalog]),
+               tuple(self.getParamNames()),
+               _frozenState(self))
+        if self._workerState is not None and self._workerState[1] == sig:
+            return self._workerState[0]
+        self.clearWorkerState()
+        tmpdir = None
+        if os.path.isdir('/dev/shm'):
+            tmpdir = '/dev/shm'
+        fd,path = tempfile.mkstemp(prefix='tractor-', suffix='.pickle',
+                                   dir=tmpdir)
+        f = os.fdopen(fd, 'wb')
+        pickle.dump(self, f, -1)
+        f.close()
+        self._workerState = (path, sig)
+        _worker_state_files[path] = (os.getpid(), weakref.ref(
+            self, lambda r, path=path: _removeWorkerStateFile(path)))
+        return path
+
+    def clearWorkerState(self):
+        '''
+        Deletes the resident-state file for the worker processes, if
+        any; it will be rewritten when next needed.
+        '''
+        if self._workerState is None:
+            return
+        _removeWorkerStateFile(self._workerState[0])
+        self._workerState = None
+
     def _map(self, func, iterable):
         return self.mp.map(func, iterable)
     def _map_async(self, func, iterable):
@@ -437,22 +864,41 @@ class Tractor(MultiParams):
         self.setParams(X)
         return self.getLogProb()
 
+    # Settings (see _setup()) carried along when pickling
+    _pickledOptions = ['modtype', 'batchModels', 'lineSearch',
+                       'incrementalModels', 'matrixFree']
+
+    def _copyOptionsTo(self, tractor):
+        '''
+        Gives *tractor* (eg, a sub-Tractor for a tile or blob) the
+        same settings as this one.
+        '''
+        for k in self._pickledOptions:
+            setattr(tractor, k, getattr(self, k))
+
     # For pickling
     def __getstate__(self):
         S = (self.getImages(), self.getCatalog(), self.liquid)
         if self.pickleCache:
             S = S + (self.cache,)
-        return S
+        opts = dict([(k, getattr(self, k)) for k in self._pickledOptions])
+        return S + (opts,)
     def __setstate__(self, state):
         args = {}
+        opts = {}
+        if isinstance(state[-1], dict):
+            opts = state[-1]
+            state = state[:-1]
         if len(state) == 3:
             (images, catalog, liquid) = state
         elif len(state) == 4:
             (images, catalog, liquid, cache) = state
-            args.update(cache=cache, pickleCache=pickleCache)
+            args.update(cache=cache, pickleCache=True)
         self.subs = [images, catalog]
         self.liquid = liquid
         self._setup(**args)
+        for k,v in opts.items():
+            setattr(self, k, v)
 
     def getNImages(self):
         return len(self.images)
@@ -485,7 +931,21 @@ class Tractor(MultiParams):
     def removeSource(self, src):
         self.catalog.remove(src)
 
-    def computeParameterErrors(self, symmetric=False):
+    def computeParameterErrors(self, symmetric=False, fisher=False):
+        '''
+        Returns a list of 1-sigma errors on the thawed parameters (None
+        where they could not be found).
+
+        By default, sweeps each parameter, with the others fixed,
+        until the log-prob drops by 0.5 (both ways, if *symmetric*).
+
+        If *fisher*, returns the marginalized errors from the inverse
+        of the Fisher matrix; see getParameterCovariance().
+        '''
+        if fisher:
+            C = self.getParameterCovariance()
+            return [None if not np.isfinite(v) else np.sqrt(v)
+                    for v in C.diagonal()]
         if not symmetric:
             return self._param_errors_1()
 
@@ -501,6 +961,65 @@ class Tractor(MultiParams):
                 sigs.append((s1 + s2) / 2.)
         return sigs
 
+    def getParameterCovariance(self, allderivs=None, priors=True):
+        '''
+        Returns the covariance matrix of the thawed parameters, the
+        inverse of the Fisher matrix J^T J (plus the prior terms), as
+        a sparse (scipy CSR) matrix.
+
+        The Fisher matrix is built from the derivative patches
+        (*allderivs*, default: getDerivs()); it has non-zero elements
+        only between parameters whose derivatives overlap, so it is
+        inverted block by block, for each connected group of
+        parameters.  Parameters that the data do not constrain get
+        variance inf.
+        '''
+        import scipy.sparse
+        from scipy.sparse.csgraph import connected_components
+
+        if allderivs is None:
+            allderivs = self.getDerivs()
+        N,nil = self._normalEquations(allderivs, self.getImages())
+        Np = N.shape[0]
+        if priors:
+            pderivs = self.getLogPriorDerivatives()
+            if pderivs is not None:
+                rA,cA,vA,pb = pderivs
+                if len(rA):
+                    rows = np.hstack(rA)
+                    cols = np.hstack([[c]*len(r) for r,c in zip(rA, cA)])
+                    P = scipy.sparse.csr_matrix(
+                        (np.hstack(vA), (rows, cols)),
+                        shape=(rows.max() + 1, Np))
+                    N = N + (P.T * P)
+        N = N.tocsr()
+        diag = N.diagonal()
+        ok = (diag > 0)
+        ngroups,groups = connected_components(N, directed=False)
+        rows = []
+        cols = []
+        vals = []
+        for g in range(ngroups):
+            I = np.flatnonzero((groups == g) * ok)
+            if len(I) == 0:
+                continue
+            block = N[I,:][:,I].toarray()
+            try:
+                C = np.linalg.inv(block)
+            except np.linalg.LinAlgError:
+                C = np.linalg.pinv(block)
+            rows.append(np.repeat(I, len(I)))
+            cols.append(np.tile(I, len(I)))
+            vals.append(C.ravel())
+        I = np.flatnonzero(np.logical_not(ok))
+        rows.append(I)
+        cols.append(I)
+        vals.append(np.inf * np.ones(len(I)))
+        C = scipy.sparse.csr_matrix((np.hstack(vals),
+                                     (np.hstack(rows), np.hstack(cols))),
+                                    shape=(Np,Np))
+        return C
+
     def _param_errors_1(self, sign=1.):
         # Try to compute 1-sigma error bars on each parameter by
         # sweeping the parameter (in the "getStepSizes()" direction)
@@ -554,8 +1073,19 @@ class Tractor(MultiParams):
             sigmas.append(sigma)
         return np.array(sigmas)
 
-    def optimize_lbfgsb(self, hessian_terms=10, plotfn=None):
+    def optimize_lbfgsb(self, hessian_terms=10, plotfn=None, bounds=None,
+                        approx_grad=False):
+        '''
+        Optimizes the thawed parameters with scipy's L-BFGS-B.
+
+        The gradient of the log-prob comes from the parameter
+        derivatives (see getLogProbGradient()) unless *approx_grad*,
+        in which case L-BFGS-B approximates it with finite differences
+        (one log-prob evaluation per parameter).
 
+        *bounds*: None, or a list of (lower, upper) bounds for each
+        thawed parameter, either of which can be None.
+        '''
         XX = []
         OO = []
         def objective(x, tractor, stepsizes, lnp0):
@@ -566,6 +1096,16 @@ class Tractor(MultiParams):
                 OO.append(res)
             return res
 
+        def objective_grad(x, tractor, stepsizes, lnp0):
+            tractor.setParams(x * stepsizes)
+            lnp,grad = tractor.getLogProbGradient(return_lnp=True)
+            res = lnp0 - lnp
+            print 'LBFGSB objective:', res
+            if plotfn:
+                XX.append(x.copy())
+                OO.append(res)
+            return res, -grad * stepsizes
+
         from scipy.optimize import fmin_l_bfgs_b
 
         stepsizes = np.array(self.getStepSizes())
@@ -574,11 +1114,21 @@ class Tractor(MultiParams):
 
         print 'Active parameters:', len(p0)
 
+        if bounds is not None:
+            # in units of the step sizes
+            bounds = [tuple([None if b is None else b / s for b in bb])
+                      for bb,s in zip(bounds, stepsizes)]
+
         print 'Calling L-BFGS-B ...'
-        X = fmin_l_bfgs_b(objective, p0 / stepsizes, fprime=None,
-                          args=(self, stepsizes, lnp0),
-                          approx_grad=True, bounds=None, m=hessian_terms,
-                          epsilon=1e-8, iprint=0)
+        if approx_grad:
+            X = fmin_l_bfgs_b(objective, p0 / stepsizes, fprime=None,
+                              args=(self, stepsizes, lnp0),
+                              approx_grad=True, bounds=bounds,
+                              m=hessian_terms, epsilon=1e-8, iprint=0)
+        else:
+            X = fmin_l_bfgs_b(objective_grad, p0 / stepsizes,
+                              args=(self, stepsizes, lnp0),
+                              bounds=bounds, m=hessian_terms, iprint=0)
         p1,lnp1,d = X
         print d
         print 'lnp0:', lnp0
@@ -1104,7 +1654,13 @@ class Tractor(MultiParams):
                     # scaled min val to be less than minsb
                     mv = minsb / counts
                 mask = self._getModelMaskFor(img, src)
-                ums = src.getUnitFluxModelPatches(img, minval=mv, modelMask=mask)
+                with self._stage('render', src, img) as t:
+                    ums = src.getUnitFluxModelPatches(img, minval=mv,
+                                                      modelMask=mask)
+                    if self.stats is not None:
+                        t.pixels = sum([um.patch.size for um in ums
+                                        if um is not None and
+                                        um.patch is not None])
 
                 isvalid = False
                 isallzero = False
@@ -1219,6 +1775,143 @@ class Tractor(MultiParams):
             lnp += self.getLogPrior()
         return lnp, chis, ims
 
+    def _normalEquations(self, derivs, imlist, chis=None):
+        '''
+        Builds the normal equations: returns (N, b), where N = A^T A is
+        the sparse (scipy CSC) normal matrix and b = A^T chi, for the
+        matrix A whose columns are the *derivs* weighted by the
+        inverse-errors.  *chis* are the chi images of *imlist*; if
+        None, b is not computed.
+
+        Only pairs of derivative patches that overlap in some image
+        contribute off-diagonal elements of N.
+        '''
+        import scipy.sparse
+
+        Ncols = len(derivs)
+        b = np.zeros(Ncols)
+        diag = np.zeros(Ncols)
+        rows = []
+        cols = []
+        vals = []
+        imindex = dict([(id(tim), i) for i,tim in enumerate(imlist)])
+        # per-image list of (column, x0, x1, y0, y1, weighted patch)
+        blocks = [[] for tim in imlist]
+        for col,param in enumerate(derivs):
+            for deriv,tim in param:
+                if deriv is None or deriv.patch is None:
+                    continue
+                i = imindex[id(tim)]
+                (H,W) = tim.shape
+                deriv = deriv.copy()
+                if not deriv.clipTo(W, H):
+                    continue
+                slc = deriv.getSlice()
+                wd = deriv.patch * tim.getInvError()[slc]
+                if chis is not None:
+                    b[col] += np.sum(wd * chis[i][slc])
+                diag[col] += np.sum(wd**2)
+                (x0,x1,y0,y1) = deriv.getExtent()
+                blocks[i].append((col, x0, x1, y0, y1, wd))
+
+        for blist in blocks:
+            # sweep in x to find the pairs of overlapping patches
+            blist.sort(key=lambda bb: bb[1])
+            for k,(ci,ax0,ax1,ay0,ay1,wa) in enumerate(blist):
+                for (cj,bx0,bx1,by0,by1,wb) in blist[k+1:]:
+                    if bx0 >= ax1:
+                        break
+                    y0 = max(ay0, by0)
+                    y1 = min(ay1, by1)
+                    if y0 >= y1:
+                        continue
+                    x1 = min(ax1, bx1)
+                    v = np.sum(wa[y0-ay0:y1-ay0, bx0-ax0:x1-ax0] *
+                               wb[y0-by0:y1-by0, :x1-bx0])
+                    if v == 0.:
+                        continue
+                    # the same pair of parameters may overlap in
+                    # several images (or twice, for shared params); the
+                    # sparse matrix sums duplicates.
+                    rows.extend([ci, cj])
+                    cols.extend([cj, ci])
+                    vals.extend([v, v])
+        rows.extend(range(Ncols))
+        cols.extend(range(Ncols))
+        vals.extend(diag)
+        N = scipy.sparse.csc_matrix((vals, (rows, cols)), shape=(Ncols,Ncols))
+        return N, b
+
+    def _direct_forced_photom(self, result, derivs, mod0, imgs, imlist,
+                              umodels, rois, scales, priors, sky, minFlux,
+                              justims0, damp, Nsky):
+        '''
+        Forced photometry by solving the (linear) least-squares problem
+        directly, via a sparse factorization of the normal matrix,
+        rather than iterating LSQR steps plus line searches.
+
+        Uses scikit-sparse's CHOLMOD Cholesky factorization if
+        available, else SuperLU from scipy.  If *minFlux* is given, the
+        fluxes are constrained to be >= minFlux (see
+        bounded_normal_lsq).
+        '''
+        import scipy.sparse
+
+        p0 = self.getParams()
+        if sky:
+            p0sky = p0[:Nsky]
+            p0 = p0[Nsky:]
+
+        t0 = Time()
+        lnp0,chis0,ims0 = self._lnp_for_update(
+            mod0, imgs, umodels, None, None, p0, rois, scales,
+            None, None, priors, sky, minFlux)
+        logverb('forced phot: initial lnp = ', lnp0, 'took', Time()-t0)
+        if justims0:
+            result.lnp0 = lnp0
+            result.chis0 = chis0
+            result.ims0 = ims0
+            return
+
+        t0 = Time()
+        with self._stage('matrix'):
+            N,b = self._normalEquations(derivs, imlist, chis0)
+        logverb('forced phot: normal matrix:', N.shape, N.nnz, 'non-zeros;',
+                'took', Time()-t0)
+        result.IVmatrix = N
+
+        # Parameters that touch no pixels do not move.
+        diag = N.diagonal()
+        fix = (diag == 0) * 1.
+        M = (N + scipy.sparse.diags(fix + damp**2, 0)).tocsc()
+        t0 = Time()
+        with self._stage('solve'):
+            if minFlux is None:
+                X = sparse_solve(M, b)
+                result.converged = True
+            else:
+                lower = np.append(-np.inf * np.ones(Nsky),
+                                  minFlux - np.array(p0))
+                X,result.converged = bounded_normal_lsq(M, b, lower)
+        logverb('forced phot: solve took', Time()-t0)
+
+        if sky:
+            Xsky = X[:Nsky]
+            X = X[Nsky:]
+            self.images.setParams([p + d for p,d in zip(p0sky, Xsky)])
+        if minFlux is not None:
+            pa = [max(minFlux, p + d) for p,d in zip(p0, X)]
+        else:
+            pa = [p + d for p,d in zip(p0, X)]
+        self.catalog.setParams(pa)
+
+        lnp1,chis1,ims1 = self._lnp_for_update(
+            mod0, imgs, umodels, None, None, pa, rois, scales,
+            None, None, priors, sky, minFlux)
+        logverb('forced phot: final lnp = ', lnp1, 'dlnp', lnp1 - lnp0)
+        result.ims0 = ims0
+        result.ims1 = ims1
+
     def _lsqr_forced_photom(self, result, derivs, mod0, imgs, umodels, rois, scales,
                             priors, sky, minFlux, justims0, subimgs,
                             damp, alphas, Nsky, mindlnp, shared_params,
@@ -1392,6 +2085,7 @@ class Tractor(MultiParams):
         result.ims0 = ims0
         result.ims1 = imsBest
     
+    @_profiled
     def optimize_forced_photometry(self, alphas=None, damp=0, priors=False,
                                    minsb=0.,
                                    mindlnp=1.,
@@ -1412,6 +2106,7 @@ class Tractor(MultiParams):
                                    nilcounts=-1e30,
                                    wantims=True,
                                    negfluxval=None,
+                                   direct=False,
                                    ):
         '''
         Returns an "OptResult" duck with fields:
@@ -1419,6 +2114,10 @@ class Tractor(MultiParams):
         .ims0, .ims1         (if wantims=True)
         .IV                  (if variance=True)
         .fitstats            (if fitstats=True)
+        .IVmatrix            (if direct=True)
+        .converged           (if direct=True): False if the flux
+                             constraints (minFlux) were not satisfied
+                             within the iteration limit
 
         ims0, ims1:
         [ (img_data, mod, ie, chi, roi), ... ]
@@ -1437,11 +2136,25 @@ class Tractor(MultiParams):
 
         PRIORS probably don't work because we don't setParams() when evaluating
         likelihood or prior!
+
+        If direct=True, the fluxes (and sky) are found in one shot by
+        factorizing the sparse normal matrix, whose off-diagonal terms
+        come only from sources whose models overlap.  That matrix, the
+        inverse-variance matrix of the parameters (including the
+        covariances of blended sources), is returned as .IVmatrix.
+        Fluxes are then constrained to be >= minFlux by an active-set
+        solver; nonneg=True (without use_ceres) implies direct=True
+        and minFlux=0.
         '''
         from basics import LinearPhotoCal, ShiftedWcs
 
         result = OptResult()
 
+        if nonneg and not use_ceres:
+            direct = True
+            if minFlux is None or minFlux < 0:
+                minFlux = 0.
+
         assert(not priors)
         scales = []
         imgs = self.getImages()
@@ -1547,12 +2260,23 @@ class Tractor(MultiParams):
                 # the derivative list.
                 derivs = skyderivs + derivs
             assert(len(derivs) == self.numberOfParams())
-            self._lsqr_forced_photom(
-                result, derivs, mod0, imgs, umodels, rois, scales, priors, sky,
-                minFlux, justims0, subimgs, damp, alphas, Nsky, mindlnp,
-                shared_params, use_tsnnls)
-                
-        if variance:
+            if direct:
+                self._direct_forced_photom(
+                    result, derivs, mod0, imgs, imlist, umodels, rois, scales,
+                    priors, sky, minFlux, justims0, damp, Nsky)
+            else:
+                self._lsqr_forced_photom(
+                    result, derivs, mod0, imgs, umodels, rois, scales, priors,
+                    sky, minFlux, justims0, subimgs, damp, alphas, Nsky,
+                    mindlnp, shared_params, use_tsnnls)
+
+        if variance and getattr(result, 'IVmatrix', None) is not None:
+            # The diagonal of the normal matrix
+            IV = result.IVmatrix.diagonal()
+            if not (sky and skyvariance):
+                IV = IV[Nsky:]
+            result.IV = IV
+        elif variance:
             # Inverse variance
             t0 = Time()
             result.IV = self._get_iv(sky, skyvariance, Nsky, skyderivs, srcs,
@@ -1571,6 +2295,136 @@ class Tractor(MultiParams):
         return result
 
 
+    def optimize_forced_photometry_tiled(self, tilesize=256, margin=16,
+                                         **kwargs):
+        '''
+        Forced photometry of a large image, tile by tile, so that
+        memory use is bounded by the tile size rather than the image
+        size.
+
+        The image is cut into *tilesize* x *tilesize* pixel tiles.
+        Each source is fit in the tile that contains its centre (or
+        the nearest tile, for sources off the image), using the pixels
+        of the tile plus a *margin* on each side.  Sources with centres
+        within *margin* of that region are included in the model with
+        their fluxes fixed.  *margin* should therefore be about the
+        radius of the source models.
+
+        The tiles are independent: every tile sees the neighbouring
+        sources at their fluxes before this call, and the fluxes are
+        all updated at the end.  In multiprocessing mode the tiles are
+        fit in parallel.
+
+        Other arguments are passed to optimize_forced_photometry() for
+        each tile; fitting the sky, fitstats and the returned images
+        are not supported.
+
+        Returns an "OptResult" duck with fields:
+
+        .IV       (if variance=True): for the thawed source parameters
+        .ntiles   number of tiles fit
+        .converged (if direct=True): whether all the tiles converged
+        '''
+        from basics import ShiftedWcs, ShiftedPsf, ShiftedSky
+
+        assert(self.getNImages() == 1)
+        assert(self.isParamFrozen('images'))
+        assert(not kwargs.get('sky', False))
+        assert(not kwargs.get('fitstats', False))
+        kwargs.update(wantims=False)
+
+        img = self.getImage(0)
+        (H,W) = img.shape
+        wcs = img.getWcs()
+        nx = max(1, int(ceil(W / float(tilesize))))
+        ny = max(1, int(ceil(H / float(tilesize))))
+
+        # Source centres, and the tile that owns each thawed source.
+        thawed = set(self.catalog.getThawedParamIndices())
+        xy = []
+        owner = []
+        for i,src in enumerate(self.catalog):
+            x,y = wcs.positionToPixel(src.getPosition(), src)
+            xy.append((x,y))
+            if i in thawed:
+                tx = int(np.clip(np.floor((x + 0.5) / tilesize), 0, nx-1))
+                ty = int(np.clip(np.floor((y + 0.5) / tilesize), 0, ny-1))
+                owner.append((ty, tx))
+            else:
+                owner.append(None)
+        xy = np.array(xy).reshape((-1,2))
+
+        def tiles():
+            for ty in range(ny):
+                for tx in range(nx):
+                    own = [i for i,o in enumerate(owner) if o == (ty,tx)]
+                    if len(own) == 0:
+                        continue
+                    x0 = max(0, tx * tilesize - margin)
+                    x1 = min(W, (tx+1) * tilesize + margin)
+                    y0 = max(0, ty * tilesize - margin)
+                    y1 = min(H, (ty+1) * tilesize + margin)
+                    near = np.flatnonzero((xy[:,0] >= x0 - margin) *
+                                          (xy[:,0] < x1 + margin) *
+                                          (xy[:,1] >= y0 - margin) *
+                                          (xy[:,1] < y1 + margin))
+                    near = [i for i in near if owner[i] != (ty,tx)]
+                    roi = (slice(y0, y1), slice(x0, x1))
+                    subimg = Image(data=img.getImage()[roi],
+                                   inverr=img.getInvError()[roi],
+                                   psf=ShiftedPsf(img.getPsf(), x0, y0),
+                                   wcs=ShiftedWcs(wcs, x0, y0),
+                                   sky=ShiftedSky(img.getSky(), x0, y0,
+                                                  img.shape),
+                                   photocal=img.getPhotoCal(),
+                                   name=img.name)
+                    cat = [self.catalog[i].copy() for i in own + near]
+                    tr = Tractor([subimg], cat)
+                    self._copyOptionsTo(tr)
+                    tr.freezeParam('images')
+                    for j in range(len(own), len(cat)):
+                        tr.catalog.freezeParam(j)
+                    yield own, (tr, len(own), kwargs)
+
+        # Parameter offsets of the thawed sources
+        offsets = {}
+        n = 0
+        for i in self.catalog.getThawedParamIndices():
+            offsets[i] = n
+            n += self.catalog[i].numberOfParams()
+
+        result = OptResult()
+        variance = kwargs.get('variance', False)
+        if variance:
+            result.IV = np.zeros(n)
+        owns = []
+        if self.is_multiproc():
+            args = []
+            for own,arg in tiles():
+                owns.append(own)
+                args.append(arg)
+            fits = self._map(getforcedphottile, args)
+        else:
+            fits = []
+            for own,arg in tiles():
+                owns.append(own)
+                fits.append(getforcedphottile(arg))
+        convs = []
+        for own,(params,IV,conv) in zip(owns, fits):
+            if conv is not None:
+                convs.append(conv)
+            k = 0
+            for i,p in zip(own, params):
+                self.catalog[i].setParams(p)
+                if variance:
+                    result.IV[offsets[i]: offsets[i] + len(p)] = IV[k: k+len(p)]
+                k += len(p)
+        result.ntiles = len(owns)
+        if len(convs):
+            result.converged = all(convs)
+        return result
+
+    @_profiled
     def optimize(self, alphas=None, damp=0, priors=True, scale_columns=True,
                  shared_params=True, variance=False, just_variance=False):
         '''
@@ -1634,6 +2488,257 @@ class Tractor(MultiParams):
             return dlogprob, X, alpha, var
         return dlogprob, X, alpha
 
+    @_profiled
+    def optimize_loop(self, dlnp=1e-3, steps=50, priors=True,
+                      shared_params=True, damp0=0.1, maxdamp=1e6):
+        '''
+        Optimizes the thawed parameters with an adaptive-damping
+        (Levenberg-Marquardt, trust-region) method, until a step
+        improves the log-prob by less than *dlnp*, *steps* steps have
+        been taken, or the damping exceeds *maxdamp*.
+
+        Each step computes the derivatives, finds the update direction
+        with the current damping (the LSQR *damp*; the columns are
+        scaled to unit norm), and compares the actual change in the
+        log-prob with the change predicted by the linearized model.
+        Steps that make things worse are rejected and retried with more
+        damping, re-using the derivatives; good agreement reduces the
+        damping, down to zero (Gauss-Newton steps).  Each trial step
+        costs one model evaluation, instead of the line search of
+        optimize().
+
+        Returns a dict with:
+          'steps': number of steps accepted
+          'dlnp': total change in the log-prob
+          'hit_limit': True if it stopped because of *steps*
+          'nevals': number of model evaluations
+          'stats': one dict per trial step, with 'dlnp' (actual),
+                   'pred' (predicted), 'rho' (their ratio), 'damp',
+                   'accepted', and 'time'
+        '''
+        def logprob(chis):
+            lnprior = 0.
+            if priors:
+                lnprior = self.getLogPrior()
+            if lnprior == -np.inf:
+                return lnprior
+            chisq = sum([(chi.astype(float)**2).sum() for chi in chis])
+            lnp = lnprior - 0.5 * chisq
+            if not np.isfinite(lnp):
+                return -np.inf
+            return lnp
+
+        chis = self.getChiImages()
+        nevals = 1
+        lnp0 = lnp = logprob(chis)
+        damp = 0.
+        stats = []
+        nsteps = 0
+        hit_limit = True
+        allderivs = None
+        while nsteps < steps:
+            t0 = time.time()
+            if allderivs is None:
+                allderivs = self.getDerivs()
+            X = self.getUpdateDirection(allderivs, damp=damp, priors=priors,
+                                        shared_params=shared_params,
+                                        chiImages=chis)
+            if X is None or len(X) == 0:
+                hit_limit = False
+                break
+            p0 = self.getParams()
+            lnprior0 = 0.
+            if priors:
+                lnprior0 = self.getLogPrior()
+            self.setParams([p + x for p,x in zip(p0, X)])
+            pred = self._predictedDlnp(allderivs, X, chis)
+            if priors:
+                pred += self.getLogPrior() - lnprior0
+            newchis = self.getChiImages()
+            nevals += 1
+            newlnp = logprob(newchis)
+            actual = newlnp - lnp
+            if pred > 0:
+                rho = actual / pred
+            else:
+                rho = 0.
+            accepted = (actual > 0)
+            stats.append(dict(dlnp=actual, pred=pred, rho=rho, damp=damp,
+                              accepted=accepted, time=time.time()-t0))
+            logverb('optimize_loop: damp', damp, 'dlnp', actual,
+                    'predicted', pred, 'rho', rho)
+            if accepted:
+                nsteps += 1
+                lnp = newlnp
+                chis = newchis
+                allderivs = None
+                if rho > 0.75:
+                    damp /= 3.
+                    if damp < damp0:
+                        damp = 0.
+                elif rho < 0.25:
+                    damp = max(damp * 2., damp0)
+                if actual < dlnp:
+                    hit_limit = False
+                    break
+            else:
+                self.setParams(p0)
+                damp = max(damp * 4., damp0)
+                if damp > maxdamp:
+                    hit_limit = False
+                    break
+        return dict(steps=nsteps, dlnp=lnp - lnp0, hit_limit=hit_limit,
+                    nevals=nevals, stats=stats)
+
+    def optimize_blobs(self, minsb=0., margin=8, **kwargs):
+        '''
+        Optimizes the thawed sources blob by blob: groups of sources
+        whose models overlap above surface brightness *minsb* in any
+        image (see getOverlappingSources(fullImage=False)) are fit
+        independently, each with its own Tractor on sub-images cut
+        around the blob (plus *margin* pixels), by optimize_loop().
+        Other arguments are passed to optimize_loop().
+
+        In multiprocessing mode the blobs are fit in parallel, the most
+        expensive (pixels times parameters) first, so that the big
+        blobs do not end up running alone at the end.  The fit
+        parameters are copied back into this catalog.
+
+        As with optimize_forced_photometry_tiled(), the images must be
+        frozen; the sub-images wrap the PSF, WCS and sky of the full
+        images (ShiftedPsf, ShiftedWcs, ShiftedSky).
+
+        Returns a dict with:
+          'blobs': list of lists of source indices, in the order fit
+          'results': the optimize_loop() result for each blob
+          'dlnp': sum of the blobs' changes in log-prob
+        '''
+        from basics import ShiftedWcs, ShiftedPsf, ShiftedSky
+        from .blobs import UnionFind, find_overlapping_groups, _maskExtent
+
+        assert(self.isParamFrozen('images'))
+        srcs = list(self.catalog)
+        thawed = set(self.catalog.getThawedParamIndices())
+        uf = UnionFind(len(srcs))
+        extents = []
+        for img in self.getImages():
+            masks = self._getSourceMasks(img, srcs, minsb)
+            for g in find_overlapping_groups(masks):
+                for i in g[1:]:
+                    uf.union(g[0], i)
+            extents.append([_maskExtent(m) for m in masks])
+
+        blobs = []
+        for blob in uf.groups():
+            if not any([i in thawed for i in blob]):
+                continue
+            rois = []
+            npix = 0
+            for img,ext in zip(self.getImages(), extents):
+                ext = [ext[i] for i in blob if ext[i] is not None]
+                if len(ext) == 0:
+                    rois.append(None)
+                    continue
+                H,W = img.getShape()
+                x0 = max(0, min([e[0] for e in ext]) - margin)
+                x1 = min(W, max([e[1] for e in ext]) + margin)
+                y0 = max(0, min([e[2] for e in ext]) - margin)
+                y1 = min(H, max([e[3] for e in ext]) + margin)
+                rois.append((x0,x1,y0,y1))
+                npix += (x1 - x0) * (y1 - y0)
+            if npix == 0:
+                continue
+            nparams = sum([srcs[i].numberOfParams() for i in blob
+                           if i in thawed])
+            blobs.append((npix * nparams, blob, rois))
+        # largest first
+        blobs.sort(key=lambda b: -b[0])
+
+        args = []
+        for cost,blob,rois in blobs:
+            subimgs = []
+            for img,roi in zip(self.getImages(), rois):
+                if roi is None:
+                    continue
+                (x0,x1,y0,y1) = roi
+                sl = (slice(y0, y1), slice(x0, x1))
+                subimgs.append(Image(data=img.getImage()[sl],
+                                     inverr=img.getInvError()[sl],
+                                     psf=ShiftedPsf(img.getPsf(), x0, y0),
+                                     wcs=ShiftedWcs(img.getWcs(), x0, y0),
+                                     sky=ShiftedSky(img.getSky(), x0, y0,
+                                                    img.shape),
+                                     photocal=img.getPhotoCal(),
+                                     name=img.name))
+            tr = Tractor(subimgs, [srcs[i].copy() for i in blob])
+            self._copyOptionsTo(tr)
+            tr.freezeParam('images')
+            for j,i in enumerate(blob):
+                if not i in thawed:
+                    tr.catalog.freezeParam(j)
+            args.append((tr, kwargs))
+
+        if self.is_multiproc():
+            # one blob at a time, so the pool works through them in order
+            fits = self.mp.map(getblobfit, args, chunksize=1)
+        else:
+            fits = [getblobfit(a) for a in args]
+
+        R = dict(blobs=[], results=[], dlnp=0.)
+        for (cost,blob,rois),(params,r) in zip(blobs, fits):
+            for i,p in zip(blob, params):
+                if i in thawed:
+                    srcs[i].setParams(p)
+            R['blobs'].append(blob)
+            R['results'].append(r)
+            R['dlnp'] += r['dlnp']
+        return R
+
+    def _predictedDlnp(self, allderivs, X, chis):
+        '''
+        Returns the change in log-likelihood predicted by the
+        linearized model, for a step *X* in the parameters, given the
+        derivatives *allderivs* and the current *chis* (one per image).
+        '''
+        # Change in model, within the bounding box of the derivatives
+        # in each image.
+        boxes = {}
+        order = []
+        for x,param in zip(X, allderivs):
+            for (deriv, img) in param:
+                if deriv.patch is None or x == 0:
+                    continue
+                (x0,x1,y0,y1) = deriv.getExtent()
+                b = boxes.get(img, None)
+                if b is None:
+                    order.append(img)
+                    boxes[img] = [x0,x1,y0,y1]
+                else:
+                    boxes[img] = [min(x0,b[0]), max(x1,b[1]),
+                                  min(y0,b[2]), max(y1,b[3])]
+        dmods = {}
+        for img in order:
+            (x0,x1,y0,y1) = boxes[img]
+            dmods[img] = Patch(x0, y0, np.zeros((y1-y0, x1-x0)))
+        for x,param in zip(X, allderivs):
+            for (deriv, img) in param:
+                if deriv.patch is None or x == 0:
+                    continue
+                d = dmods[img]
+                d.patch[deriv.y0 - d.y0 : deriv.y1 - d.y0,
+                        deriv.x0 - d.x0 : deriv.x1 - d.x0] += x * deriv.patch
+        chimap = dict([(img, chi) for img,chi in zip(self.getImages(), chis)])
+        dlnl = 0.
+        for img in order:
+            d = dmods[img]
+            (H,W) = img.shape
+            if not d.clipTo(W, H):
+                continue
+            slc = d.getSlice(img)
+            dchi = d.patch * img.getInvError()[slc]
+            dlnl += np.sum(chimap[img][slc] * dchi) - 0.5 * np.sum(dchi**2)
+        return dlnl
+
     def getParameterScales(self):
         print self.getName()+': Finding derivs...'
         allderivs = self.getDerivs()
@@ -1641,35 +2746,74 @@ class Tractor(MultiParams):
         s = self.getUpdateDirection(allderivs, scales_only=True)
         return s
 
-    def tryUpdates(self, X, alphas=None):
+    @_timedStage('linesearch')
+    def tryUpdates(self, X, alphas=None, lineSearch=None):
+        '''
+        Line search: steps the parameters by *alpha* times the update
+        direction *X*, for the step sizes *alphas*, and keeps the best.
+
+        *lineSearch* (default: self.lineSearch) selects how:
+
+        - 'grid': tries the *alphas* in order, stopping when the
+          log-prob gets worse.
+        - 'parallel': like 'grid', but evaluates all the *alphas* at
+          once in the multiprocessing pool.  Same result as 'grid'.
+        - 'quadratic': tries alpha = 1 and 1/2, fits a parabola to the
+          log-prob, and tries its peak (clipped to the range of
+          *alphas*) unless it is close to one already tried.  Costs
+          two or three log-prob evaluations instead of up to
+          len(alphas).
+
+        Returns (delta-logprob, alpha); alpha = 0 if no step improved
+        the log-prob, in which case the parameters are unchanged.
+        '''
         if alphas is None:
             # 1/1024 to 1 in factors of 2, + sqrt(2.) + 2.
             alphas = np.append(2.**np.arange(-10, 1), [np.sqrt(2.), 2.])
+        if lineSearch is None:
+            lineSearch = self.lineSearch
 
         pBefore = self.getLogProb()
         logverb('  log-prob before:', pBefore)
-        pBest = pBefore
-        alphaBest = None
         p0 = self.getParams()
-        for alpha in alphas:
-            logverb('  Stepping with alpha =', alpha)
-            pa = [p + alpha * d for p,d in zip(p0, X)]
-            self.setParams(pa)
-            pAfter = self.getLogProb()
-            logverb('  Log-prob after:', pAfter)
-            logverb('  delta log-prob:', pAfter - pBefore)
 
-            if not np.isfinite(pAfter):
-                logmsg('  Got bad log-prob', pAfter)
-                break
+        if lineSearch == 'quadratic':
+            (pBest, alphaBest) = self._quadraticLineSearch(X, alphas, p0,
+                                                           pBefore)
+        elif lineSearch in ['grid', 'parallel']:
+            pa = [[p + alpha * d for p,d in zip(p0, X)] for alpha in alphas]
+            if lineSearch == 'parallel' and self._useWorkerState():
+                path = self._getWorkerState()
+                pAfters = self._map(getworkerlogprob, [(path, p) for p in pa])
+            elif lineSearch == 'parallel' and self.is_multiproc():
+                pAfters = self._map(getlogprobstep, [(self, p) for p in pa])
+            else:
+                pAfters = None
+            pBest = pBefore
+            alphaBest = None
+            for i,alpha in enumerate(alphas):
+                logverb('  Stepping with alpha =', alpha)
+                if pAfters is None:
+                    self.setParams(pa[i])
+                    pAfter = self.getLogProb()
+                else:
+                    pAfter = pAfters[i]
+                logverb('  Log-prob after:', pAfter)
+                logverb('  delta log-prob:', pAfter - pBefore)
 
-            if pAfter < (pBest - 1.):
-                break
+                if not np.isfinite(pAfter):
+                    logmsg('  Got bad log-prob', pAfter)
+                    break
+
+                if pAfter < (pBest - 1.):
+                    break
+
+                if pAfter > pBest:
+                    alphaBest = alpha
+                    pBest = pAfter
+        else:
+            raise RuntimeError('Unknown line search: "%s"' % lineSearch)
 
-            if pAfter > pBest:
-                alphaBest = alpha
-                pBest = pAfter
-        
         # if alphaBest is None or alphaBest == 0:
         #     print "Warning: optimization is borking"
         #     print "Parameter direction =",X
@@ -1685,6 +2829,57 @@ class Tractor(MultiParams):
         self.setParams(pa)
         return pBest - pBefore, alphaBest
 
+    def _quadraticLineSearch(self, X, alphas, p0, pBefore):
+        '''
+        The 'quadratic' line search for tryUpdates(); returns (best
+        log-prob, best alpha or None).
+        '''
+        amin = np.min(alphas)
+        amax = np.max(alphas)
+        tried = {}
+        def lnp(alpha):
+            logverb('  Stepping with alpha =', alpha)
+            self.setParams([p + alpha * d for p,d in zip(p0, X)])
+            pAfter = self.getLogProb()
+            logverb('  Log-prob after:', pAfter)
+            if not np.isfinite(pAfter):
+                pAfter = -np.inf
+            tried[alpha] = pAfter
+            return pAfter
+
+        # The linearized least-squares step is alpha = 1.  If the
+        # log-prob there is bad, back off until it is finite.
+        a1 = min(1., amax)
+        p1 = lnp(a1)
+        while not np.isfinite(p1) and a1 / 2. >= amin:
+            a1 /= 2.
+            p1 = lnp(a1)
+        if np.isfinite(p1):
+            ah = a1 / 2.
+            ph = lnp(ah)
+            # Parabola through (0, pBefore), (ah, ph), (a1, p1):
+            # lnp(alpha) = pBefore + b * alpha + c * alpha**2
+            c = (p1 - 2.*ph + pBefore) / (2. * ah**2)
+            b = (ph - pBefore) / ah - c * ah
+            if c < 0:
+                astar = np.clip(-b / (2. * c), amin, amax)
+            elif p1 > ph:
+                # still going up
+                astar = amax
+            else:
+                astar = None
+            if astar is not None and np.isfinite(astar):
+                near = [abs(astar - a) <= 0.1 * astar for a in tried.keys()]
+                if not any(near):
+                    lnp(astar)
+
+        pBest = pBefore
+        alphaBest = None
+        for alpha,pAfter in tried.items():
+            if pAfter > pBest:
+                pBest = pAfter
+                alphaBest = alpha
+        return pBest, alphaBest
 
     def getDerivs(self):
         '''
@@ -1758,13 +2953,26 @@ class Tractor(MultiParams):
 
             # Next, derivs for the sources.
             args = []
-            for j,src in enumerate(srcs):
-                for i,img in enumerate(self.images):
-                    args.append((src, img))
+            if self._useWorkerState():
+                path = self._getWorkerState()
+                params = self.getParams()
+                js = []
+                if not self.isParamFrozen('catalog'):
+                    js = [j for j in self.catalog.getThawedParamIndices()
+                          if self.catalog[j] is not None]
+                for j in js:
+                    for i in range(len(self.images)):
+                        args.append((path, params, j, i))
+                func = getworkersrcderivs
+            else:
+                for j,src in enumerate(srcs):
+                    for i,img in enumerate(self.images):
+                        args.append((src, img))
+                func = getsrcderivs
 
             # if modelMasks are set, need to send those across the multiprocessing...
             assert(self.modelMasks is None)
-            sderivs = self._map_async(getsrcderivs, reversed(args))
+            sderivs = self._map_async(func, reversed(args))
     
             # Wait for and unpack the image derivatives...
             mod0s = mod0s.get()
@@ -1870,13 +3078,17 @@ class Tractor(MultiParams):
                            shared_params=True,
                            use_tsnnls=False,
                            use_ceres=False,
-                           get_A_matrix=False):
+                           get_A_matrix=False,
+                           matrix_free=None):
         #
         # Returns: numpy array containing update direction.
         # If *variance* is True, return    (update,variance)
         # If *get_A_matrix* is True, returns the sparse matrix of derivatives.
         # If *scale_only* is True, return column scalings
         # In cases of an empty matrix, returns the list []
+        # If *matrix_free* is True (default: self.matrixFree), LSQR
+        # works on the derivative patches directly rather than on a
+        # sparse matrix built from them.
         #
         # allderivs: [
         #    (param0:)  [  (deriv, img), (deriv, img), ... ],
@@ -1901,7 +3113,8 @@ class Tractor(MultiParams):
         #          = + (derivs) * inverr
 
         # Parameters to optimize go in the columns of matrix A
-        # Pixels go in the rows.
+        # Pixels go in the rows -- only the pixels that are touched by
+        # some derivative patch; the others would be empty rows.
 
         if shared_params:
             # Find shared parameters
@@ -1915,196 +3128,181 @@ class Tractor(MultiParams):
             #print 'paramindexmap:', paramindexmap
             #print 'p1:', p1
             
-        # Build the sparse matrix of derivatives:
-        sprows = []
-        spcols = []
-        spvals = []
-
-        # Keep track of row offsets for each image.
-        imgoffs = {}
-        nextrow = 0
-        for param in allderivs:
-            for deriv,img in param:
-                if img in imgoffs:
-                    continue
-                imgoffs[img] = nextrow
-                #print 'Putting image', img.name, 'at row offset', nextrow
-                nextrow += img.numberOfPixels()
-        Nrows = nextrow
-        del nextrow
-        Ncols = len(allderivs)
-
-        # FIXME -- shared_params should share colscales!
-        
-        colscales = np.ones(len(allderivs))
-        for col, param in enumerate(allderivs):
-            RR = []
-            VV = []
-            WW = []
-            for (deriv, img) in param:
-                inverrs = img.getInvError()
-                (H,W) = img.shape
-                row0 = imgoffs[img]
-                deriv.clipTo(W, H)
-                pix = deriv.getPixelIndices(img)
-                if len(pix) == 0:
-                    #print 'This param does not influence this image!'
-                    continue
-
-                assert(np.all(pix < img.numberOfPixels()))
-                # (grab non-zero indices)
-                dimg = deriv.getImage()
-                nz = np.flatnonzero(dimg)
-                #print '  source', j, 'derivative', p, 'has', len(nz), 'non-zero entries'
-                if len(nz) == 0:
-                    continue
-                rows = row0 + pix[nz]
-                #print 'Adding derivative', deriv.getName(), 'for image', img.name
-                vals = dimg.flat[nz]
-                w = inverrs[deriv.getSlice(img)].flat[nz]
-                assert(vals.shape == w.shape)
-                #if not scales_only:
-                RR.append(rows)
-                VV.append(vals)
-                WW.append(w)
-
-            # massage, re-scale, and clean up matrix elements
-            if len(VV) == 0:
-                continue
-            rows = np.hstack(RR)
-            VV = np.hstack(VV)
-            WW = np.hstack(WW)
-            #vals = np.hstack(VV) * np.hstack(WW)
-            #print 'VV absmin:', np.min(np.abs(VV))
-            #print 'WW absmin:', np.min(np.abs(WW))
-            #print 'VV type', VV.dtype
-            #print 'WW type', WW.dtype
-            vals = VV * WW
-            #print 'vals absmin:', np.min(np.abs(vals))
-            #print 'vals absmax:', np.max(np.abs(vals))
-            #print 'vals type', vals.dtype
-
-            # shouldn't be necessary since we check len(nz)>0 above
-            #if len(vals) == 0:
-            #   continue
-            mx = np.max(np.abs(vals))
-            if mx == 0:
-                logmsg('mx == 0:', len(np.flatnonzero(VV)), 'of', len(VV), 'non-zero derivatives,',
-                       len(np.flatnonzero(WW)), 'of', len(WW), 'non-zero weights;',
-                       len(np.flatnonzero(vals)), 'non-zero products')
-                continue
-            # MAGIC number: near-zero matrix elements -> 0
-            # 'mx' is the max value in this column.
-            FACTOR = 1.e-10
-            I = (np.abs(vals) > (FACTOR * mx))
-            rows = rows[I]
-            vals = vals[I]
-            scale = np.sqrt(np.dot(vals, vals))
-            colscales[col] = scale
-            #logverb('Column', col, 'scale:', scale)
-            if scales_only:
-                continue
-
-            sprows.append(rows)
-            spcols.append(col)
-            #c = np.empty_like(rows)
-            #c[:] = col
-            #spcols.append(c)
-            if scale_columns:
-                if scale == 0.:
-                    spvals.append(vals)
-                else:
-                    spvals.append(vals / scale)
-            else:
-                spvals.append(vals)
-                
-        if scales_only:
-            return colscales
+        if shared_params:
+            # Shared parameters map to the same column.
+            Ncols = len(U)
+            colmap = paramindexmap
+        else:
+            Ncols = len(allderivs)
+            colmap = np.arange(Ncols)
+        logverb('Set Ncols=', Ncols)
 
-        b = None
-        if priors:
+        pderivs = None
+        Nprior = 0
+        if priors and not scales_only:
             # We don't include the priors in the "colscales"
-            # computation above, mostly because the priors are
+            # computation below, mostly because the priors are
             # returned as sparse additions to the matrix, and not
             # necessarily column-oriented the way the other params
             # are.  It would be possible to make it work, but dstn is
             # not convinced it's worth the effort right now.
-            X = self.getLogPriorDerivatives()
-            if X is not None:
-                rA,cA,vA,pb = X
+            pderivs = self.getLogPriorDerivatives()
+            if pderivs is not None:
+                rA,cA,vA,pb = pderivs
+                Nprior = listmax(rA, -1) + 1
+
+        if matrix_free is None:
+            matrix_free = self.matrixFree
+        if (matrix_free and not (scales_only or get_A_matrix or use_tsnnls)):
+            if not shared_params:
+                paramindexmap = None
+            with self._stage('solve'):
+                return self._getUpdateDirectionMatrixFree(
+                    allderivs, colmap, Ncols, pderivs, Nprior, damp,
+                    scale_columns, chiImages, variance, paramindexmap)
+
+        # We build the sparse matrix directly in CSC form.  A counting
+        # pass over the (clipped) derivative patches, plus the prior
+        # elements, gives an upper bound on the number of elements in
+        # each column, so the "indices" and "data" arrays are
+        # allocated just once; each column is filled in at its
+        # reserved offset, and the columns are squeezed together once
+        # the near-zero elements have been dropped.
+        with self._stage('matrix'):
+            colsize = np.zeros(Ncols, np.int64)
+            for col, param in enumerate(allderivs):
+                for (deriv, img) in param:
+                    (H,W) = img.shape
+                    deriv.clipTo(W, H)
+                    if deriv.patch is None:
+                        continue
+                    colsize[colmap[col]] += deriv.patch.size
+
+            # Number the rows: the pixels with a non-zero derivative in
+            # any column.
+            imgorder,imgrows,Nrows = _numberDerivativeRows(allderivs)
+            logverb('Rows (pixels):', Nrows, 'of', sum([img.numberOfPixels()
+                                                        for img in imgorder]))
+            if pderivs is not None:
+                for ri,ci in zip(rA, cA):
+                    colsize[colmap[ci]] += len(ri)
+            colstart = np.zeros(Ncols + 1, np.int64)
+            colstart[1:] = np.cumsum(colsize)
+            Nmax = colstart[-1]
+            if max(Nrows + Nprior, Nmax) < 2**31:
+                itype = np.int32
+            else:
+                itype = np.int64
+            spindices = np.empty(Nmax, itype)
+            spdata = np.empty(Nmax, np.float64)
+            # end of the filled part of each column
+            colend = colstart[:-1].copy()
 
-                sprows.extend([ri + Nrows for ri in rA])
-                spcols.extend(cA)
-                spvals.extend([vi / colscales[ci] for vi,ci in zip(vA,cA)])
-                oldnrows = Nrows
-                nr = listmax(rA, -1) + 1
-                Nrows += nr
-                logverb('Nrows was %i, added %i rows of priors => %i' % (oldnrows, nr, Nrows))
-                # if len(cA) == 0:
-                #     Ncols = 0
-                # else:
-                #     Ncols = 1 + max(cA)
+            # FIXME -- shared_params should share colscales!
+        
+            colscales = np.ones(len(allderivs))
+            for col, param in enumerate(allderivs):
+                c = colmap[col]
+                i0 = i = colend[c]
+                for (deriv, img) in param:
+                    # (already clipped in the counting pass)
+                    if deriv.patch is None:
+                        #print 'This param does not influence this image!'
+                        continue
+                    # (grab non-zero indices)
+                    dimg = deriv.getImage()
+                    nz = np.flatnonzero(dimg)
+                    if len(nz) == 0:
+                        continue
+                    inverrs = img.getInvError()
+                    i1 = i + len(nz)
+                    spindices[i:i1] = _derivativeRows(imgrows, img, deriv, nz)
+                    spdata[i:i1] = dimg.flat[nz]
+                    spdata[i:i1] *= inverrs[deriv.getSlice(img)].flat[nz]
+                    i = i1
+
+                # massage, re-scale, and clean up matrix elements
+                if i == i0:
+                    continue
+                vals = spdata[i0:i]
+                mx = np.max(np.abs(vals))
+                if mx == 0:
+                    logmsg('mx == 0:', i - i0, 'derivative * inverse-error products, all zero')
+                    continue
+                # MAGIC number: near-zero matrix elements -> 0
+                # 'mx' is the max value in this column.
+                FACTOR = 1.e-10
+                I = np.flatnonzero(np.abs(vals) > (FACTOR * mx))
+                i = i0 + len(I)
+                if i < i0 + len(vals):
+                    spindices[i0:i] = spindices[i0 + I]
+                    spdata[i0:i] = vals[I]
+                vals = spdata[i0:i]
+                scale = np.sqrt(np.dot(vals, vals))
+                colscales[col] = scale
+                #logverb('Column', col, 'scale:', scale)
+                if scales_only:
+                    continue
 
+                if scale_columns and scale != 0.:
+                    vals /= scale
+                colend[c] = i
+                
+            if scales_only:
+                return colscales
+
+            b = None
+            if pderivs is not None:
+                for ri,ci,vi in zip(rA, cA, vA):
+                    c = colmap[ci]
+                    i0 = colend[c]
+                    i = i0 + len(ri)
+                    spindices[i0:i] = ri + Nrows
+                    spdata[i0:i] = vi / colscales[ci]
+                    colend[c] = i
+                oldnrows = Nrows
+                Nrows += Nprior
+                logverb('Nrows was %i, added %i rows of priors => %i' % (oldnrows, Nprior, Nrows))
                 b = np.zeros(Nrows)
                 b[oldnrows:] = np.hstack(pb)
 
-        if len(spcols) == 0:
-            logverb("len(spcols) == 0")
-            return []
+            # Squeeze out the unused space at the end of each column.
+            colcounts = colend - colstart[:-1]
+            indptr = np.zeros(Ncols + 1, itype)
+            indptr[1:] = np.cumsum(colcounts)
+            Nel = indptr[-1]
+            if Nel == 0:
+                logverb("No sparse matrix elements")
+                return []
+            if Nel < Nmax:
+                for c in np.flatnonzero(colcounts):
+                    i0 = colstart[c]
+                    j0 = indptr[c]
+                    if i0 == j0:
+                        continue
+                    n = colcounts[c]
+                    spindices[j0 : j0+n] = spindices[i0 : i0+n]
+                    spdata   [j0 : j0+n] = spdata   [i0 : i0+n]
+                spindices = spindices[:Nel]
+                spdata = spdata[:Nel]
+            ucols = np.flatnonzero(colcounts)
+
+            # b = chi, computed just within the bounding box of the
+            # derivatives in each image.
+            if b is None:
+                b = np.zeros(Nrows)
 
-        # 'spcols' has one integer per 'sprows' block.
-        # below we hstack the rows, but before doing that, remember how
-        # many rows are in each chunk.
-        spcols = np.array(spcols)
-        nrowspercol = np.array([len(x) for x in sprows])
-        
-        if shared_params:
-            # Apply shared parameter map
-            #print 'Before applying shared parameter map:'
-            #print 'spcols:', len(spcols), 'elements'
-            #print '  ', len(set(spcols)), 'unique'
-            spcols = paramindexmap[spcols]
-            #print 'After:'
-            #print 'spcols:', len(spcols), 'elements'
-            #print '  ', len(set(spcols)), 'unique'
-            Ncols = np.max(spcols) + 1
-            logverb('Set Ncols=', Ncols)
-
-        # b = chi
-        #
-        # FIXME -- we could be much smarter here about computing
-        # just the regions we need!
-        #
-        if b is None:
-            b = np.zeros(Nrows)
+            chimap = {}
+            if chiImages is not None:
+                for img,chi in zip(self.getImages(), chiImages):
+                    chimap[img] = chi
 
-        chimap = {}
-        if chiImages is not None:
-            for img,chi in zip(self.getImages(), chiImages):
-                chimap[img] = chi
-
-        ## FIXME -- could compute just chi ROIs here.
-                
-        # iterating this way avoids setting the elements more than once
-        for img,row0 in imgoffs.items():
-            chi = chimap.get(img, None)
-            if chi is None:
-                #print 'computing chi image'
-                chi = self.getChiImage(img=img)
-            chi = chi.ravel()
-            NP = len(chi)
-            # we haven't touched these pix before
-            assert(np.all(b[row0 : row0 + NP] == 0))
-            assert(np.all(np.isfinite(chi)))
-            #print 'Setting [%i:%i) from chi img' % (row0, row0+NP)
-            b[row0 : row0 + NP] = chi
-        ###### Zero out unused rows -- FIXME, is this useful??
-        # print 'Nrows', Nrows, 'vs len(urows)', len(urows)
-        # bnz = np.zeros(Nrows)
-        # bnz[urows] = b[urows]
-        # print 'b', len(b), 'vs bnz', len(bnz)
-        # b = bnz
-        assert(np.all(np.isfinite(b)))
+            for img in imgorder:
+                R = imgrows[img]
+                chi = self._getChiRows(img, R, chimap.get(img, None))
+                assert(np.all(np.isfinite(chi)))
+                b[R['row0'] : R['row0'] + R['nrows']] = chi
+            assert(np.all(np.isfinite(b)))
 
         use_lsqr = True
 
@@ -2115,112 +3313,52 @@ class Tractor(MultiParams):
         if use_tsnnls:
             use_lsqr = False
             from tsnnls import tsnnls_lsqr
-            #logmsg('TSNNLS: %i cols (%i unique), %i elements' %
-            #       (Ncols, len(ucols), len(spvals)))
-            print 'spcols:', spcols.shape, spcols.dtype
-            #print 'spvals:', spvals.shape, spvals.dtype
-            print 'spvals:', len(spvals), 'chunks'
-            print '  total', sum(len(x) for x in spvals), 'elements'
-            print 'b:', b.shape, b.dtype
-            #print 'sprows:', sprows.shape, sprows.dtype
-            print 'sprows:', len(sprows), 'chunks'
-            print '  total', sum(len(x) for x in sprows), 'elements'
-
-            ucols,colI = np.unique(spcols, return_inverse=True)
-            J = np.argsort(colI)
-
-            sorted_cols = colI[J]
-            nel = [len(sprows[j]) for j in J]
-            sorted_rows = np.hstack([sprows[j].astype(np.int32) for j in J])
-            sorted_vals = np.hstack([spvals[j] for j in J])
-            #Nelements = sum(len(x) for x in spvals)
-            Nelements = sum(nel)
-            
-            colinds = np.zeros(len(ucols)+1, np.int32)
-            for c,n in zip(sorted_cols, nel):
-                colinds[c+1] += n
-            colinds = np.cumsum(colinds).astype(np.int32)
-            assert(colinds[-1] == Nelements)
-            #colinds = colinds[:-1]
-            
-            # print 'sorted_cols:', sorted_cols
-            # print 'column inds:', colinds
-            # print 'sorted_rows:', sorted_rows
-            # print 'sorted_vals:', sorted_vals
+            # The CSC arrays are what tsnnls wants, once empty columns
+            # are dropped.
+            colinds = np.append(indptr[ucols], Nel).astype(np.int32)
             print 'colinds:', colinds.shape, colinds.dtype
-            print 'rows:', sorted_rows.shape, sorted_rows.dtype
-            print 'vals:', sorted_vals.shape, sorted_vals.dtype
+            print 'rows:', spindices.shape, spindices.dtype
+            print 'vals:', spdata.shape, spdata.dtype
 
-            # compress b and rows?
-            urows,K = np.unique(sorted_rows, return_inverse=True)
+            # compress b and rows
+            urows,K = np.unique(spindices, return_inverse=True)
             bcomp = b[urows]
             rowcomp = K.astype(np.int32)
-
-            # print 'Compressed rows:', rowcomp
-            # print 'Compressed b:', bcomp
-            # for c,(i0,i1) in enumerate(zip(colinds, colinds[1:])):
-            #     print 'Column', c, 'goes from', i0, 'to', i1
-            #     print 'rows:', rowcomp[i0:i1]
-            #     print 'vals:', sorted_vals[i0:i1]
-            
             nrcomp = len(urows)
             
-            #tsnnls_lsqr(colinds, sorted_rows, sorted_vals,
-            #            b, Nrows, Nelements)
-
-            X = tsnnls_lsqr(colinds, rowcomp, sorted_vals,
-                            bcomp, nrcomp, Nelements)
+            X = tsnnls_lsqr(colinds, rowcomp, spdata,
+                            bcomp, nrcomp, int(Nel))
             print 'Got TSNNLS result:', X
 
             # Undo the column mappings
-            X2 = np.zeros(len(allderivs))
-            #X2[colI] = X
+            X2 = np.zeros(Ncols)
             X2[ucols] = X
             X = X2
             del X2
             
         if use_lsqr:
-            from scipy.sparse import csr_matrix, csc_matrix
+            from scipy.sparse import csc_matrix
             from scipy.sparse.linalg import lsqr
 
-            spvals = np.hstack(spvals)
-            if not np.all(np.isfinite(spvals)):
+            if not np.all(np.isfinite(spdata)):
                 print 'Warning: infinite derivatives; bailing out'
                 return None
-            assert(np.all(np.isfinite(spvals)))
-    
-            sprows = np.hstack(sprows) # hogg's lovin' hstack *again* here
-            assert(len(sprows) == len(spvals))
-                
-            # For LSQR, expand 'spcols' to be the same length as 'sprows'.
-            cc = np.empty(len(sprows))
-            i = 0
-            for c,n in zip(spcols, nrowspercol):
-                cc[i : i+n] = c
-                i += n
-            spcols = cc
-            assert(i == len(sprows))
-            assert(len(sprows) == len(spcols))
-
-            logverb('  Number of sparse matrix elements:', len(sprows))
-            urows = np.unique(sprows)
-            ucols = np.unique(spcols)
-            logverb('  Unique rows (pixels):', len(urows))
-            logverb('  Unique columns (params):', len(ucols))
-            if len(urows) == 0 or len(ucols) == 0:
-                return []
-            logverb('  Max row:', urows[-1])
-            logverb('  Max column:', ucols[-1])
-            logverb('  Sparsity factor (possible elements / filled elements):', float(len(urows) * len(ucols)) / float(len(sprows)))
+
+            logverb('  Number of sparse matrix elements:', Nel)
+            if isverbose():
+                urows = np.unique(spindices)
+                logverb('  Unique rows (pixels):', len(urows))
+                logverb('  Unique columns (params):', len(ucols))
+                logverb('  Max row:', urows[-1])
+                logverb('  Max column:', ucols[-1])
+                logverb('  Sparsity factor (possible elements / filled elements):', float(len(urows) * len(ucols)) / float(Nel))
             
             # FIXME -- does it make LSQR faster if we remap the row and column
             # indices so that no rows/cols are empty?
     
-            # FIXME -- we could probably construct the CSC matrix ourselves!
-    
             # Build sparse matrix
-            #A = csc_matrix((spvals, (sprows, spcols)), shape=(Nrows, Ncols))
-            A = csr_matrix((spvals, (sprows, spcols)), shape=(Nrows, Ncols))
+            A = csc_matrix((spdata, spindices, indptr), shape=(Nrows, Ncols))
+            del spdata, spindices
 
             if get_A_matrix:
                 return A
@@ -2231,7 +3369,7 @@ class Tractor(MultiParams):
     
             # Run lsqr()
             logverb('LSQR: %i cols (%i unique), %i elements' %
-                   (Ncols, len(ucols), len(spvals)-1))
+                   (Ncols, len(ucols), Nel))
 
             # print 'A matrix:'
             # print A.todense()
@@ -2243,8 +3381,9 @@ class Tractor(MultiParams):
             try:
                 # lsqr can trigger floating-point errors
                 oldsettings = np.seterr(all='print')
-                (X, istop, niters, r1norm, r2norm, anorm, acond,
-                 arnorm, xnorm, var) = lsqr(A, b, **lsqropts)
+                with self._stage('solve'):
+                    (X, istop, niters, r1norm, r2norm, anorm, acond,
+                     arnorm, xnorm, var) = lsqr(A, b, **lsqropts)
             except ZeroDivisionError:
                 print 'ZeroDivisionError caught.  Returning zero.'
                 bail = True
@@ -2270,10 +3409,24 @@ class Tractor(MultiParams):
             # print '  xnorm =', xnorm
             # print '  var =', var
         
+        if not shared_params:
+            paramindexmap = None
+        if not variance:
+            var = None
+        return self._unscaleUpdate(X, var, colscales, paramindexmap,
+                                   scale_columns)
+
+    def _unscaleUpdate(self, X, var, colscales, paramindexmap, scale_columns):
+        '''
+        Maps the solution *X* (and variance *var*, if not None) of the
+        least-squares problem in getUpdateDirection() back to the
+        parameters: undoes the shared-parameter map and the column
+        scaling.
+        '''
         logverb('scaled  X=', X)
         X = np.array(X)
 
-        if shared_params:
+        if paramindexmap is not None:
             # Unapply shared parameter map -- result is duplicated
             # result elements.
             logverb('shared_params: before, X len', len(X), 'with', np.count_nonzero(X), 'non-zero entries')
@@ -2285,8 +3438,8 @@ class Tractor(MultiParams):
             X[colscales > 0] /= colscales[colscales > 0]
         logverb('  X=', X)
 
-        if variance:
-            if shared_params:
+        if var is not None:
+            if paramindexmap is not None:
                 # Unapply shared parameter map.
                 var = var[paramindexmap]
             
@@ -2296,6 +3449,128 @@ class Tractor(MultiParams):
 
         return X
 
+    def _getUpdateDirectionMatrixFree(self, allderivs, colmap, Ncols,
+                                      pderivs, Nprior, damp, scale_columns,
+                                      chiImages, variance, paramindexmap):
+        '''
+        getUpdateDirection() without building the sparse matrix: LSQR
+        is given a LinearOperator whose products work directly on the
+        non-zero derivative * inverse-error values of each patch,
+        applying the column scaling and shared-parameter map on the
+        fly.  Memory use is about that of the derivative patches.
+
+        The rows of the operator are the pixels where some derivative
+        is non-zero, numbered as in the sparse matrix (see
+        _numberDerivativeRows), plus the priors.
+        '''
+        from scipy.sparse.linalg import LinearOperator, lsqr
+
+        for param in allderivs:
+            for (deriv, img) in param:
+                (H,W) = img.shape
+                deriv.clipTo(W, H)
+        imgorder,imgrows,Npix = _numberDerivativeRows(allderivs)
+        Nrows = Npix + Nprior
+
+        # (column, image, derivative patch, non-zero elements, their
+        # rows, derivative * inverse-error at those elements)
+        blocks = []
+        for col, param in enumerate(allderivs):
+            for (deriv, img) in param:
+                if deriv.patch is None:
+                    continue
+                nz = np.flatnonzero(deriv.patch)
+                if len(nz) == 0:
+                    continue
+                rows = _derivativeRows(imgrows, img, deriv, nz)
+                vals = (deriv.patch.flat[nz] *
+                        img.getInvError()[deriv.getSlice(img)].flat[nz])
+                blocks.append((col, img, deriv, nz, rows, vals))
+        if len(blocks) == 0 and Nprior == 0:
+            logverb("No sparse matrix elements")
+            return []
+
+        sumsq = np.zeros(len(allderivs))
+        for (col, img, deriv, nz, rows, vals) in blocks:
+            sumsq[col] += np.dot(vals, vals)
+        if not np.all(np.isfinite(sumsq)):
+            print 'Warning: infinite derivatives; bailing out'
+            return None
+        colscales = np.ones(len(allderivs))
+        colscales[sumsq > 0] = np.sqrt(sumsq[sumsq > 0])
+        if scale_columns:
+            colweights = 1. / colscales
+        else:
+            colweights = np.ones(len(allderivs))
+
+        priorblocks = []
+        if pderivs is not None:
+            rA,cA,vA,pb = pderivs
+            for ri,ci,vi in zip(rA, cA, vA):
+                priorblocks.append((np.asarray(ri) + Npix, colmap[ci],
+                                    np.asarray(vi) / colscales[ci]))
+
+        def matvec(x):
+            x = np.ravel(x)
+            y = np.zeros(Nrows)
+            for (col, img, deriv, nz, rows, vals) in blocks:
+                xc = x[colmap[col]] * colweights[col]
+                if xc == 0:
+                    continue
+                # (the rows of one patch are distinct)
+                y[rows] += xc * vals
+            for (ri, c, vi) in priorblocks:
+                y[ri] += vi * x[c]
+            return y
+
+        def rmatvec(y):
+            y = np.ravel(y)
+            x = np.zeros(Ncols)
+            for (col, img, deriv, nz, rows, vals) in blocks:
+                x[colmap[col]] += colweights[col] * np.dot(vals, y[rows])
+            for (ri, c, vi) in priorblocks:
+                x[c] += np.dot(vi, y[ri])
+            return x
+
+        A = LinearOperator((Nrows, Ncols), matvec=matvec, rmatvec=rmatvec,
+                           dtype=np.float64)
+
+        # b = chi, on the pixels touched by some derivative
+        b = np.zeros(Nrows)
+        chimap = {}
+        if chiImages is not None:
+            for img,chi in zip(self.getImages(), chiImages):
+                chimap[img] = chi
+        for img in imgorder:
+            R = imgrows[img]
+            chi = self._getChiRows(img, R, chimap.get(img, None))
+            assert(np.all(np.isfinite(chi)))
+            b[R['row0'] : R['row0'] + R['nrows']] = chi
+        if pderivs is not None:
+            b[Npix:] = np.hstack(pb)
+
+        lsqropts = dict(show=isverbose(), damp=damp)
+        if variance:
+            lsqropts.update(calc_var=True)
+        logverb('LSQR (matrix-free): %i cols, %i rows, %i patches' %
+                (Ncols, Nrows, len(blocks)))
+        try:
+            oldsettings = np.seterr(all='print')
+            (X, istop, niters, r1norm, r2norm, anorm, acond,
+             arnorm, xnorm, var) = lsqr(A, b, **lsqropts)
+        except ZeroDivisionError:
+            print 'ZeroDivisionError caught.  Returning zero.'
+            np.seterr(**oldsettings)
+            if paramindexmap is not None:
+                return np.zeros(len(paramindexmap))
+            return np.zeros(len(allderivs))
+        np.seterr(**oldsettings)
+
+        if not variance:
+            var = None
+        return self._unscaleUpdate(X, var, colscales, paramindexmap,
+                                   scale_columns)
+
     # def changeInvvar(self, Q2=None):
     #     '''
     #     run one iteration of iteratively reweighting the invvars for IRLS
@@ -2370,7 +3645,11 @@ class Tractor(MultiParams):
             return [None] * src.numberOfParams()
 
         #print 'getting param derivs for', src
-        derivs = src.getParamDerivatives(img, modelMask=mask, **kwargs)
+        with self._stage('derivs', src, img) as t:
+            derivs = src.getParamDerivatives(img, modelMask=mask, **kwargs)
+            if self.stats is not None:
+                t.pixels = sum([d.patch.size for d in derivs
+                                if d is not None and d.patch is not None])
         #print 'done getting param derivs for', src
 
         # HACK -- auto-add?
@@ -2398,7 +3677,10 @@ class Tractor(MultiParams):
         if self.expectModelMasks and mask is None:
             return None
 
-        mod = src.getModelPatch(img, modelMask=mask, **kwargs)
+        with self._stage('render', src, img) as t:
+            mod = src.getModelPatch(img, modelMask=mask, **kwargs)
+            if mod is not None and mod.patch is not None:
+                t.pixels = mod.patch.size
         return mod
     
     def getModelPatch(self, img, src, minsb=None, **kwargs):
@@ -2413,10 +3695,14 @@ class Tractor(MultiParams):
         if mv > minsb:
             mod = None
         if mod is not None:
-            pass
+            if self.stats is not None:
+                self.stats.add('cache', 'hit')
         else:
+            if self.stats is not None:
+                self.stats.add('cache', 'miss')
+            t0 = time.time()
             mod = self.getModelPatchNoCache(img, src, minsb=minsb, **kwargs)
-            self.cache.put(deps, (minsb,mod))
+            self.cache.put(deps, (minsb,mod), cost=time.time()-t0)
 
         # DEBUG
         if mod is not None and mod.patch is not None:
@@ -2433,11 +3719,17 @@ class Tractor(MultiParams):
         '''
         if _isint(img):
             img = self.getImage(img)
+        if (self.incrementalModels and srcs is None and sky and
+            minsb is None):
+            return self._getResidentModel(img)['mod'].astype(self.modtype)
         mod = np.zeros(img.getModelShape(), self.modtype)
         if sky:
             img.getSky().addTo(mod)
         if srcs is None:
             srcs = self.catalog
+        if self.batchModels:
+            self._addModelsBatched(img, srcs, mod, minsb=minsb)
+            return mod
         for src in srcs:
             if src is None:
                 continue
@@ -2447,12 +3739,156 @@ class Tractor(MultiParams):
             patch.addTo(mod)
         return mod
 
-    def getOverlappingSources(self, img, srcs=None, minsb=0.):
+    def _getResidentModel(self, img):
+        '''
+        Returns the resident model of *img* (used when
+        self.incrementalModels is set): a dict with the model image
+        'mod' (float64, including the sky) and its chi-squared
+        'chisq'.
+
+        The model is rebuilt from scratch when the image's hashkey or
+        the list of sources changes; otherwise, only the sources whose
+        hashkeys have changed since the last call are subtracted and
+        re-added, and the chi-squared is updated within their patches.
+        Like the patch cache, this does not notice changes made to
+        the image pixels in place.
+        '''
+        R = self._resident.get(id(img))
+        srcs = [src for src in self.catalog]
+        srcids = [id(src) for src in srcs]
+        keys = [None if src is None else src.hashkey() for src in srcs]
+        # Rebuilding after as many updates as there are sources keeps
+        # round-off from piling up, at constant amortized cost.
+        if (R is None or R['img'] is not img or
+            R['imgkey'] != img.hashkey() or R['srcids'] != srcids or
+            R['nupdates'] > len(srcs)):
+            # forget images that are no longer ours
+            ids = [id(im) for im in self.images]
+            for k in self._resident.keys():
+                if not k in ids:
+                    del self._resident[k]
+            mod = np.zeros(img.getModelShape(), np.float64)
+            img.getSky().addTo(mod)
+            patches = []
+            for src in srcs:
+                patch = None
+                if src is not None:
+                    patch = self.getModelPatch(img, src)
+                if patch is not None:
+                    patch.addTo(mod)
+                patches.append(patch)
+            chisq = np.sum(((img.getImage() - mod) * img.getInvError())**2)
+            R = dict(img=img, imgkey=img.hashkey(), srcids=srcids, keys=keys,
+                     patches=patches, mod=mod, chisq=chisq, nupdates=0)
+            self._resident[id(img)] = R
+            return R
+
+        mod = R['mod']
+        data = img.getImage()
+        ie = img.getInvError()
+        (H,W) = mod.shape
+        for i,(oldkey,key) in enumerate(zip(R['keys'], keys)):
+            if oldkey == key:
+                continue
+            old = R['patches'][i]
+            new = self.getModelPatch(img, srcs[i])
+            R['patches'][i] = new
+            R['keys'][i] = key
+            R['nupdates'] += 1
+            ext = [p.getExtent() for p in [old, new]
+                   if p is not None and p.patch is not None]
+            if len(ext) == 0:
+                continue
+            x0 = max(0, min([e[0] for e in ext]))
+            x1 = min(W, max([e[1] for e in ext]))
+            y0 = max(0, min([e[2] for e in ext]))
+            y1 = min(H, max([e[3] for e in ext]))
+            if x0 >= x1 or y0 >= y1:
+                continue
+            sl = (slice(y0, y1), slice(x0, x1))
+            before = np.sum(((data[sl] - mod[sl]) * ie[sl])**2)
+            if old is not None:
+                old.addTo(mod, scale=-1.)
+            if new is not None:
+                new.addTo(mod)
+            after = np.sum(((data[sl] - mod[sl]) * ie[sl])**2)
+            R['chisq'] += after - before
+        return R
+
+    def _addModelsBatched(self, img, srcs, mod, minsb=None):
+        '''
+        Adds the models of *srcs* to *mod*.  Sources that can give
+        their models as mixtures of Gaussians (getModelMixture) are
+        rendered together in a single call, as are point sources with
+        pixelized PSFs (getPixelizedModel); the others (and those
+        with model masks) via getModelPatch.
+        '''
+        from .mixture_profiles import render_mixtures
+        mixes = []
+        extents = []
+        # psf id -> (psf, [px], [py], [counts])
+        pixsrcs = {}
+        for src in srcs:
+            if src is None:
+                continue
+            mm = None
+            if (not self.expectModelMasks and
+                self._getModelMaskFor(img, src) is None):
+                if hasattr(src, 'getModelMixture'):
+                    mm = src.getModelMixture(img, minsb=minsb)
+                if mm is None and hasattr(src, 'getPixelizedModel'):
+                    pm = src.getPixelizedModel(img, minsb=minsb)
+                    if pm is not None:
+                        (psf,px,py,counts) = pm
+                        if counts != 0:
+                            P = pixsrcs.setdefault(id(psf), (psf,[],[],[]))
+                            P[1].append(px)
+                            P[2].append(py)
+                            P[3].append(counts)
+                        continue
+            if mm is None:
+                patch = self.getModelPatch(img, src, minsb=minsb)
+                if patch is not None:
+                    patch.addTo(mod)
+                continue
+            mix,extent = mm
+            if mix is None:
+                continue
+            mixes.append(mix)
+            extents.append(extent)
+        render_mixtures(mixes, extents, mod)
+        for psf,pxs,pys,counts in pixsrcs.values():
+            psf.addPointSourcesTo(mod, pxs, pys, counts)
+
+    def getOverlappingSources(self, img, srcs=None, minsb=0., fullImage=True):
+        '''
+        Groups the sources (default: the catalog) whose models in
+        *img* overlap above surface brightness *minsb*.
+
+        Returns (srcgroups, L, mod): *srcgroups* is a dict from group
+        label to a list of source indices; *L* is the label image and
+        *mod* the model image.
+
+        If not *fullImage*, the groups are found from the extents of
+        the model patches, with a spatial index and union-find (see
+        blobs.find_overlapping_groups()), without full-image arrays,
+        and *L* and *mod* are None.  Sources are then grouped when
+        their individual models are above *minsb* within a few pixels
+        of each other, rather than when the summed model is.
+        '''
         from scipy.ndimage.morphology import binary_dilation
         from scipy.ndimage.measurements import label
 
         if _isint(img):
             img = self.getImage(img)
+        if not fullImage:
+            from .blobs import find_overlapping_groups
+            if srcs is None:
+                srcs = self.catalog
+            groups = find_overlapping_groups(self._getSourceMasks(img, srcs,
+                                                                  minsb))
+            srcgroups = dict([(i+1, g) for i,g in enumerate(groups)])
+            return srcgroups, None, None
         mod = np.zeros(img.getShape(), self.modtype)
         if srcs is None:
             srcs = self.catalog
@@ -2528,8 +3964,32 @@ class Tractor(MultiParams):
         #return srcgroups.values() #, L
         return srcgroups, L, mod
 
+    def _getSourceMasks(self, img, srcs, minsb):
+        '''
+        Returns a list, per source, of boolean Patches of the pixels of
+        *img* where the source model is above *minsb* (or None).
+        '''
+        H,W = img.getShape()
+        masks = []
+        for src in srcs:
+            patch = None
+            if src is not None:
+                patch = self.getModelPatch(img, src, minsb=minsb)
+            mask = None
+            if patch is not None and patch.patch is not None:
+                mask = Patch(patch.x0, patch.y0, patch.patch > minsb)
+                if not mask.clipTo(W,H):
+                    mask = None
+            masks.append(mask)
+        return masks
+
     def getModelImages(self):
-        if self.is_multiproc():
+        if self._useWorkerState() and not self.incrementalModels:
+            path = self._getWorkerState()
+            params = self.getParams()
+            mods = self._map(getworkermodelimage,
+                             [(path, params, i) for i in range(len(self.images))])
+        elif self.is_multiproc() and not self.incrementalModels:
             # avoid shipping my images...
             allimages = self.getImages()
             self.images = Images()
@@ -2558,6 +4018,101 @@ class Tractor(MultiParams):
             chis.append(chi)
         return chis
 
+    def _getChiRoi(self, img, x0, x1, y0, y1, minsb=0.):
+        '''
+        Returns the chi image for the region [y0:y1, x0:x1] of the
+        given image, rendering the model only within that region.
+        '''
+        (H,W) = img.shape
+        if x0 == 0 and y0 == 0 and x1 == W and y1 == H:
+            return self.getChiImage(img=img, minsb=minsb)
+        mod = np.zeros((y1-y0, x1-x0), self.modtype)
+        self._addSkyTo(img, mod, x0, y0)
+        for src in self.catalog:
+            if src is None:
+                continue
+            patch = self.getModelPatch(img, src, minsb=minsb)
+            if patch is None or patch.patch is None:
+                continue
+            Patch(patch.x0 - x0, patch.y0 - y0, patch.patch).addTo(mod)
+        chi = ((img.getImage()[y0:y1, x0:x1] - mod) *
+               img.getInvError()[y0:y1, x0:x1])
+        return chi
+
+    def _getChiRows(self, img, R, chi=None):
+        '''
+        Returns chi at the pixels of the rows of *img* in the update
+        matrix, *R* = imgrows[img] from _numberDerivativeRows(), using
+        the full chi image *chi* if given.
+        '''
+        pix = R['pix']
+        if chi is not None:
+            return chi.flat[pix]
+        if R['rowmap'] is None:
+            return self._getChiPixels(img, pix)
+        # (dense: render the bounding box)
+        (x0,x1,y0,y1) = R['extent']
+        W = img.shape[1]
+        chi = self._getChiRoi(img, x0, x1, y0, y1)
+        return chi[pix // W - y0, pix % W - x0]
+
+    def _getChiPixels(self, img, pix, minsb=0., tilesize=64):
+        '''
+        Returns chi at the pixels of *img* with sorted flat indices
+        *pix*, rendering only around those pixels: the model patches
+        are sampled there, and the sky is rendered in the
+        *tilesize*-square tiles that contain them.
+        '''
+        (H,W) = img.shape
+        mod = np.zeros(len(pix), self.modtype)
+        yy = pix // W
+        xx = pix % W
+        tiles = (yy // tilesize) * W + (xx // tilesize)
+        for t in np.unique(tiles):
+            I = np.flatnonzero(tiles == t)
+            ty0 = (t // W) * tilesize
+            tx0 = (t % W) * tilesize
+            tile = np.zeros((min(tilesize, H - ty0), min(tilesize, W - tx0)),
+                            self.modtype)
+            self._addSkyTo(img, tile, tx0, ty0)
+            mod[I] += tile[yy[I] - ty0, xx[I] - tx0]
+        for src in self.catalog:
+            if src is None:
+                continue
+            patch = self.getModelPatch(img, src, minsb=minsb)
+            if patch is None or patch.patch is None:
+                continue
+            (ph,pw) = patch.patch.shape
+            px0,py0 = max(0, patch.x0), max(0, patch.y0)
+            px1,py1 = min(W, patch.x0 + pw), min(H, patch.y0 + ph)
+            if px0 >= px1 or py0 >= py1:
+                continue
+            # the elements of pix within the patch
+            I = np.arange(np.searchsorted(pix, py0 * W + px0),
+                          np.searchsorted(pix, (py1 - 1) * W + px1))
+            I = I[(xx[I] >= px0) * (xx[I] < px1)]
+            if len(I) == 0:
+                continue
+            mod[I] += patch.patch[yy[I] - patch.y0, xx[I] - patch.x0]
+        return ((img.getImage().flat[pix] - mod) *
+                img.getInvError().flat[pix])
+
+    def _addSkyTo(self, img, mod, x0, y0):
+        '''
+        Adds the sky of *img* to *mod*, the sub-region of the image
+        whose pixel [0,0] is image pixel (*x0*,*y0*).  Skies whose
+        addTo() takes x0,y0 keywords render just that region; others
+        (addTo(mod, scale)) are rendered on the whole image and cut.
+        '''
+        sky = img.getSky()
+        if _takesOffsets(sky.addTo):
+            sky.addTo(mod, x0=x0, y0=y0)
+            return
+        (h,w) = mod.shape
+        full = np.zeros(img.shape, mod.dtype)
+        sky.addTo(full)
+        mod += full[y0:y0+h, x0:x0+w]
+
     def getChiImage(self, imgi=-1, img=None, srcs=None, minsb=0.):
         if img is None:
             img = self.getImage(imgi)
@@ -2586,6 +4141,9 @@ class Tractor(MultiParams):
         return count
 
     def getLogLikelihood(self):
+        if self.incrementalModels:
+            return -0.5 * sum([self._getResidentModel(img)['chisq']
+                               for img in self.images])
         chisq = 0.
         for i,chi in enumerate(self.getChiImages()):
             chisq += (chi.astype(float) ** 2).sum()
@@ -2609,6 +4167,55 @@ class Tractor(MultiParams):
             return -np.inf
         return lnp
 
+    def getLogProbGradient(self, allderivs=None, chis=None, priors=True,
+                           return_lnp=False):
+        '''
+        Returns the gradient of the log-prob with respect to the thawed
+        parameters, J^T chi, from the derivative patches (*allderivs*,
+        default: getDerivs()) and chi images (*chis*, default:
+        getChiImages()), plus the log-prior derivatives.
+
+        If *return_lnp*, returns (log-prob, gradient), where the
+        log-prob comes from the same chi images.
+        '''
+        if chis is None:
+            chis = self.getChiImages()
+        if allderivs is None:
+            allderivs = self.getDerivs()
+        chimap = dict([(img, chi) for img,chi in zip(self.getImages(), chis)])
+        grad = np.zeros(len(allderivs))
+        for i,param in enumerate(allderivs):
+            for (deriv, img) in param:
+                if deriv is None or deriv.patch is None:
+                    continue
+                (H,W) = img.shape
+                deriv = deriv.copy()
+                if not deriv.clipTo(W, H):
+                    continue
+                slc = deriv.getSlice(img)
+                grad[i] += np.sum(deriv.patch * img.getInvError()[slc] *
+                                  chimap[img][slc])
+        lnprior = 0.
+        if priors:
+            # the priors are least-squares terms like chi, with
+            # "derivative" values vA and residuals pb.
+            pderivs = self.getLogPriorDerivatives()
+            if pderivs is not None:
+                rA,cA,vA,pb = pderivs
+                if len(pb):
+                    pb = np.hstack(pb)
+                    for ri,ci,vi in zip(rA, cA, vA):
+                        grad[ci] += np.dot(vi, pb[ri])
+            if return_lnp:
+                lnprior = self.getLogPrior()
+        if not return_lnp:
+            return grad
+        chisq = sum([(chi.astype(float)**2).sum() for chi in chis])
+        lnp = lnprior - 0.5 * chisq
+        if not np.isfinite(lnp):
+            lnp = -np.inf
+        return lnp, grad
+
     def getBbox(self, img, srcs):
         nzsum = None
         # find bbox
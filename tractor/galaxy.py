@@ -12,6 +12,8 @@ These use the slightly modified versions of the exp and dev profiles
 from the SDSS /Photo/ software; we use multi-Gaussian approximations
 of these.
 """
+import time
+
 import numpy as np
 
 from . import mixture_profiles as mp
@@ -24,16 +26,118 @@ _galcache = Cache(maxsize=10000)
 def get_galaxy_cache():
     return _galcache
 
-def set_galaxy_cache_size(N=10000):
+def set_galaxy_cache_size(N=10000, maxbytes=None, policy='lru'):
+    '''
+    Replaces the cache of unit-flux galaxy patches with a new one
+    holding at most *N* patches and *maxbytes* bytes of patches, with
+    eviction policy *policy*; see cache.Cache.
+    '''
     global _galcache
-    _galcache = Cache(maxsize=N)
+    _galcache = Cache(maxsize=N, maxbytes=maxbytes, policy=policy)
 
 enable_galaxy_cache = set_galaxy_cache_size
 
+def set_galaxy_cache(cache):
+    '''
+    Replaces the cache of unit-flux galaxy patches with the given
+    object, which must support the cache.Cache get() and put() calls
+    (eg, mpcache.SharedPatchCache); *None* disables the cache.
+    '''
+    global _galcache
+    _galcache = cache
+
 def disable_galaxy_cache():
     global _galcache
     _galcache = None
 
+_analytic_derivs = False
+def set_analytic_derivatives(on=True):
+    '''
+    Turns on (or off) computing the position and shape derivatives of
+    galaxies analytically, rather than by finite differences.  This
+    is only possible for PSFs that are mixtures of Gaussians;
+    otherwise finite differences are still used.
+    '''
+    global _analytic_derivs
+    _analytic_derivs = on
+
+_shiftcache = None
+_shiftsub = 16
+def set_galaxy_shift_cache(nsub=16, N=10000, maxbytes=None):
+    '''
+    Turns on (or, with *nsub* = None, off) a cache of the expensive
+    parts of galaxy rendering -- the PSF-convolved mixture (for
+    mixture-of-Gaussians PSFs) or the galaxy Fourier transform (for
+    pixelized PSFs) -- keyed on the source position quantized to
+    1/*nsub* pixel, and the shape, WCS and PSF.  The residual
+    sub-pixel offset is applied exactly, as a shift of the mixture
+    means or a phase ramp on the transform, so small position steps
+    (derivatives, optimizer iterations, multi-epoch forced photometry)
+    reuse the cached entry.
+
+    *N* and *maxbytes* limit the size of the cache; see cache.Cache.
+    '''
+    global _shiftcache, _shiftsub
+    if nsub is None:
+        _shiftcache = None
+        return
+    _shiftcache = Cache(maxsize=N, maxbytes=maxbytes)
+    _shiftsub = nsub
+
+def get_galaxy_shift_cache():
+    return _shiftcache
+
+def _quantizePixel(px, py):
+    q = float(_shiftsub)
+    return np.round(px * q) / q, np.round(py * q) / q
+
+def _getShapeVariance(shape, cd):
+    '''
+    Returns the variance matrix, in pixel space, of a unit-variance
+    circular Gaussian that has been transformed by the given shape.
+    '''
+    Tinv = np.linalg.inv(shape.getTensor(cd))
+    return np.dot(Tinv, Tinv.T)
+
+def _getShapeVarianceDerivs(shape, cd):
+    '''
+    Returns a list (one per thawed parameter of *shape*) of the
+    derivatives of _getShapeVariance() with respect to that parameter.
+
+    This is just a 2x2 matrix computation, so central differences with
+    tiny steps are plenty accurate.
+    '''
+    params = shape.getParams()
+    dS = []
+    for i,step in enumerate(shape.getStepSizes()):
+        h = 1e-4 * step
+        oldval = shape.setParam(i, params[i] + h)
+        S1 = _getShapeVariance(shape, cd)
+        shape.setParam(i, params[i] - h)
+        S0 = _getShapeVariance(shape, cd)
+        shape.setParam(i, oldval)
+        dS.append((S1 - S0) / (2. * h))
+    return dS
+
+def _getPosDerivsFromPixel(src, img, pos, px0, py0, counts, dx, dy, dname):
+    '''
+    Converts derivatives of a unit-flux model with respect to pixel
+    position (Patches *dx*, *dy*) into derivatives with respect to the
+    (thawed) parameters of Position *pos*.
+    '''
+    derivs = []
+    params = pos.getParams()
+    for i,pstep in enumerate(pos.getStepSizes()):
+        oldval = pos.setParam(i, params[i]+pstep)
+        (px,py) = img.getWcs().positionToPixel(pos, src)
+        pos.setParam(i, oldval)
+        d = Patch(dx.x0, dx.y0,
+                  (dx.patch * ((px - px0) / pstep) +
+                   dy.patch * ((py - py0) / pstep)) * counts)
+        d.setName('d(%s)/d(pos%i)' % (dname, i))
+        derivs.append(d)
+    return derivs
+
 class GalaxyShape(ParamList):
     '''
     A naive representation of an ellipse (describing a galaxy shape),
@@ -134,6 +238,9 @@ class Galaxy(MultiParams, SingleProfileSource):
         raise RuntimeError('getUnitFluxModelPatch unimplemented in' +
                            self.getName())
 
+    def _getAnalyticDerivs(self, img, px, py, patch0, modelMask=None):
+        return None
+
     # returns [ Patch, Patch, ... ] of length numberOfParams().
     # Galaxy.
     def getParamDerivatives(self, img, modelMask=None):
@@ -154,6 +261,12 @@ class Galaxy(MultiParams, SingleProfileSource):
         derivs = []
 
         extent = patch0.getExtent()
+
+        # analytic position and shape derivatives?
+        aderivs = None
+        if _analytic_derivs and counts != 0:
+            aderivs = self._getAnalyticDerivs(img, px0, py0, patch0,
+                                              modelMask=modelMask)
         
         # derivatives wrt position
 
@@ -166,6 +279,11 @@ class Galaxy(MultiParams, SingleProfileSource):
             if counts == 0:
                 derivs.extend([None] * len(params))
                 psteps = []
+            if aderivs is not None:
+                dx,dy,nil = aderivs
+                derivs.extend(_getPosDerivsFromPixel(
+                    self, img, pos0, px0, py0, counts, dx, dy, self.dname))
+                psteps = []
             for i,pstep in enumerate(psteps):
                 oldval = pos0.setParam(i, params[i]+pstep)
                 (px,py) = img.getWcs().positionToPixel(pos0, self)
@@ -209,10 +327,15 @@ class Galaxy(MultiParams, SingleProfileSource):
                                
                 dx = (patchx - patch0) * (counts / pstep)
 
-                if modelMask is None:
+                if (modelMask is None and
+                    patch0.patch.shape == patchx.patch.shape and
+                    (patch0.x0, patch0.y0) == (patchx.x0, patchx.y0)):
                     # We evaluated patch0 and patchx on the same extent,
                     # so they are pixel aligned.  Take the intersection of
                     # the pixels they evaluated (>minval) to avoid jumps.
+                    # (Renderings that ignore *extent*, eg via a
+                    # PixelizedPSF, can differ by a pixel at the image
+                    # edge; there the Patch difference covers both.)
                     dx.patch *= ((patch0.patch > 0) * (patchx.patch > 0))
 
                 dx.setName('d(%s)/d(pos%i)' % (self.dname, i))
@@ -240,6 +363,12 @@ class Galaxy(MultiParams, SingleProfileSource):
             if counts == 0:
                 derivs.extend([None] * len(oldvals))
                 gsteps = []
+            if aderivs is not None:
+                for i,dg in enumerate(aderivs[2]['shape']):
+                    dg.patch *= counts
+                    dg.setName('d(%s)/d(%s)' % (self.dname, gnames[i]))
+                    derivs.append(dg)
+                gsteps = []
             for i,gstep in enumerate(gsteps):
                 oldval = self.shape.setParam(i, oldvals[i]+gstep)
                 #print '  stepped', gnames[i], 'by', gsteps[i],
@@ -289,7 +418,122 @@ class ProfileGalaxy(object):
 
     def _getUnitFluxPatchSize(self, img, minval):
         return 0
+
+    def _getShapeProfiles(self):
+        '''
+        Returns a list of (weight, MixtureOfGaussians profile, shape,
+        shape parameter name) for the components of this galaxy.
+        '''
+        return []
+
+    def _getAnalyticDerivs(self, img, px, py, patch0, modelMask=None):
+        '''
+        Computes the derivatives of the unit-flux model patch with
+        respect to pixel position and the thawed shape parameters
+        analytically, in a single pass over the pixels of *patch0*
+        (or *modelMask*).
+
+        Returns None if this is not possible (the PSF is not a mixture
+        of Gaussians, or the profile is not circular); otherwise
+        (dx, dy, dshapes), where dx,dy are Patches and *dshapes* is a
+        dict from shape parameter name to a list of Patches, one per
+        thawed parameter.
+        '''
+        psf = img.getPsf()
+        if not hasattr(psf, 'getMixtureOfGaussians'):
+            return None
+        profs = self._getShapeProfiles()
+        if len(profs) == 0:
+            return None
+        cd = img.getWcs().cdAtPixel(px, py)
+        G = len(profs)
+        amps = []
+        means = []
+        variances = []
+        vweights = []
+        for g,(f,prof,shape,name) in enumerate(profs):
+            v = prof.var[:,0,0]
+            if not (np.all(prof.var[:,0,1] == 0) and
+                    np.all(prof.var[:,1,0] == 0) and
+                    np.all(prof.var[:,1,1] == v)):
+                return None
+            S = _getShapeVariance(shape, cd)
+            amps.append(f * prof.amp)
+            means.append(prof.mean + np.array([px,py]))
+            variances.append(v[:,np.newaxis,np.newaxis] * S[np.newaxis,:,:])
+            # The variance of each component is v * S, so its
+            # derivative wrt the shape is v * dS.
+            w = np.zeros((prof.K, G))
+            w[:,g] = v
+            vweights.append(w)
+        amix = mp.MixtureOfGaussians(np.hstack(amps), np.vstack(means),
+                                     np.vstack(variances))
+        psfmix = psf.getMixtureOfGaussians(px=px, py=py)
+        cmix = amix.convolve(psfmix)
+        # convolve() orders the components by PSF component, then ours.
+        vweights = np.tile(np.vstack(vweights), (psfmix.K, 1))
+
+        if modelMask is not None:
+            x0,y0,mask = modelMask.x0, modelMask.y0, modelMask.patch
+        else:
+            x0,y0,mask = patch0.x0, patch0.y0, (patch0.patch != 0)
+        mod,dx,dy,vderivs = cmix.evaluate_grid_masked_derivs(
+            x0, y0, mask, 0., 0., vweights)
+
+        dshapes = {}
+        for g,(f,prof,shape,name) in enumerate(profs):
+            if self.isParamFrozen(name):
+                continue
+            dxx,dxy,dyy = [d.patch for d in vderivs[g]]
+            dshapes[name] = [Patch(x0, y0, dxx * dS[0,0] + dxy * (2.*dS[0,1]) +
+                                   dyy * dS[1,1])
+                             for dS in _getShapeVarianceDerivs(shape, cd)]
+        return dx, dy, dshapes
     
+    def _getConvolvedMixture(self, img, px, py):
+        '''
+        Returns the affine-transformed profile convolved with the
+        (mixture-of-Gaussians) PSF, centered at pixel *px*,*py*.
+        '''
+        psf = img.getPsf()
+        if _shiftcache is None:
+            amix = self._getAffineProfile(img, px, py)
+            return amix.convolve(psf.getMixtureOfGaussians(px=px, py=py))
+        qx,qy = _quantizePixel(px, py)
+        key = ('mog', self._getUnitFluxDeps(img, qx, qy))
+        try:
+            (amp,mean,var) = _shiftcache.get(key)
+        except KeyError:
+            t0 = time.time()
+            amix = self._getAffineProfile(img, qx, qy)
+            cmix = amix.convolve(psf.getMixtureOfGaussians(px=qx, py=qy))
+            (amp,mean,var) = (cmix.amp, cmix.mean, cmix.var)
+            _shiftcache.put(key, (amp,mean,var), cost=time.time()-t0)
+        return mp.MixtureOfGaussians(amp.copy(),
+                                     mean + np.array([px - qx, py - qy]),
+                                     var.copy(), quick=True)
+
+    def _getFourierTransform(self, img, mux, muy, w, v):
+        '''
+        Returns the Fourier transform of the affine-transformed
+        profile centered at *mux*,*muy*, at frequencies *w*,*v*.
+        '''
+        if _shiftcache is None:
+            amix = self._getAffineProfile(img, mux, muy)
+            return amix.getFourierTransform(w, v)
+        qx,qy = _quantizePixel(mux, muy)
+        key = ('fft', len(w), len(v), self._getUnitFluxDeps(img, qx, qy))
+        try:
+            F = _shiftcache.get(key)
+        except KeyError:
+            t0 = time.time()
+            amix = self._getAffineProfile(img, qx, qy)
+            F = amix.getFourierTransform(w, v)
+            _shiftcache.put(key, F, cost=time.time()-t0)
+        # shift theorem: phase ramp for the residual offset
+        return F * np.exp(-2j * np.pi * ((mux - qx) * w[np.newaxis,:] +
+                                         (muy - qy) * v[:,np.newaxis]))
+
     def getUnitFluxModelPatch(self, img, px=None, py=None, minval=0.0,
                               extent=None, modelMask=None):
         if px is None or py is None:
@@ -333,10 +577,12 @@ class ProfileGalaxy(object):
         except KeyError:
             pass
 
+        t0 = time.time()
         patch = self._realGetUnitFluxModelPatch(img, px, py, minval,
                                                 extent=extent, modelMask=modelMask)
         if patch is not None:
             patch = patch.copy()
+        cost = time.time() - t0
         # print 'Adding to cache:', deps,
         # if patch is not None:
         #     print 'patch shape', patch.shape
@@ -345,9 +591,49 @@ class ProfileGalaxy(object):
         if patch is not None and modelMask is not None:
             assert(patch.shape == modelMask.shape)
         # print 'modelMask:', modelMask
-        _galcache.put(deps, (patch,minval))
+        _galcache.put(deps, (patch,minval), cost=cost)
         return patch
 
+    def _getUnitFluxPatchExtent(self, img, px, py, minval):
+        '''
+        Returns the [x0,x1,y0,y1] range of pixels of *img* to render
+        for the unit-flux model patch, or None if there is no overlap.
+        '''
+        halfsize = self._getUnitFluxPatchSize(img, px, py, minval)
+        (outx, inx) = get_overlapping_region(
+            int(floor(px-halfsize)), int(ceil(px+halfsize+1)),
+            0, img.getWidth())
+        (outy, iny) = get_overlapping_region(
+            int(floor(py-halfsize)), int(ceil(py+halfsize+1)),
+            0, img.getHeight())
+        if inx == [] or iny == []:
+            return None
+        return [outx.start, outx.stop, outy.start, outy.stop]
+
+    def getModelMixture(self, img, minsb=None):
+        '''
+        Returns (mixture, extent) for batch rendering; see
+        ducks.Source.getModelMixture().  Only possible for
+        mixture-of-Gaussians PSFs, with no approximation (minsb = 0).
+        '''
+        psf = img.getPsf()
+        if not hasattr(psf, 'getMixtureOfGaussians'):
+            return None
+        if minsb is None:
+            minsb = img.modelMinval
+        if minsb != 0.:
+            return None
+        counts = img.getPhotoCal().brightnessToCounts(self.brightness)
+        if counts == 0 or not np.isfinite(np.float32(counts)):
+            return None,None
+        (px,py) = img.getWcs().positionToPixel(self.getPosition(), self)
+        extent = self._getUnitFluxPatchExtent(img, px, py, 0.)
+        if extent is None:
+            return None,None
+        cmix = self._getConvolvedMixture(img, px, py)
+        cmix.amp *= counts
+        return cmix, extent
+
     def _realGetUnitFluxModelPatch(self, img, px, py, minval, extent=None,
                                    modelMask=None):
         '''
@@ -360,25 +646,16 @@ class ProfileGalaxy(object):
 
 
         
-        if modelMask is None:
-            # now choose the patch size
-            halfsize = self._getUnitFluxPatchSize(img, px, py, minval)
-
         if modelMask is not None:
             x0,y0 = modelMask.x0, modelMask.y0
         elif extent is None:
             # find overlapping pixels to render
-            (outx, inx) = get_overlapping_region(
-                int(floor(px-halfsize)), int(ceil(px+halfsize+1)),
-                0, img.getWidth())
-            (outy, iny) = get_overlapping_region(
-                int(floor(py-halfsize)), int(ceil(py+halfsize+1)),
-                0, img.getHeight())
-            if inx == [] or iny == []:
+            extent = self._getUnitFluxPatchExtent(img, px, py, minval)
+            if extent is None:
                 # no overlap
                 return None
-            x0,x1 = outx.start, outx.stop
-            y0,y1 = outy.start, outy.stop
+            x0,x1,y0,y1 = extent
+            extent = None
         else:
             x0,x1,y0,y1 = extent
         psf = img.getPsf()
@@ -392,10 +669,8 @@ class ProfileGalaxy(object):
         # profile.
 
         if hasattr(psf, 'getMixtureOfGaussians'):
-            amix = self._getAffineProfile(img, px, py)
-            # now convolve with the PSF, analytically
-            psfmix = psf.getMixtureOfGaussians(px=px, py=py)
-            cmix = amix.convolve(psfmix)
+            # convolve with the PSF, analytically
+            cmix = self._getConvolvedMixture(img, px, py)
 
             # print 'galaxy affine mixture:', amix
             # print 'psf mixture:', psfmix
@@ -497,8 +772,7 @@ class ProfileGalaxy(object):
             ## print 'ix0,iy0', ix0,iy0
             # print 'mux,muy', mux,muy
             
-            amix = self._getAffineProfile(img, mux, muy)
-            Fsum = amix.getFourierTransform(w, v)
+            Fsum = self._getFourierTransform(img, mux, muy, w, v)
 
             # print 'Galaxy FFT:', Fsum.shape
             
@@ -630,9 +904,11 @@ class HoggGalaxy(ProfileGalaxy, Galaxy):
         galmix = self.getProfile()
         Tinv = np.linalg.inv(self.shape.getTensor(cd))
         amix = galmix.apply_affine(np.array([px,py]), Tinv.T)
-        amix.symmetrize()
         return amix
 
+    def _getShapeProfiles(self):
+        return [(1., self.getProfile(), self.shape, 'shape')]
+
     def _getUnitFluxDeps(self, img, px, py):
         # return ('unitpatch', self.getName(), px, py,
         return hash(('unitpatch', self.getName(), px, py,
@@ -757,20 +1033,23 @@ class FixedCompositeGalaxy(MultiParams, ProfileGalaxy, SingleProfileSource):
                 ', shapeExp=' + repr(self.shapeExp) +
                 ', shapeDev=' + repr(self.shapeDev) + ')')
 
-    def _getAffineProfile(self, img, px, py):
+    def _getShapeProfiles(self):
         f = self.fracDev.getClippedValue()
         profs = []
         if f > 0.:
-            profs.append((f, DevGalaxy.profile, self.shapeDev))
+            profs.append((f, DevGalaxy.profile, self.shapeDev, 'shapeDev'))
         if f < 1.:
-            profs.append((1.-f, ExpGalaxy.profile, self.shapeExp))
+            profs.append((1.-f, ExpGalaxy.profile, self.shapeExp, 'shapeExp'))
+        return profs
+
+    def _getAffineProfile(self, img, px, py):
+        profs = [(f,p,s) for f,p,s,nil in self._getShapeProfiles()]
 
         cd = img.getWcs().cdAtPixel(px, py)
         mix = []
         for f,p,s in profs:
             Tinv = np.linalg.inv(s.getTensor(cd))
             amix = p.apply_affine(np.array([px,py]), Tinv.T)
-            amix.symmetrize()
             amix.amp *= f
             mix.append(amix)
             #print 'affine profile: shape', s, 'weight', f, '->', amix
@@ -780,7 +1059,7 @@ class FixedCompositeGalaxy(MultiParams, ProfileGalaxy, SingleProfileSource):
         smix = mix[0] + mix[1]
         #print 'Summed profiles:', smix
         #print 'amp sum', np.sum(smix.amp)
-        return mix[0] + mix[1]
+        return smix
 
     def _getUnitFluxPatchSize(self, img, px, py, minval):
         if hasattr(self, 'halfsize'):
@@ -810,7 +1089,85 @@ class FixedCompositeGalaxy(MultiParams, ProfileGalaxy, SingleProfileSource):
                      self.shapeExp.hashkey(),
                      self.fracDev.hashkey()))
     
+    def _getFracDevDeriv(self, img, counts, modelMask=None):
+        if counts == 0.:
+            return None
+        e = ExpGalaxy(self.pos, self.brightness, self.shapeExp)
+        d = DevGalaxy(self.pos, self.brightness, self.shapeDev)
+        ## FIXME -- should be possible to avoid recomputing these...
+        ue = e.getUnitFluxModelPatch(img, modelMask=modelMask)
+        ud = d.getUnitFluxModelPatch(img, modelMask=modelMask)
+        if ue is not None:
+            ue *= -1
+        df = add_patches(ud, ue)
+        if df is None:
+            return None
+        df *= counts
+        df.setName('d(fcomp)/d(fracDev)')
+        return df
+
+    def _getAnalyticParamDerivatives(self, img, modelMask=None):
+        '''
+        Like getParamDerivatives(), but with the position and shape
+        derivatives for both components computed analytically in a
+        single pass.  Returns None if that is not possible.
+        '''
+        pos0 = self.getPosition()
+        (px0,py0) = img.getWcs().positionToPixel(pos0, self)
+        counts = img.getPhotoCal().brightnessToCounts(self.brightness)
+        if counts == 0:
+            return None
+        minval = img.modelMinval / counts
+        patch0 = self.getUnitFluxModelPatch(img, px0, py0, minval=minval,
+                                            modelMask=modelMask)
+        if patch0 is None:
+            return [None] * self.numberOfParams()
+        aderivs = self._getAnalyticDerivs(img, px0, py0, patch0,
+                                          modelMask=modelMask)
+        if aderivs is None:
+            return None
+        dx,dy,dshapes = aderivs
+
+        derivs = []
+        if not self.isParamFrozen('pos'):
+            derivs.extend(_getPosDerivsFromPixel(
+                self, img, pos0, px0, py0, counts, dx, dy, 'fcomp'))
+
+        if not self.isParamFrozen('brightness'):
+            bsteps = self.brightness.getStepSizes()
+            params = self.brightness.getParams()
+            for i,bstep in enumerate(bsteps):
+                oldval = self.brightness.setParam(i, params[i] + bstep)
+                countsi = img.getPhotoCal().brightnessToCounts(self.brightness)
+                self.brightness.setParam(i, oldval)
+                df = patch0 * ((countsi - counts) / bstep)
+                df.setName('d(fcomp)/d(bright%i)' % i)
+                derivs.append(df)
+
+        if not self.isParamFrozen('fracDev'):
+            derivs.append(self._getFracDevDeriv(img, counts,
+                                                modelMask=modelMask))
+
+        for name,dname in [('shapeExp', 'fcomp.exp'), ('shapeDev', 'fcomp.dev')]:
+            if self.isParamFrozen(name):
+                continue
+            shape = getattr(self, name)
+            gnames = shape.getParamNames()
+            # (this component has zero weight if it is not in dshapes)
+            dg = dshapes.get(name, [None] * len(gnames))
+            for i,d in enumerate(dg):
+                if d is not None:
+                    d.patch *= counts
+                    d.setName('d(%s)/d(%s)' % (dname, gnames[i]))
+            derivs.extend(dg)
+        return derivs
+
     def getParamDerivatives(self, img, modelMask=None):
+        if _analytic_derivs:
+            derivs = self._getAnalyticParamDerivatives(img, modelMask=modelMask)
+            if derivs is not None:
+                return derivs
+
         e = ExpGalaxy(self.pos, self.brightness, self.shapeExp)
         d = DevGalaxy(self.pos, self.brightness, self.shapeDev)
         e.dname = 'fcomp.exp'
@@ -868,21 +1225,8 @@ class FixedCompositeGalaxy(MultiParams, ProfileGalaxy, SingleProfileSource):
                 
         if not self.isParamFrozen('fracDev'):
             counts = img.getPhotoCal().brightnessToCounts(self.brightness)
-            if counts == 0.:
-                derivs.append(None)
-            else:
-                ## FIXME -- should be possible to avoid recomputing these...
-                ue = e.getUnitFluxModelPatch(img, modelMask=modelMask)
-                ud = d.getUnitFluxModelPatch(img, modelMask=modelMask)
-                if ue is not None:
-                    ue *= -1
-                df = add_patches(ud, ue)
-                if df is None:
-                    derivs.append(None)
-                else:
-                    df *= counts
-                    df.setName('d(fcomp)/d(fracDev)')
-                    derivs.append(df)
+            derivs.append(self._getFracDevDeriv(img, counts,
+                                                modelMask=modelMask))
 
         if not self.isParamFrozen('shapeExp'):
             derivs.extend(dexp[i0:])
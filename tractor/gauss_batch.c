@@ -0,0 +1,123 @@
+static int c_gauss_2d_batch(int W, int H,
+                            PyObject* ob_amp,
+                            PyObject* ob_mean,
+                            PyObject* ob_var,
+                            PyObject* ob_koff,
+                            PyObject* ob_extent,
+                            PyObject* ob_result) {
+    // Renders a batch of mixtures of Gaussians into one image.
+    //
+    // ob_amp, ob_mean, ob_var: the components of all the mixtures,
+    //   stacked (N, Nx2, Nx2x2); means are in image pixel coordinates.
+    // ob_koff: int32, length S+1: mixture s is components
+    //   [koff[s], koff[s+1]).
+    // ob_extent: int32, S x 4: [x0,x1,y0,y1) pixel range to evaluate
+    //   mixture s; clipped to the image.
+    // ob_result: double, H x W: the mixtures are *added* to this image.
+    //
+    // Evaluates each mixture exactly as c_gauss_2d_grid does.
+    const int D = 2;
+    int K, S, s, k;
+    double *amp, *mean, *var, *result;
+    int32_t *koff, *extent;
+    double *scale = NULL, *ivar = NULL;
+    double tpd;
+    PyObject *np_amp=NULL, *np_mean=NULL, *np_var=NULL, *np_result=NULL;
+    PyObject *np_koff=NULL, *np_extent=NULL;
+    PyArray_Descr* itype;
+    int req = NPY_C_CONTIGUOUS | NPY_ALIGNED;
+    int rtn = -1;
+
+    tpd = pow(2.*M_PI, D);
+
+    if (get_np(ob_amp, ob_mean, ob_var, ob_result, Py_None, Py_None, Py_None,
+               W, H, &K, &np_amp, &np_mean, &np_var, &np_result,
+               NULL, NULL, NULL, NULL))
+        goto bailout;
+
+    itype = PyArray_DescrFromType(NPY_INT32);
+    Py_INCREF(itype);
+    np_koff = PyArray_FromAny(ob_koff, itype, 1, 1, req, NULL);
+    np_extent = PyArray_FromAny(ob_extent, itype, 2, 2, req, NULL);
+    if (!np_koff || !np_extent) {
+        ERR("koff and extent must be int32 arrays");
+        goto bailout;
+    }
+    S = (int)PyArray_DIM(np_koff, 0) - 1;
+    if ((PyArray_DIM(np_extent, 0) != S) ||
+        (PyArray_DIM(np_extent, 1) != 4)) {
+        ERR("extent must be size S x 4");
+        goto bailout;
+    }
+
+    amp    = PyArray_DATA(np_amp);
+    mean   = PyArray_DATA(np_mean);
+    var    = PyArray_DATA(np_var);
+    result = PyArray_DATA(np_result);
+    koff   = PyArray_DATA(np_koff);
+    extent = PyArray_DATA(np_extent);
+
+    if (S >= 0 && (koff[0] < 0 || koff[S] > K)) {
+        ERR("koff out of range");
+        goto bailout;
+    }
+
+    scale = malloc(K * sizeof(double));
+    ivar = malloc(K * 3 * sizeof(double));
+    // (malloc(0) may return NULL)
+    if (K > 0 && (!scale || !ivar)) {
+        ERR("failed to allocate %i components", K);
+        goto bailout;
+    }
+    for (k=0; k<K; k++) {
+        double* V = var + k*D*D;
+        double* I = ivar + k*3;
+        double det;
+        det = V[0]*V[3] - V[1]*V[2];
+        I[0] =  V[3] / det;
+        I[1] = -(V[1]+V[2]) / det;
+        I[2] =  V[0] / det;
+        scale[k] = amp[k] / sqrt(tpd * det);
+    }
+
+    for (s=0; s<S; s++) {
+        int k0 = koff[s];
+        int k1 = koff[s+1];
+        int x0 = MAX(extent[s*4 + 0], 0);
+        int x1 = MIN(extent[s*4 + 1], W);
+        int y0 = MAX(extent[s*4 + 2], 0);
+        int y1 = MIN(extent[s*4 + 3], H);
+        int ix, iy;
+        for (iy=y0; iy<y1; iy++) {
+            double* row = result + iy*W;
+            for (ix=x0; ix<x1; ix++) {
+                double sum = 0.;
+                for (k=k0; k<k1; k++) {
+                    double dsq;
+                    double dx,dy;
+                    dx = ix - mean[k*D+0];
+                    dy = iy - mean[k*D+1];
+                    dsq = ivar[k*3 + 0] * dx * dx
+                        + ivar[k*3 + 1] * dx * dy
+                        + ivar[k*3 + 2] * dy * dy;
+                    if (dsq >= 100)
+                        continue;
+                    sum += scale[k] * exp(-0.5 * dsq);
+                }
+                row[ix] += sum;
+            }
+        }
+    }
+    rtn = 0;
+
+ bailout:
+    free(scale);
+    free(ivar);
+    Py_XDECREF(np_amp);
+    Py_XDECREF(np_mean);
+    Py_XDECREF(np_var);
+    Py_XDECREF(np_result);
+    Py_XDECREF(np_koff);
+    Py_XDECREF(np_extent);
+    return rtn;
+}
@@ -154,3 +154,189 @@ static int c_gauss_2d_masked(int x0, int y0, int W, int H,
     //printf("N expf calls: %i\n", n_expf - nexpf0);
     return rtn;
 }
+
+
+static int c_gauss_2d_masked_derivs(int x0, int y0, int W, int H,
+                                    // (fx,fy): center position
+                                    // which offsets "means"
+                                    double fxd, double fyd,
+                                    PyObject* ob_amp,
+                                    PyObject* ob_mean,
+                                    PyObject* ob_var,
+                                    PyObject* ob_vweight,
+                                    PyObject* ob_result,
+                                    PyObject* ob_xderiv,
+                                    PyObject* ob_yderiv,
+                                    PyObject* ob_vderiv,
+                                    PyObject* ob_mask) {
+
+    // Like c_gauss_2d_masked, but also computes derivatives with
+    // respect to the variances, in the same pass.
+    //
+    // ob_vweight: numpy array, K x G: weight of each component in
+    // each of G groups of variance derivatives.
+    //
+    // ob_vderiv: numpy array, 3G x H x W: for each group g, the
+    // weighted sums of the derivatives wrt the variance elements,
+    // Vxx, Vxy, Vyy, in planes 3g, 3g+1, 3g+2.  (Vxy is treated as
+    // one element of a symmetric matrix, so a change in the
+    // off-diagonal variance dVxy contributes 2 * dVxy * (plane 3g+1).)
+
+    float *amp, *mean, *var, *result, *vweight, *vderiv;
+    float *xderiv=NULL, *yderiv=NULL;
+    float fx = (float)fxd;
+    float fy = (float)fyd;
+    uint8_t* mask=NULL;
+    const int D=2;
+    int K, k, G, g;
+    int NP = W*H;
+    PyObject *np_amp=NULL, *np_mean=NULL, *np_var=NULL, *np_result=NULL;
+    PyObject *np_xderiv=NULL, *np_yderiv=NULL, *np_mask=NULL;
+    PyObject *np_vweight=NULL, *np_vderiv=NULL;
+    float tpd;
+    int rtn = -1;
+    int req = NPY_C_CONTIGUOUS | NPY_ALIGNED;
+    int reqout = req | NPY_WRITEABLE | NPY_UPDATEIFCOPY;
+    PyArray_Descr* ftype = PyArray_DescrFromType(PyArray_FLOAT32);
+
+    tpd = pow(2.*M_PI, D);
+
+    if (get_np(ob_amp, ob_mean, ob_var, ob_result, ob_xderiv, ob_yderiv,
+               ob_mask, W, H,
+               &K, &np_amp, &np_mean, &np_var, &np_result, &np_xderiv, &np_yderiv,
+               &np_mask, ftype)) {
+        printf("get_np failed\n");
+        goto bailout;
+    }
+    if (!np_mask) {
+        ERR("mask is required");
+        goto bailout;
+    }
+    Py_INCREF(ftype);
+    np_vweight = PyArray_FromAny(ob_vweight, ftype, 2, 2, req, NULL);
+    Py_INCREF(ftype);
+    np_vderiv = PyArray_FromAny(ob_vderiv, ftype, 3, 3, reqout, NULL);
+    if (!np_vweight || !np_vderiv) {
+        ERR("vweight and vderiv must be float32 arrays");
+        goto bailout;
+    }
+    G = (int)PyArray_DIM(np_vweight, 1);
+    if (PyArray_DIM(np_vweight, 0) != K) {
+        ERR("np_vweight must be K x G");
+        goto bailout;
+    }
+    if ((PyArray_DIM(np_vderiv, 0) != 3*G) ||
+        (PyArray_DIM(np_vderiv, 1) != H) ||
+        (PyArray_DIM(np_vderiv, 2) != W)) {
+        ERR("np_vderiv must be 3G x H x W");
+        goto bailout;
+    }
+
+    rtn = 0;
+    amp     = PyArray_DATA(np_amp);
+    mean    = PyArray_DATA(np_mean);
+    var     = PyArray_DATA(np_var);
+    vweight = PyArray_DATA(np_vweight);
+    result  = PyArray_DATA(np_result);
+    vderiv  = PyArray_DATA(np_vderiv);
+    if (np_xderiv)
+        xderiv = PyArray_DATA(np_xderiv);
+    if (np_yderiv)
+        yderiv = PyArray_DATA(np_yderiv);
+    mask    = PyArray_DATA(np_mask);
+
+    {
+        // Inverse variances, unscaled: a, b, c for [[a,b],[b,c]]
+        float II[3*K];
+        float scales[K];
+        int allzero = 1;
+
+        for (k=0; k<K; k++) {
+            float V0, V1, V2, det;
+            float* I = II + 3*k;
+            V0 =  var[k*D*D + 0];
+            V1 = (var[k*D*D + 1] + var[k*D*D + 2])*0.5;
+            V2 =  var[k*D*D + 3];
+            det = V0*V2 - V1*V1;
+            I[0] =  V2 / det;
+            I[1] = -V1 / det;
+            I[2] =  V0 / det;
+            scales[k] = amp[k] / sqrt(tpd * det);
+            if (!(isfinite(I[0]) && isfinite(I[1]) && isfinite(I[2]) &&
+                  isfinite(scales[k]))) {
+                // large variance can cause this... set scale = 0.
+                scales[k] = 0.;
+                I[0] = I[2] = 1.;
+                I[1] = 0.;
+            }
+            if (scales[k] != 0)
+                allzero = 0;
+        }
+
+        if (allzero)
+            goto bailout;
+
+        int dx, dy;
+        for (dy=0; dy<H; dy++) {
+            int y = y0 + dy;
+            int i0 = dy * W;
+            for (dx=0; dx<W; dx++) {
+                int i = i0 + dx;
+                float r = 0, rx = 0, ry = 0;
+                if (!mask[i])
+                    continue;
+                for (g=0; g<3*G; g++)
+                    vderiv[g*NP + i] = 0;
+                for (k=0; k<K; k++) {
+                    float ddx, ddy, ux, uy, dsq, Gk;
+                    float* Ik;
+                    if (scales[k] == 0)
+                        continue;
+                    Ik = II + 3*k;
+                    ddx = (x0 + dx - fx) - mean[2*k+0];
+                    ddy = (y - fy) - mean[2*k+1];
+                    ux = Ik[0] * ddx + Ik[1] * ddy;
+                    uy = Ik[1] * ddx + Ik[2] * ddy;
+                    // -0.5 * mahalanobis distance
+                    dsq = -0.5 * (ux * ddx + uy * ddy);
+                    // same cut as eval_all_dxy_f
+                    if (!(dsq >= -30.))
+                        continue;
+                    n_expf++;
+                    Gk = scales[k] * expf(dsq);
+                    r += Gk;
+                    // derivatives wrt the means
+                    rx += Gk * ux;
+                    ry += Gk * uy;
+                    // derivatives wrt the variance:
+                    //   0.5 * G * (V^-1 d d^T V^-1 - V^-1)
+                    for (g=0; g<G; g++) {
+                        float w = vweight[k*G + g];
+                        if (w == 0)
+                            continue;
+                        w *= 0.5 * Gk;
+                        vderiv[(3*g+0)*NP + i] += w * (ux*ux - Ik[0]);
+                        vderiv[(3*g+1)*NP + i] += w * (ux*uy - Ik[1]);
+                        vderiv[(3*g+2)*NP + i] += w * (uy*uy - Ik[2]);
+                    }
+                }
+                result[i] = r;
+                if (xderiv)
+                    xderiv[i] = rx;
+                if (yderiv)
+                    yderiv[i] = ry;
+            }
+        }
+    }
+ bailout:
+    Py_XDECREF(np_amp);
+    Py_XDECREF(np_mean);
+    Py_XDECREF(np_var);
+    Py_XDECREF(np_vweight);
+    Py_XDECREF(np_result);
+    Py_XDECREF(np_xderiv);
+    Py_XDECREF(np_yderiv);
+    Py_XDECREF(np_vderiv);
+    Py_XDECREF(np_mask);
+    return rtn;
+}
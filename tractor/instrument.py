@@ -0,0 +1,128 @@
+'''
+This file is part of the Tractor project.
+Copyright 2011, 2012 Dustin Lang and David W. Hogg.
+Licensed under the GPLv2; see the file COPYING for details.
+
+`instrument.py`
+===========
+
+Per-stage timing counters for the Tractor; see Tractor.profiling().
+'''
+import time
+import resource
+
+def _cputime():
+    r = resource.getrusage(resource.RUSAGE_SELF)
+    return r.ru_utime + r.ru_stime
+
+class StageTimer(object):
+    '''
+    Times one call of a stage; use as a context manager, or call
+    start() and stop().  Set *pixels* to record the number of pixels
+    handled.
+    '''
+    def __init__(self, stats, name, kind):
+        self.stats = stats
+        self.name = name
+        self.kind = kind
+        self.pixels = 0
+
+    def start(self):
+        self.t0 = time.time()
+        self.c0 = _cputime()
+
+    def stop(self):
+        self.stats.add(self.name, self.kind, wall=time.time() - self.t0,
+                       cpu=_cputime() - self.c0, pixels=self.pixels)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+        return False
+
+class NullTimer(object):
+    '''
+    A StageTimer that does nothing, for when stats are off.
+    '''
+    pixels = 0
+    def start(self):
+        pass
+    def stop(self):
+        pass
+    def __enter__(self):
+        return self
+    def __exit__(self, *args):
+        return False
+
+nulltimer = NullTimer()
+
+class StageStats(object):
+    '''
+    Counters of wall-clock and CPU time, number of calls and number of
+    pixels, per stage (eg, 'render', 'derivs', 'matrix', 'solve',
+    'linesearch', 'cache') and, within a stage, per *kind* (eg, the
+    source and PSF classes).  Stages can be nested, so their times are
+    inclusive.
+    '''
+    def __init__(self):
+        # (stage, kind) -> [calls, wall, cpu, pixels]
+        self.counts = {}
+
+    def stage(self, name, kind=None):
+        return StageTimer(self, name, kind)
+
+    def add(self, name, kind=None, wall=0., cpu=0., pixels=0, calls=1):
+        c = self.counts.get((name, kind))
+        if c is None:
+            c = self.counts[(name, kind)] = [0, 0., 0., 0]
+        c[0] += calls
+        c[1] += wall
+        c[2] += cpu
+        c[3] += pixels
+
+    def merge(self, other):
+        for (name,kind),(calls,wall,cpu,pixels) in other.counts.items():
+            self.add(name, kind, wall=wall, cpu=cpu, pixels=pixels,
+                     calls=calls)
+
+    def clear(self):
+        self.counts = {}
+
+    def report(self):
+        '''
+        Returns a dict from stage name to a dict with 'calls', 'wall',
+        'cpu' (seconds), 'pixels', and 'kinds', a dict from kind to the
+        same counters for that kind alone.
+        '''
+        R = {}
+        for (name,kind),(calls,wall,cpu,pixels) in self.counts.items():
+            r = R.get(name)
+            if r is None:
+                r = R[name] = dict(calls=0, wall=0., cpu=0., pixels=0,
+                                   kinds={})
+            r['calls'] += calls
+            r['wall'] += wall
+            r['cpu'] += cpu
+            r['pixels'] += pixels
+            if kind is not None:
+                r['kinds'][kind] = dict(calls=calls, wall=wall, cpu=cpu,
+                                        pixels=pixels)
+        return R
+
+    def __str__(self):
+        lines = ['%-12s %8s %10s %10s %12s' %
+                 ('stage', 'calls', 'wall', 'cpu', 'pixels')]
+        R = self.report()
+        for name in sorted(R.keys()):
+            r = R[name]
+            lines.append('%-12s %8i %10.3f %10.3f %12i' %
+                         (name, r['calls'], r['wall'], r['cpu'], r['pixels']))
+            for kind in sorted(r['kinds'].keys()):
+                k = r['kinds'][kind]
+                lines.append('  %-30s %8i %10.3f %10.3f %12i' %
+                             (kind, k['calls'], k['wall'], k['cpu'],
+                              k['pixels']))
+        return '\n'.join(lines)
@@ -1086,8 +1086,30 @@ static int c_gauss_2d_masked(int x0, int y0, int W, int H,
                              PyObject* ob_yderiv,
                              PyObject* ob_mask);
 
+static int c_gauss_2d_masked_derivs(int x0, int y0, int W, int H,
+                                    double fx, double fy,
+                                    PyObject* ob_amp,
+                                    PyObject* ob_mean,
+                                    PyObject* ob_var,
+                                    PyObject* ob_vweight,
+                                    PyObject* ob_result,
+                                    PyObject* ob_xderiv,
+                                    PyObject* ob_yderiv,
+                                    PyObject* ob_vderiv,
+                                    PyObject* ob_mask);
+
 #include "gauss_masked.c"
 
+static int c_gauss_2d_batch(int W, int H,
+                            PyObject* ob_amp,
+                            PyObject* ob_mean,
+                            PyObject* ob_var,
+                            PyObject* ob_koff,
+                            PyObject* ob_extent,
+                            PyObject* ob_result);
+
+#include "gauss_batch.c"
+
 
 %}
 
@@ -37,12 +37,23 @@ def get_dev_mixture():
 class MixtureOfGaussians():
 
     # symmetrize is an unnecessary step in principle, but in practice?
-    def __init__(self, amp, mean, var):
+    def __init__(self, amp, mean, var, quick=False):
         '''
         amp: shape (K,)
         mean: shape (K,D)
         var: shape (K,D,D)
+
+        If *quick* is True, the arrays are trusted to be float arrays
+        of the right shapes, with symmetric *var*; they are used
+        as-is (not copied), so this is for internal use where the
+        arrays were freshly computed.
         '''
+        if quick:
+            self.amp = amp
+            self.mean = mean
+            self.var = var
+            (self.K, self.D) = mean.shape
+            return
         self.amp = np.atleast_1d(amp).astype(float)
         self.mean = np.atleast_2d(np.array(mean)).astype(float)
         (self.K, self.D) = self.mean.shape
@@ -60,18 +71,13 @@ class MixtureOfGaussians():
 
     def set_var(self, var):
         if var.size == self.K:
-            self.var = np.zeros((self.K, self.D, self.D))
-            for d in range(self.D):
-                self.var[:,d,d] = var
+            self.var = (np.asarray(var, dtype=float).reshape(self.K,1,1) *
+                        np.eye(self.D)[np.newaxis,:,:])
         else:
             self.var = np.array(var).astype(float)
 
     def symmetrize(self):
-        for i in range(self.D):
-            for j in range(i):
-                tmpij = 0.5 * (self.var[:,i,j] + self.var[:,j,i])
-                self.var[:,i,j] = tmpij
-                self.var[:,j,i] = tmpij
+        self.var[:] = 0.5 * (self.var + self.var.transpose(0,2,1))
 
     # very harsh testing, and expensive
     def test(self):
@@ -109,7 +115,7 @@ class MixtureOfGaussians():
         assert(amp.shape  == (K,))
         assert(mean.shape == (K, D))
         assert(var.shape  == (K, D, D))
-        s = MixtureOfGaussians(amp, mean, var)
+        s = MixtureOfGaussians(amp, mean, var, quick=True)
         s.normalize()
         return s
         
@@ -121,27 +127,30 @@ class MixtureOfGaussians():
         assert(shift.shape == (self.D,))
         assert(scale.shape == (self.D, self.D))
         newmean = self.mean + shift
-        newvar = np.zeros_like(self.var)
-        for k in range(self.K):
-            newvar[k,:,:] = np.dot(scale.T, np.dot(self.var[k,:,:], scale))
-        return MixtureOfGaussians(self.amp.copy(), newmean, newvar)
+        # scale.T * var[k] * scale, for all k at once
+        newvar = np.einsum('ji,kjl,lm->kim', scale, self.var, scale)
+        # ... symmetric up to round-off
+        newvar += newvar.transpose(0,2,1)
+        newvar *= 0.5
+        return MixtureOfGaussians(self.amp.copy(), newmean, newvar,
+                                  quick=True)
 
     # dstn: should this be called "correlate"?
     def convolve(self, other):
+        '''
+        Returns the mixture of all pairs of components.  The result
+        is ordered by *other*'s components, then this mixture's.
+        '''
         assert(self.D == other.D)
         newK = self.K * other.K
         D = self.D
-        newamp = np.zeros((newK))
-        newmean = np.zeros((newK, D))
-        newvar = np.zeros((newK, D, D))
-        newk = 0
-        for k in range(other.K):
-            nextnewk = newk + self.K
-            newamp[newk:nextnewk] = self.amp * other.amp[k]
-            newmean[newk:nextnewk,:] = self.mean + other.mean[k]
-            newvar[newk:nextnewk,:,:] = self.var + other.var[k]
-            newk = nextnewk
-        return MixtureOfGaussians(newamp, newmean, newvar)
+        newamp = (other.amp[:,np.newaxis] * self.amp[np.newaxis,:]
+                  ).reshape(newK)
+        newmean = (other.mean[:,np.newaxis,:] + self.mean[np.newaxis,:,:]
+                   ).reshape((newK, D))
+        newvar = (other.var[:,np.newaxis,:,:] + self.var[np.newaxis,:,:,:]
+                  ).reshape((newK, D, D))
+        return MixtureOfGaussians(newamp, newmean, newvar, quick=True)
 
     def getFourierTransform(self, w, v, use_mp_fourier=True):
         if mp_fourier and use_mp_fourier:
@@ -298,7 +307,49 @@ class MixtureOfGaussians():
             return (Patch(x0,y0,result), Patch(x0,y0,xderiv),
                     Patch(x0,y0,yderiv))
         return Patch(x0,y0,result)
-        
+
+    def evaluate_grid_masked_derivs(self, x0, y0, mask, fx, fy, vweights):
+        '''
+        Evaluates the mixture on the pixels in *mask*, along with its
+        derivatives with respect to the means (all components moving
+        together) and the variances, in a single pass.
+
+        mask: np array of booleans (NOT Patch object!)
+        vweights: (K,G) array: weight of each component in each of G
+        groups of variance derivatives.
+
+        Returns (model, xderiv, yderiv, vderivs), where the first
+        three are Patch objects, and *vderivs* is a list of length G
+        of (dVxx, dVxy, dVyy) Patch triples: the vweight-weighted sums
+        of the derivatives with respect to the elements of the
+        variance matrices.  For a change dV in a (symmetric) variance
+        matrix, the change in the model is
+            dVxx * dV[0,0] + 2 * dVxy * dV[0,1] + dVyy * dV[1,1]
+        '''
+        from mix import c_gauss_2d_masked_derivs
+
+        h,w = mask.shape
+        vweights = np.atleast_2d(vweights).astype(np.float32)
+        assert(vweights.shape[0] == self.K)
+        G = vweights.shape[1]
+        result = np.zeros((h,w), np.float32)
+        xderiv = np.zeros_like(result)
+        yderiv = np.zeros_like(result)
+        vderiv = np.zeros((3*G, h, w), np.float32)
+
+        rtn = c_gauss_2d_masked_derivs(int(x0), int(y0), int(w), int(h),
+                                       float(fx), float(fy),
+                                       self.amp.astype(np.float32),
+                                       self.mean.astype(np.float32),
+                                       self.var.astype(np.float32),
+                                       vweights,
+                                       result, xderiv, yderiv, vderiv, mask)
+        assert(rtn == 0)
+        vderivs = [tuple([Patch(x0, y0, vderiv[3*g + i]) for i in range(3)])
+                   for g in range(G)]
+        return (Patch(x0,y0,result), Patch(x0,y0,xderiv),
+                Patch(x0,y0,yderiv), vderivs)
+
 
     def evaluate_grid_approx3(self, x0, x1, y0, y1, fx, fy, minval,
                               derivs=False, minradius=3, doslice=True,
@@ -380,6 +431,36 @@ class MixtureOfGaussians():
     #evaluate_grid = evaluate_grid_hogg
     evaluate_grid = evaluate_grid_dstn
 
+def render_mixtures(mixtures, extents, img):
+    '''
+    `mixtures`: list of MixtureOfGaussians, in pixel coordinates
+    `extents`: list of integer bounds [x0,x1,y0,y1] over which to
+        evaluate each mixture (clipped to the image)
+    `img`: 2-d image to which the mixtures are added
+
+    Evaluates all the mixtures in a single call, with the same
+    results as mixture.evaluate_grid(x0,x1,y0,y1, 0.,0.) for each.
+    '''
+    from mix import c_gauss_2d_batch
+    if len(mixtures) == 0:
+        return
+    koff = np.zeros(len(mixtures)+1, np.int32)
+    koff[1:] = np.cumsum([m.K for m in mixtures])
+    amp  = np.hstack([m.amp  for m in mixtures])
+    mean = np.vstack([m.mean for m in mixtures])
+    var  = np.vstack([m.var  for m in mixtures])
+    extents = np.array(extents, np.int32).reshape((len(mixtures), 4))
+    H,W = img.shape
+    if img.dtype == np.float64 and img.flags.c_contiguous:
+        result = img
+    else:
+        result = np.zeros((H,W))
+    rtn = c_gauss_2d_batch(W, H, amp, mean, var, koff, extents, result)
+    if rtn == -1:
+        raise RuntimeError('c_gauss_2d_batch failed')
+    if result is not img:
+        img += result
+
 def mixture_to_patch(mixture, x0, x1, y0, y1, minval=0., exactExtent=False):
     '''
     `mixture`: a MixtureOfGaussians
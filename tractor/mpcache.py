@@ -1,11 +1,18 @@
+import mmap
+import itertools
+import multiprocessing
 from multiprocessing import Manager
 from multiprocessing.managers import BaseManager
+
+import numpy as np
+
 #from .cache import Cache
 from cache import Cache
+from patch import Patch
 
 class CacheManager(BaseManager):
 	pass
-CacheManager.register('Cache', Cache, exposed=('get','put','printStats'))
+CacheManager.register('Cache', Cache, exposed=('get','put','printStats','stats'))
 
 def createManager():
 	manager = CacheManager()
@@ -22,6 +29,225 @@ def createCache(**kwargs):
 
 
 
+# SharedPatchCache objects in this process, by id, so that they can be
+# "pickled" to forked worker processes, which inherit the shared memory.
+_shared_caches = {}
+_shared_ids = itertools.count()
+
+class SharedPatchCache(object):
+	'''
+	A cache of Patches whose pixels live in shared memory, so that
+	processes forked after it is created (eg, the workers of a
+	multiprocessing Pool, as used by Tractor(mp=...)) see each
+	other's entries without the pixels being pickled.
+
+	The pixels are kept in a ring buffer of *nbytes* bytes: new
+	entries overwrite the oldest.  A small shared index of *nslots*
+	slots maps keys to their place in the ring buffer.  Keys are
+	hashed to integers; values must be (Patch, float) or (float,
+	Patch) tuples -- like the entries in the Tractor and galaxy
+	caches -- where the Patch can be None.
+
+	To use it for the galaxy cache::
+
+		galaxy.set_galaxy_cache(SharedPatchCache())
+
+	and for the Tractor's model-patch cache::
+
+		tractor.cache = SharedPatchCache()
+		tractor.pickleCache = True
+
+	in both cases *before* the worker processes are started.
+	'''
+	# 4-way set-associative index
+	ways = 4
+
+	index_dtype = np.dtype([('key', np.int64), ('pos', np.int64),
+							('nbytes', np.int64), ('minval', np.float64),
+							('x0', np.int32), ('y0', np.int32),
+							('h', np.int32), ('w', np.int32),
+							# pixel type: 0 = Patch is None, 1 = float32,
+							# 2 = float64; -1 = empty slot
+							('ptype', np.int32),
+							# value is (patch,minval) = 0 or (minval,patch) = 1
+							('order', np.int32)])
+	ptypes = {1: np.float32, 2: np.float64}
+
+	# header: ring-buffer head, hits, misses, puts
+	nheader = 4
+
+	def __init__(self, nbytes=256*1024*1024, nslots=65536):
+		self.nbytes = nbytes
+		self.nslots = nslots
+		self.lock = multiprocessing.Lock()
+		self.arena = mmap.mmap(-1, nbytes)
+		isz = self.nheader * 8 + nslots * self.index_dtype.itemsize
+		self.indexmem = mmap.mmap(-1, isz)
+		self._attach()
+		self.header[:] = 0
+		self.index['ptype'] = -1
+		self.id = next(_shared_ids)
+		_shared_caches[self.id] = self
+
+	def _attach(self):
+		self.header = np.frombuffer(self.indexmem, np.int64, self.nheader)
+		self.index = np.frombuffer(self.indexmem, self.index_dtype,
+			self.nslots, self.nheader * 8)
+		self.pixels = np.frombuffer(self.arena, np.uint8, self.nbytes)
+
+	# "Pickling" only works into processes forked after this cache
+	# was created, which share its memory; elsewhere the cache is
+	# disabled.
+	def __getstate__(self):
+		return dict(id=self.id, nbytes=self.nbytes, nslots=self.nslots)
+	def __setstate__(self, state):
+		c = _shared_caches.get(state['id'])
+		if c is None:
+			self.__dict__.update(state)
+			self.arena = None
+			return
+		self.__dict__ = c.__dict__
+
+	def _slots(self, key):
+		s = key % self.nslots
+		return [(s + i) % self.nslots for i in range(self.ways)]
+
+	def _valid(self, e, head):
+		return e['ptype'] >= 0 and head <= e['pos'] + self.nbytes
+
+	def _key(self, key):
+		return int(hash(key)) & 0x7fffffffffffffff
+
+	def get(self, *args):
+		key = args[0]
+		if self.arena is None:
+			if len(args) == 2:
+				return args[1]
+			raise KeyError(key)
+		key = self._key(key)
+		with self.lock:
+			head = self.header[0]
+			for s in self._slots(key):
+				e = self.index[s]
+				if e['key'] != key or not self._valid(e, head):
+					continue
+				p = None
+				if e['ptype'] > 0:
+					off = e['pos'] % self.nbytes
+					pix = self.pixels[off: off + e['nbytes']].copy()
+					pix = pix.view(self.ptypes[e['ptype']]).reshape(
+						(e['h'], e['w']))
+					p = Patch(int(e['x0']), int(e['y0']), pix)
+				self.header[1] += 1
+				if e['order'] == 0:
+					return (p, float(e['minval']))
+				return (float(e['minval']), p)
+			self.header[2] += 1
+		if len(args) == 2:
+			return args[1]
+		raise KeyError(key)
+
+	def __getitem__(self, key):
+		return self.get(key)
+
+	def put(self, key, val, cost=None):
+		if self.arena is None:
+			return
+		a,b = val
+		if a is None or isinstance(a, Patch):
+			order = 0
+			p,minval = a,b
+		else:
+			order = 1
+			minval,p = a,b
+		ptype = 0
+		nb = 0
+		if p is not None and p.patch is not None:
+			if p.patch.dtype == np.float32:
+				ptype = 1
+			else:
+				ptype = 2
+			pix = np.ascontiguousarray(p.patch, self.ptypes[ptype])
+			nb = pix.nbytes
+			if nb > self.nbytes:
+				return
+		key = self._key(key)
+		with self.lock:
+			head = int(self.header[0])
+			# choose a slot: this key, else an empty or overwritten
+			# slot, else the oldest entry
+			slots = self._slots(key)
+			best = None
+			for s in slots:
+				e = self.index[s]
+				if e['key'] == key:
+					best = s
+					break
+				if not self._valid(e, head):
+					if best is None or self._valid(self.index[best], head):
+						best = s
+				elif (best is None or (self._valid(self.index[best], head) and
+						e['pos'] < self.index[best]['pos'])):
+					best = s
+			# allocate (8-byte aligned) space in the ring buffer,
+			# without wrapping around the end.
+			off = head % self.nbytes
+			if off + nb > self.nbytes:
+				head += self.nbytes - off
+				off = 0
+			pos = head
+			head += (nb + 7) & ~7
+			if nb:
+				self.pixels[off: off + nb] = pix.view(np.uint8).ravel()
+			e = self.index[best]
+			e['key'] = key
+			e['pos'] = pos
+			e['nbytes'] = nb
+			e['minval'] = minval
+			e['ptype'] = ptype
+			e['order'] = order
+			if p is not None:
+				e['x0'] = p.x0
+				e['y0'] = p.y0
+				if ptype:
+					e['h'],e['w'] = pix.shape
+			self.header[0] = head
+			self.header[3] += 1
+
+	__setitem__ = put
+
+	def clear(self):
+		if self.arena is None:
+			return
+		with self.lock:
+			self.index['ptype'] = -1
+
+	def __len__(self):
+		if self.arena is None:
+			return 0
+		head = self.header[0]
+		return int(np.sum((self.index['ptype'] >= 0) &
+				(head <= self.index['pos'] + self.nbytes)))
+
+	def stats(self):
+		'''
+		Returns a dict of statistics, shared between all processes.
+		'''
+		if self.arena is None:
+			return dict(entries=0)
+		return dict(entries=len(self), hits=int(self.header[1]),
+					misses=int(self.header[2]), puts=int(self.header[3]),
+					nbytes=self.nbytes, written=int(self.header[0]))
+
+	def printStats(self):
+		print 'SharedPatchCache:', self.stats()
+
+	def totalBytes(self):
+		if self.arena is None:
+			return 0
+		return int(min(self.header[0], self.nbytes))
+
+
 def testProcess(cache):
 	import time
 	import os
@@ -404,7 +404,7 @@ class CachingPsfEx(PsfEx):
     # For pickling
     def __getstate__(self):
         self.cache.clear()
-        return self.__dict__
+        return super(CachingPsfEx, self).__getstate__()
 
     def psfAt(self, x, y):
         # Center of rounding cell:
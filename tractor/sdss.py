@@ -1148,7 +1148,10 @@ class SdssMagsPhotoCal(BaseParams):
         return [0.01]
     def setParam(self, i, p):
         assert(i == 0)
+        old = self.aa
         self.aa = p
+        self._paramsChanged()
+        return old
 
     def getParamNames(self):
         return ['aa']
@@ -40,10 +40,10 @@ class SplineSky(ParamList):
 		'''
 		self.prior_smooth_sigma = sigma
 
-	def addTo(self, mod, scale=1.):
+	def addTo(self, mod, scale=1., x0=0, y0=0):
 		H,W = mod.shape
-		X = np.arange(W)
-		Y = np.arange(H)
+		X = x0 + np.arange(W)
+		Y = y0 + np.arange(H)
 		#print 'Y', Y.shape, 'Y.T', Y.T.shape
 		#print 'X shape', X.shape, 'Y shape', Y.shape
 		#S = self.spl(X, Y.T)
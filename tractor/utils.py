@@ -11,6 +11,9 @@ needs: sets of parameters stored in lists and such.  This framework
 could be useful outside the Tractor context.
 
 """
+import itertools
+import weakref
+
 import numpy as np
 
 try:
@@ -168,10 +171,59 @@ class GaussianPriorsMixin(object):
     def getGaussianLogPrior(self):
         return self.gpriors.getLogPrior(param=self)
 
+# Version stamps for Params objects: every change to a Params object
+# gives it (and every MultiParams containing it) a new, unique version
+# number.
+_paramVersions = itertools.count(1)
+
+# type -> whether its hashkey() changes are always notified; see
+# _classTracksHashkey().
+_trackedClasses = {}
+
+def _classTracksHashkey(obj):
+    '''
+    _hasDefaultHashkey(obj) and _notifiesParamChanges(obj), cached per
+    class since these walk the class hierarchy and hashkey() is hot.
+    '''
+    t = type(obj)
+    tracked = _trackedClasses.get(t)
+    if tracked is None:
+        tracked = _trackedClasses[t] = (_hasDefaultHashkey(obj) and
+                                        _notifiesParamChanges(obj))
+    return tracked
+
+def _hasDefaultHashkey(obj):
+    '''
+    Is the hashkey() of *obj* the one from BaseParams or MultiParams,
+    ie, computed entirely from its parameters?
+    '''
+    f = type(obj).hashkey
+    f = getattr(f, 'im_func', getattr(f, '__func__', f))
+    return f is BaseParams.__dict__['hashkey'] or f is MultiParams.__dict__['hashkey']
+
+def _notifiesParamChanges(obj):
+    '''
+    Do all the parameter setters of *obj* call _paramsChanged()?  Each
+    of setParam, setParams and setAllParams must be defined by a class
+    that says so with "_notifiesParamChanges = True" in its own body;
+    subclasses that override a setter without saying so are not
+    trusted.
+    '''
+    for name in ['setParam', 'setParams', 'setAllParams']:
+        for klass in type(obj).__mro__:
+            if name in klass.__dict__:
+                if not klass.__dict__.get('_notifiesParamChanges', False):
+                    return False
+                break
+    return True
+
 class BaseParams(object):
     '''
     A basic implementation of the `Params` duck type.
     '''
+    # (see _notifiesParamChanges)
+    _notifiesParamChanges = True
+
     def __repr__(self):
         return getClassName(self) + repr(self.getParams())
     def __str__(self):
@@ -180,6 +232,49 @@ class BaseParams(object):
         return self.__class__(*self.getAllParams())
     def hashkey(self):
         return (getClassName(self),) + tuple(self.getAllParams())
+
+    # For pickling (and copying): don't carry along the hashkey-tracking
+    # state, which refers to the MultiParams that contain this object.
+    def __getstate__(self):
+        d = self.__dict__.copy()
+        d.pop('_hkparents', None)
+        d.pop('_hkcache', None)
+        return d
+
+    def getVersion(self):
+        '''
+        Returns a version stamp that changes whenever the parameters
+        of this object (or, for MultiParams, its sub-Params) are set
+        via setParam(), setParams(), setAllParams() or named
+        parameters.
+        '''
+        return self.__dict__.get('_version', 0)
+
+    def _paramsChanged(self):
+        '''
+        Called when the parameters of this object change: updates its
+        version stamp and invalidates the cached hashkeys of the
+        MultiParams that contain it.
+        '''
+        self._version = next(_paramVersions)
+        self._hkcache = None
+        parents = self.__dict__.get('_hkparents')
+        if parents:
+            for p in list(parents.values()):
+                p._paramsChanged()
+
+    def _addHashkeyParent(self, parent):
+        # (id -> parent; parents drop out when they are deleted)
+        parents = self.__dict__.get('_hkparents')
+        if parents is None:
+            parents = self._hkparents = weakref.WeakValueDictionary()
+        parents[id(parent)] = parent
+
+    def _hashkeyTracked(self):
+        '''
+        Will _paramsChanged() be called whenever hashkey() changes?
+        '''
+        return _classTracksHashkey(self)
     #def __hash__(self):
     #    return hash(self.hashkey())
     #def __eq__(self, other):
@@ -261,8 +356,15 @@ class ScalarParam(BaseParams):
     '''
     stepsize = 1.
     strformat = '%g'
+    _notifiesParamChanges = True
     def __init__(self, val=0):
         self.val = val
+    def __setattr__(self, name, value):
+        object.__setattr__(self, name, value)
+        # Direct writes to "val" (eg, "sky.val -= x") change the
+        # parameters too.
+        if name == 'val':
+            self._paramsChanged()
     def __str__(self):
         return getClassName(self) + ': ' + self.strformat % self.val
     def __repr__(self):
@@ -295,6 +397,7 @@ class ScalarParam(BaseParams):
         self._set(p)
         return oldval
     def _set(self, val):
+        # (__setattr__ calls _paramsChanged())
         self.val = val
     def getValue(self):
         return self.val
@@ -427,7 +530,9 @@ class NamedParams(object):
     def _getNamedThing(self, nm):
         return self._getThing(self.namedparams[nm])
     def _setNamedThing(self, nm, v):
-        return self._setThing(self.namedparams[nm], v)
+        rtn = self._setThing(self.namedparams[nm], v)
+        self._paramsChanged()
+        return rtn
 
 
     def _iterNamesAndVals(self):
@@ -613,6 +718,8 @@ class ParamList(GaussianPriorsMixin, NamedParams, BaseParams):
     '''
     An implementation of Params that holds values in a list.
     '''
+    _notifiesParamChanges = True
+
     def __init__(self, *args):
         #print 'ParamList __init__()'
         # FIXME -- kwargs with named params?
@@ -666,10 +773,12 @@ class ParamList(GaussianPriorsMixin, NamedParams, BaseParams):
         ii = self._indexLiquid(i)
         oldval = self._getThing(ii)
         self._setThing(ii, val)
+        self._paramsChanged()
         return oldval
     def setParams(self, p):
         for i,j in self._indexBoth():
             self._setThing(j, p[i])
+        self._paramsChanged()
     def numberOfParams(self):
         return self._countLiquid()
     def getParams(self):
@@ -684,6 +793,7 @@ class ParamList(GaussianPriorsMixin, NamedParams, BaseParams):
     def setAllParams(self, p):
         for i,pp in enumerate(p):
             self._setThing(i, pp)
+        self._paramsChanged()
 
     def getParam(self,i):
         ii = self._indexLiquid(i)
@@ -803,6 +913,8 @@ class MultiParams(BaseParams, NamedParams):
     '''
     An implementation of Params that combines component sub-Params.
     '''
+    _notifiesParamChanges = True
+
     def __init__(self, *args):
         if len(args):
             self.subs = list(args)
@@ -819,16 +931,20 @@ class MultiParams(BaseParams, NamedParams):
     def append(self, x):
         self.subs.append(x)
         self.liquid.append(True)
+        self._paramsChanged()
     def prepend(self, x):
         self.subs = [x] + self.subs
         self.liquid = [True] + self.liquid
+        self._paramsChanged()
     def extend(self, x):
         self.subs.extend(x)
         self.liquid.extend([True] * len(x))
+        self._paramsChanged()
     def remove(self, x):
         i = self.subs.index(x)
         self.subs = self.subs[:i] + self.subs[i+1:]
         self.liquid = self.liquid[:i] + self.liquid[i+1:]
+        self._paramsChanged()
         #self.subs.remove(x)
     def index(self, x):
         return self.subs.index(x)
@@ -839,7 +955,9 @@ class MultiParams(BaseParams, NamedParams):
     def __getitem__(self, key):
         return self.subs.__getitem__(key)
     def __setitem__(self, key, val):
-        return self.subs.__setitem__(key, val)
+        rtn = self.subs.__setitem__(key, val)
+        self._paramsChanged()
+        return rtn
     def __iter__(self):
         return self.subs.__iter__()
 
@@ -867,13 +985,33 @@ class MultiParams(BaseParams, NamedParams):
     #   return MultiParams.MultiParamsIter(self)
 
     def hashkey(self):
+        '''
+        If all the sub-Params report their changes (see
+        _paramsChanged), the hashkey is cached until one of them
+        changes; otherwise it is recomputed on each call.
+        '''
+        hk = self.__dict__.get('_hkcache')
+        if hk is not None:
+            return hk
         t = [getClassName(self)]
+        tracked = True
         for s in self.subs:
             if s is None:
                 t.append(None)
+                continue
+            t.append(s.hashkey())
+            if hasattr(s, '_hashkeyTracked') and s._hashkeyTracked():
+                s._addHashkeyParent(self)
             else:
-                t.append(s.hashkey())
-        return tuple(t)
+                tracked = False
+        hk = tuple(t)
+        if tracked:
+            self._hkcache = hk
+        return hk
+
+    def _hashkeyTracked(self):
+        return (_classTracksHashkey(self) and
+                self.__dict__.get('_hkcache') is not None)
 
     def __str__(self):
         s = []
@@ -888,6 +1026,7 @@ class MultiParams(BaseParams, NamedParams):
     # the active/inactive state.
     def _setThing(self, i, val):
         self.subs[i] = val
+        self._paramsChanged()
     def _getThing(self, i):
         return self.subs[i]
     def _getThings(self):
@@ -1119,6 +1258,6 @@ class NpArrayParams(ParamList):
             return getattr(self.a, name)
         raise AttributeError() #name + ': no such attribute in NpArrayParams.__getattr__')
 
-    def __getstate__(self): return self.__dict__
+    def __getstate__(self): return super(NpArrayParams, self).__getstate__()
     def __setstate__(self, d): self.__dict__.update(d)
 
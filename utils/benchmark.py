@@ -0,0 +1,398 @@
+'''
+Benchmarks of the Tractor's rendering and fitting engines, on
+synthetic scenes generated from a fixed random seed (no input files).
+
+    python utils/benchmark.py                      # all the scenes
+    python utils/benchmark.py -s stars-mog -s gals-pix --repeat 5
+    python utils/benchmark.py -o new.json --compare old.json
+    python utils/benchmark.py --nsrc 100 --mix exp:1 --psf psfex
+
+Each scene is run in its own process, so the peak memory reported
+(maxrss, from getrusage) is that of the scene alone (plus the
+interpreter and imports, reported as rss0).  The results are written
+as JSON: one entry per scene, with the scene parameters, the best and
+median wall-clock times of each stage over the repeats, and the
+memory; with --compare, the timings are also printed as ratios to an
+earlier results file.
+'''
+import sys
+import os
+import time
+import json
+import platform
+import resource
+import multiprocessing
+
+import numpy as np
+
+from tractor import (Tractor, Image, PointSource, PixPos, Flux, NullWCS,
+                     LinearPhotoCal, ConstantSky, GaussianMixturePSF,
+                     PixelizedPSF)
+from tractor.galaxy import (ExpGalaxy, DevGalaxy, FixedCompositeGalaxy,
+                            FracDev, GalaxyShape)
+from tractor.sersic import SersicGalaxy, SersicIndex
+from tractor.psfex import PsfEx
+
+# Source types, by their name in a "mix"
+sourcetypes = ['point', 'exp', 'dev', 'comp', 'sersic']
+
+# psf: 'mog' (GaussianMixturePSF), 'pixelized' (PixelizedPSF) or
+# 'psfex' (PsfEx, varying across the image)
+scenes = dict([(s['name'], s) for s in [
+    dict(name='stars-mog', nsrc=100, mix=dict(point=1.), psf='mog',
+         size=128, epochs=1),
+    dict(name='stars-pix', nsrc=100, mix=dict(point=1.), psf='pixelized',
+         size=128, epochs=1),
+    dict(name='gals-mog', nsrc=40, mix=dict(exp=0.3, dev=0.3, comp=0.2,
+                                             sersic=0.2),
+         psf='mog', size=128, epochs=1),
+    dict(name='gals-pix', nsrc=40, mix=dict(exp=0.3, dev=0.3, comp=0.2,
+                                             sersic=0.2),
+         psf='pixelized', size=128, epochs=1),
+    dict(name='mixed-psfex', nsrc=60, mix=dict(point=0.5, exp=0.2, dev=0.2,
+                                                comp=0.1),
+         psf='psfex', size=128, epochs=1),
+    dict(name='mixed-epochs', nsrc=60, mix=dict(point=0.5, exp=0.2, dev=0.2,
+                                                 comp=0.1),
+         psf='mog', size=128, epochs=4),
+    dict(name='large', nsrc=400, mix=dict(point=0.6, exp=0.2, dev=0.2),
+         psf='mog', size=512, epochs=1),
+    ]])
+
+stages = ['getModelImage', 'getDerivs', 'getUpdateDirection', 'optimize',
+          'optimize_forced_photometry']
+
+def _rss():
+    '''
+    Current resident set size in MB, or None.
+    '''
+    try:
+        f = open('/proc/self/statm')
+        rss = int(f.read().split()[1])
+        f.close()
+        return rss * resource.getpagesize() / 1e6
+    except:
+        return None
+
+def _maxrss():
+    '''
+    Peak resident set size of this process in MB.
+    '''
+    r = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        # bytes, not kB
+        return r / 1e6
+    return r / 1e3
+
+def _mogParams(sigma, e=0.):
+    '''
+    Parameters of a two-component GaussianMixturePSF with core width
+    *sigma* and ellipticity-ish *e*, in the order its constructor wants.
+    '''
+    amp = [0.8, 0.2]
+    mean = [0., 0., 0., 0.]
+    var = []
+    for s in [sigma, 2. * sigma]:
+        var.extend([s**2 * (1. + e), s**2 * (1. - e), 0.3 * e * s**2])
+    return amp + mean + var
+
+def make_psf(kind, sigma, W, H):
+    if kind == 'mog':
+        return GaussianMixturePSF(*_mogParams(sigma))
+    if kind == 'pixelized':
+        mog = GaussianMixturePSF(*_mogParams(sigma))
+        r = int(np.ceil(5. * 2. * sigma))
+        stamp = mog.getPointSourcePatch(0., 0., radius=r).patch
+        return PixelizedPSF(stamp / stamp.sum())
+    if kind == 'psfex':
+        # The spatial variation is given directly as a grid of mixture
+        # parameters, rather than fit to PSFEx eigen-images.
+        psf = PsfEx(None, W, H, nx=5, ny=5, K=2)
+        XX = np.linspace(0, W, psf.nx)
+        YY = np.linspace(0, H, psf.ny)
+        pp = np.array([[_mogParams(sigma * (1. + 0.2 * y / H),
+                                   e=0.1 * x / W)
+                        for x in XX] for y in YY])
+        psf.fitSavedData(pp, XX, YY)
+        psf.radius = 5. * 2. * sigma * 1.2
+        return psf
+    raise ValueError('Unknown PSF type: "%s"' % kind)
+
+def make_source(kind, x, y, flux, rnd):
+    pos = PixPos(x, y)
+    br = Flux(flux)
+    if kind == 'point':
+        return PointSource(pos, br)
+    shape = GalaxyShape(rnd.uniform(1., 3.), rnd.uniform(0.4, 1.),
+                        rnd.uniform(0., 180.))
+    if kind == 'exp':
+        return ExpGalaxy(pos, br, shape)
+    if kind == 'dev':
+        return DevGalaxy(pos, br, shape)
+    if kind == 'comp':
+        shape2 = GalaxyShape(rnd.uniform(0.5, 1.5), rnd.uniform(0.4, 1.),
+                             rnd.uniform(0., 180.))
+        return FixedCompositeGalaxy(pos, br, FracDev(rnd.uniform(0.2, 0.8)),
+                                    shape, shape2)
+    if kind == 'sersic':
+        return SersicGalaxy(pos, br, shape,
+                            SersicIndex(rnd.uniform(1.5, 4.)))
+    raise ValueError('Unknown source type: "%s"' % kind)
+
+def make_scene(scene, seed=42):
+    '''
+    Returns (tractor, truth): a Tractor with the images of *scene*
+    (noisy renderings of the true catalog) and a perturbed catalog,
+    plus the true parameters.
+    '''
+    rnd = np.random.RandomState(seed)
+    W = H = scene['size']
+    nsrc = scene['nsrc']
+    mix = scene['mix']
+    names = sorted(mix.keys())
+    frac = np.array([mix[k] for k in names], float)
+    kinds = rnd.choice(len(names), size=nsrc, p=frac / frac.sum())
+    margin = 8.
+    srcs = []
+    for k in kinds:
+        srcs.append(make_source(names[k], rnd.uniform(margin, W - margin),
+                                rnd.uniform(margin, H - margin),
+                                rnd.uniform(50., 500.), rnd))
+    sig1 = 1.
+    tims = []
+    for e in range(scene['epochs']):
+        psf = make_psf(scene['psf'], 1.2 + 0.15 * e, W, H)
+        tims.append(Image(data=np.zeros((H,W), np.float32),
+                          invvar=np.ones((H,W), np.float32) / sig1**2,
+                          psf=psf, wcs=NullWCS(),
+                          photocal=LinearPhotoCal(1.),
+                          sky=ConstantSky(0.), name='epoch %i' % e))
+    tractor = Tractor(tims, srcs)
+    for tim in tims:
+        mod = tractor.getModelImage(tim)
+        tim.data = (mod + rnd.normal(scale=sig1, size=mod.shape)).astype(
+            np.float32)
+    tractor.freezeParam('images')
+    truth = tractor.getParams()
+    # perturb the positions and fluxes
+    for src in srcs:
+        src.pos.setParams([p + rnd.normal(scale=0.3)
+                           for p in src.pos.getParams()])
+        src.brightness.setParams([p * rnd.uniform(0.8, 1.2)
+                                  for p in src.brightness.getParams()])
+    tractor.cache.clear()
+    return tractor, truth
+
+def _timeit(func, repeat, setup=None):
+    '''
+    Returns (best, median, result of the last call) of the wall-clock
+    time of *func()*, calling *setup()* untimed before each call.
+    '''
+    times = []
+    for i in range(repeat):
+        if setup is not None:
+            setup()
+        t0 = time.time()
+        R = func()
+        times.append(time.time() - t0)
+    return min(times), float(np.median(times)), R
+
+def run_scene(scene, repeat=3, seed=42, profile=False):
+    '''
+    Times the stages of one scene; returns a dict.
+    '''
+    rss0 = _rss()
+    t0 = time.time()
+    tractor,truth = make_scene(scene, seed=seed)
+    R = dict(scene=scene, seed=seed, repeat=repeat,
+             setup=time.time() - t0,
+             nparams=tractor.numberOfParams(),
+             npix=sum([tim.shape[0] * tim.shape[1]
+                       for tim in tractor.getImages()]))
+    p0 = tractor.getParams()
+    def reset():
+        tractor.setParams(p0)
+        tractor.cache.clear()
+    timings = {}
+    profiles = {}
+
+    def bench(name, func):
+        best,med,res = _timeit(func, repeat, setup=reset)
+        timings[name] = dict(best=best, median=med)
+        if profile:
+            reset()
+            with tractor.profiling() as stats:
+                func()
+            profiles[name] = stats.report()
+        return res
+
+    bench('getModelImage', tractor.getModelImages)
+    bench('getDerivs', tractor.getDerivs)
+    reset()
+    allderivs = tractor.getDerivs()
+    # (no setup: the derivatives are for p0)
+    best,med,nil = _timeit(lambda: tractor.getUpdateDirection(allderivs),
+                           repeat)
+    timings['getUpdateDirection'] = dict(best=best, median=med)
+    bench('optimize', tractor.optimize)
+    # (a check that versions are doing the same work)
+    R['lnp_optimize'] = tractor.getLogProb()
+
+    for src in tractor.catalog:
+        src.freezeAllBut('brightness')
+    # (reset() now restores these)
+    p0 = tractor.getParams()
+    bench('optimize_forced_photometry',
+          lambda: tractor.optimize_forced_photometry(direct=True))
+    for src in tractor.catalog:
+        src.thawAllParams()
+
+    R['timings'] = timings
+    if profile:
+        R['profiles'] = profiles
+    R['rss0'] = rss0
+    R['maxrss'] = _maxrss()
+    return R
+
+def _run_scene_queued(args):
+    (scene, repeat, seed, profile, q) = args
+    try:
+        q.put(run_scene(scene, repeat=repeat, seed=seed, profile=profile))
+    except Exception as e:
+        import traceback
+        traceback.print_exc()
+        q.put(dict(scene=scene, error=str(e)))
+
+def run_scene_in_process(scene, **kwargs):
+    '''
+    run_scene() in a child process, so that its peak memory is its own.
+    '''
+    q = multiprocessing.Queue()
+    p = multiprocessing.Process(
+        target=_run_scene_queued,
+        args=((scene, kwargs.get('repeat', 3), kwargs.get('seed', 42),
+               kwargs.get('profile', False), q),))
+    p.start()
+    R = q.get()
+    p.join()
+    return R
+
+def environment():
+    import scipy
+    import subprocess
+    try:
+        d = os.path.dirname(os.path.abspath(__file__))
+        version = subprocess.Popen(['git', 'describe', '--always', '--dirty'],
+                                   cwd=d, stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE).communicate()[0]
+        version = version.strip().decode('ascii')
+    except:
+        version = None
+    return dict(version=version, python=platform.python_version(),
+                numpy=np.__version__, scipy=scipy.__version__,
+                machine=platform.machine(), node=platform.node(),
+                date=time.strftime('%Y-%m-%dT%H:%M:%S'))
+
+def compare(results, old):
+    '''
+    Prints the best times of *results* as ratios to those of *old*
+    (both lists of run_scene() dicts), by scene name.
+    '''
+    oldbyname = dict([(r['scene']['name'], r) for r in old
+                      if 'timings' in r])
+    print '%-16s %-28s %10s %10s %8s' % ('scene', 'stage', 'old', 'new',
+                                         'ratio')
+    for r in results:
+        name = r['scene']['name']
+        o = oldbyname.get(name)
+        if o is None or not 'timings' in r:
+            continue
+        for stage in stages:
+            if not (stage in r['timings'] and stage in o['timings']):
+                continue
+            a = o['timings'][stage]['best']
+            b = r['timings'][stage]['best']
+            print '%-16s %-28s %10.4f %10.4f %8.2f' % (name, stage, a, b,
+                                                       b / max(a, 1e-9))
+
+def main():
+    import optparse
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('-s', '--scene', dest='scenes', action='append',
+                      default=[], help='Scene to run (repeatable); default all')
+    parser.add_option('--list', action='store_true',
+                      help='List the scenes and exit')
+    parser.add_option('--repeat', type=int, default=3,
+                      help='Timings per stage (default %default)')
+    parser.add_option('--seed', type=int, default=42,
+                      help='Random seed of the scenes (default %default)')
+    parser.add_option('-o', '--out', help='Write JSON results to this file')
+    parser.add_option('--compare', help='Compare with this results file')
+    parser.add_option('--profile', action='store_true',
+                      help='Also record Tractor.profiling() reports')
+    parser.add_option('--no-fork', dest='fork', action='store_false',
+                      default=True, help='Run the scenes in this process')
+    parser.add_option('--nsrc', type=int,
+                      help='Run a custom scene with this many sources')
+    parser.add_option('--mix', default='point:1',
+                      help='Custom scene: source mix, eg "point:0.5,exp:0.5" '
+                      '(types: %s)' % ', '.join(sourcetypes))
+    parser.add_option('--psf', default='mog',
+                      help='Custom scene: mog, pixelized or psfex')
+    parser.add_option('--size', type=int, default=128,
+                      help='Custom scene: image size')
+    parser.add_option('--epochs', type=int, default=1,
+                      help='Custom scene: number of images')
+    opt,args = parser.parse_args()
+
+    if opt.list:
+        for name in sorted(scenes.keys()):
+            print name, scenes[name]
+        return 0
+
+    if opt.nsrc is not None:
+        mix = {}
+        for word in opt.mix.split(','):
+            k,v = word.split(':')
+            if not k in sourcetypes:
+                parser.error('Unknown source type "%s"' % k)
+            mix[k] = float(v)
+        torun = [dict(name='custom', nsrc=opt.nsrc, mix=mix, psf=opt.psf,
+                      size=opt.size, epochs=opt.epochs)]
+    elif len(opt.scenes):
+        for name in opt.scenes:
+            if not name in scenes:
+                parser.error('Unknown scene "%s"; see --list' % name)
+        torun = [scenes[name] for name in opt.scenes]
+    else:
+        torun = [scenes[name] for name in sorted(scenes.keys())]
+
+    results = []
+    for scene in torun:
+        kw = dict(repeat=opt.repeat, seed=opt.seed, profile=opt.profile)
+        if opt.fork:
+            R = run_scene_in_process(scene, **kw)
+        else:
+            R = run_scene(scene, **kw)
+        results.append(R)
+        if 'error' in R:
+            print '%-16s failed: %s' % (scene['name'], R['error'])
+            continue
+        print '%-16s' % scene['name'], ' '.join(
+            ['%s %.4f' % (stage, R['timings'][stage]['best'])
+             for stage in stages]), 'maxrss %.0f MB' % R['maxrss']
+
+    if opt.out:
+        f = open(opt.out, 'w')
+        json.dump(dict(environment=environment(), results=results), f,
+                  indent=1, sort_keys=True)
+        f.close()
+        print 'Wrote', opt.out
+
+    if opt.compare:
+        old = json.load(open(opt.compare))
+        compare(results, old['results'])
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())